@@ -4,6 +4,10 @@ from jsonschema import validate
 from jsonschema.exceptions import ValidationError
 from socketio import AsyncNamespace
 from functools import wraps
+import asyncio
+import os
+import time
+import weakref
 
 import constants
 from error import Errors
@@ -11,16 +15,25 @@ from managers.global_manager import GlobalManager
 import schema.board_responses as bres
 import schema.discussion_requests as dreq
 import schema.discussion_responses as dres
+from utils import metrics
+from utils.rate_limit import RateLimiter
+from utils.supervisor import supervise
 from utils.utils import (
   logger,
   is_error, 
   make_error,
+  split_error,
   DictEncoder, 
+  stem_cache_stats,
 )
 
 
 gm = GlobalManager()
 sio = gm.sio
+rate_limiter = RateLimiter(constants.RATE_LIMITS, constants.RATE_LIMIT_CLASSES)
+# discussion id -> held while an event is numbered and sent, so every client
+# gets the events of a discussion in the order of their seq
+emit_locks = weakref.WeakValueDictionary()
 
 
 # have checkers later
@@ -47,37 +60,47 @@ class DiscussionNamespace(AsyncNamespace):
     Namespace functions for the discussion abstraction.
     """
 
-    def _process_responses(name, ret=None, emits=None): # res is used to package emits
+    def _process_responses(name, ret=None, emits=None, broadcast=True, broadcast_as=None): # res is used to package emits
       def outer(func):
         @wraps(func)
         async def helper(self, sid, request):
           try:
             result = None
+            # offloaded requests are only acknowledged here; the worker
+            # sends the results
+            offloaded = request.get("background", False) \
+              if isinstance(request, dict) else False
+            ret_schema = "offloaded" if offloaded else ret
+            emit_schemas = None if offloaded else emits
+            start = time.monotonic()
             product = await func(self, sid, request)
+            metrics.observe(name, time.monotonic() - start, is_error(product))
             logger.info("func_name: {}\nproduct: {}\nrequest: {}\n".format(
               name, product, request
             ))
 
             if is_error(product):
-              result = make_error(product, info={
-                "func_name": name, "result": result, "request": request
-              })
+              error, details = split_error(product)
+              info = {"func_name": name, "result": result, "request": request}
+              if details is not None:
+                info["details"] = details
+              result = make_error(error, info=info)
             else:
               ret_res, emits_res = product
 
               bad_response = False
 
-              if ret is not None:
+              if ret_schema is not None:
                 try:
-                  validate(instance=ret_res, schema=dres.schema[ret])
+                  validate(instance=ret_res, schema=dres.schema[ret_schema])
                   result = ret_res
                 except ValidationError:
-                  logger.info("Return response: {}\nReturn schema: {}".format(ret_res, ret))
+                  logger.info("Return response: {}\nReturn schema: {}".format(ret_res, ret_schema))
                   bad_response = True
 
-              if emits is not None:
+              if emit_schemas is not None:
                 assert(emits_res is not None)
-                for r, e in zip(emits_res, emits):
+                for r, e in zip(emits_res, emit_schemas):
                   try:
                     validate(instance=r, schema=dres.schema[e])
                   except ValidationError:
@@ -89,9 +112,9 @@ class DiscussionNamespace(AsyncNamespace):
               else: # we can send off emits
 
                 shared = {}
-                if emits is not None:
+                if emit_schemas is not None:
                   assert(emits_res is not None)
-                  for r, e in zip(emits_res, emits):
+                  for r, e in zip(emits_res, emit_schemas):
                     shared[e] = r
 
                 if result is None:
@@ -99,15 +122,28 @@ class DiscussionNamespace(AsyncNamespace):
                 # set emitted data to return
                 result["shared"] = shared
 
-                result = dumps(result, cls=DictEncoder) # default returns
-
                 # every function except maybe leave should have a discussion id
                 session = await self.get_session(sid)
                 # send to everyone else
-                if "discussion_id" in session:
+                if broadcast and not offloaded and "discussion_id" in session:
                   discussion_id = session["discussion_id"]
-                  emit_shared = dumps(shared, cls=DictEncoder)
-                  await self.emit(name, emit_shared, room=discussion_id, skip_sid=sid)
+                  event = name if broadcast_as is None else broadcast_as
+                  # everyone else has a copy to apply the delta to
+                  shared = {k: v for k, v in shared.items() \
+                    if k != "doc_meta" or "doc_delta" not in shared}
+                  lock = emit_locks.setdefault(discussion_id, asyncio.Lock())
+                  async with lock:
+                    # logged for clients that miss it, and numbered so they know
+                    if len(shared) > 0:
+                      seq = gm.event_log_manager.append(discussion_id, event, shared)
+                      if seq is not None:
+                        shared["seq"] = seq
+                        # a resync already says how far its own payload goes
+                        result.setdefault("seq", seq)
+                    emit_shared = dumps(shared, cls=DictEncoder)
+                    await self.emit(event, emit_shared, room=discussion_id, skip_sid=sid)
+
+                result = dumps(result, cls=DictEncoder) # default returns
 
             return result
 
@@ -142,6 +178,38 @@ class DiscussionNamespace(AsyncNamespace):
         return helper
       return outer
 
+    async def _run(self, event, sid, request, **kwargs):
+      """
+      Run the operation here, or queue it for the worker if the request asks.
+      """
+      if request.get("background", False):
+        return await gm.discussion_manager.offload(
+          discussion_id=kwargs["discussion_id"],
+          event=event, 
+          operation=kwargs,
+          sid=sid
+        )
+      return getattr(gm.discussion_manager, event)(**kwargs)
+
+    async def trigger_event(self, event, *args):
+      """
+      Events over the sender's rate limit are turned away before any work.
+      """
+      sid = args[0] if len(args) > 0 else None
+      if event == "disconnect":
+        rate_limiter.forget(sid)
+      elif sid is not None:
+        cost = 1
+        if event == "batch" and len(args) > 1 and isinstance(args[1], dict):
+          operations = args[1].get("operations")
+          if isinstance(operations, list):
+            cost = max(len(operations), 1)
+        if not rate_limiter.allow(sid, event, cost):
+          metrics.limit(event)
+          # counted rather than logged, as a flood would fill the log
+          return make_error(Errors.RATE_LIMITED, log=False)
+      return await super().trigger_event(event, *args)
+
     async def on_connect(self, sid, environ):
       # does not do anything
       pass
@@ -155,10 +223,12 @@ class DiscussionNamespace(AsyncNamespace):
     async def on_test_connect(self, sid, request):
         """
         :event: :ref:`dreq_create_user-label`
-        :errors: BAD_REQUEST, BAD_DISCUSSION_ID
+        :errors: BAD_REQUEST, BAD_DISCUSSION_ID, OVERLOADED
         """
         discussion_id = request["discussion_id"]
-        result = gm.discussion_manager.test_connect(
+        # an archived discussion is restored off the event loop
+        result = await gm.admission_manager.run(
+          gm.discussion_manager.test_connect,
           discussion_id=discussion_id,
         )
 
@@ -176,7 +246,7 @@ class DiscussionNamespace(AsyncNamespace):
         """
         :event: :ref:`dreq_create_user-label`
         :return: :ref:`dres_created_user-label` 
-        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, NICKNAME_EXISTS, USER_ID_EXISTS 
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, NICKNAME_EXISTS, USER_ID_EXISTS, OVERLOADED 
         """
         discussion_id = request["discussion_id"]
         nickname = request["nickname"]
@@ -184,7 +254,8 @@ class DiscussionNamespace(AsyncNamespace):
         if "user_id" in request:
           user_id = request["user_id"]
 
-        result = gm.discussion_manager.create_user(
+        result = await gm.admission_manager.run(
+          gm.discussion_manager.create_user,
           discussion_id=discussion_id,
           nickname=nickname,
           user_id=user_id
@@ -198,14 +269,15 @@ class DiscussionNamespace(AsyncNamespace):
         :event: :ref:`dreq_join-label`
         :return: *joined_user* (:ref:`dres_joined_user-label`)
         :emit: *set_cursor* (:ref:`dres_set_cursor-label`)
-        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID 
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, OVERLOADED 
         """
         user_id = request["user_id"]
 
         session = await self.get_session(sid)
         discussion_id = session["discussion_id"]
 
-        result = gm.discussion_manager.join(
+        result = await gm.admission_manager.run(
+          gm.discussion_manager.join,
           discussion_id=discussion_id, 
           user_id=user_id
         )
@@ -223,6 +295,46 @@ class DiscussionNamespace(AsyncNamespace):
 
         return result
 
+    @_process_responses("resync", ret="resynced", emits=["set_cursor"], 
+      broadcast_as="join")
+    @_validate_request("resync")
+    async def on_resync(self, sid, request):
+        """
+        NOTE: Use this instead of join when reconnecting. Every broadcast 
+        carries the *seq* of the discussion's event log; send the last one 
+        seen. Events may arrive both live and in *events*; skip those with 
+        a *seq* already seen.
+
+        :event: :ref:`dreq_resync-label`
+        :return: *resynced* (:ref:`dres_resynced-label`)
+        :emit: *set_cursor* (:ref:`dres_set_cursor-label`), as join
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, OVERLOADED 
+        """
+        user_id = request["user_id"]
+
+        session = await self.get_session(sid)
+        discussion_id = session["discussion_id"]
+
+        # in the room before the log is read, so no event falls in between
+        self.enter_room(sid, discussion_id)
+        result = await gm.admission_manager.run(
+          gm.discussion_manager.resync,
+          discussion_id=discussion_id, 
+          user_id=user_id,
+          seq=request["seq"]
+        )
+
+        if not is_error(result):
+          await self.save_session(sid, {
+            "joined": True,
+            "user_id": user_id,
+            "discussion_id": discussion_id
+          })
+        else:
+          self.leave_room(sid, discussion_id)
+
+        return result
+
     # this function has to be handled manually
     @_process_responses("leave", emits=["left_user"])
     async def on_leave(self, sid, request):
@@ -307,6 +419,27 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
+    @_process_responses("get_doc_meta", ret="get_doc_meta")
+    @_validate_request("get_doc_meta")
+    @_check_user_session
+    async def on_get_doc_meta(self, sid, request):
+        """
+        NOTE: Use this when a *doc_delta* does not apply to the cached copy.
+
+        :event: :ref:`dreq_get_doc_meta-label`
+        :return: :ref:`dres_get_doc_meta-label`
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_UNIT_ID
+        """
+        units = request["units"]
+        session = await self.get_session(sid)
+        discussion_id = session["discussion_id"]
+
+        result = gm.discussion_manager.get_doc_meta(
+          discussion_id=discussion_id, 
+          units=units
+        )
+        return result
+
     @_process_responses("get_unit_context", ret="get_unit_context")
     @_validate_request("get_unit_context")
     @_check_user_session
@@ -326,13 +459,33 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
-    @_process_responses("post", emits=["created_post", "doc_meta", "chat_meta"])
+    @_process_responses("get_discussion_stats", ret="get_discussion_stats")
+    @_validate_request("get_discussion_stats")
+    @_check_user_session
+    async def on_get_discussion_stats(self, sid, request):
+        """
+        Time spent on each unit and by each user. Rolled up periodically by
+        the worker, so recent visits may be missing.
+
+        :event: :ref:`dreq_get_discussion_stats-label`
+        :return: :ref:`dres_get_discussion_stats-label`
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID
+        """
+        session = await self.get_session(sid)
+        discussion_id = session["discussion_id"]
+
+        result = gm.discussion_manager.get_discussion_stats(
+          discussion_id=discussion_id
+        )
+        return result
+
+    @_process_responses("post", emits=["created_post", "doc_meta", "chat_meta", "doc_delta"])
     @_validate_request("post")
     @_check_user_session
     async def on_post(self, sid, request):
         """
         :event: :ref:`dreq_post-label`
-        :emit: *created_post* (:ref:`dres_created_post-label`) AND *doc_meta* (:ref:`dres_doc_meta-label`) AND *chat_meta* (:ref:`dres_chat_meta-label`) 
+        :emit: *created_post* (:ref:`dres_created_post-label`) AND *doc_meta* (:ref:`dres_doc_meta-label`) AND *chat_meta* (:ref:`dres_chat_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID
         """
         pith = request["pith"]
@@ -352,27 +505,54 @@ class DiscussionNamespace(AsyncNamespace):
     @_check_user_session
     async def on_search(self, sid, request):
         """
+        Runs on the worker if *background* is set (see :ref:`dres_offloaded-label`).
+
         :event: :ref:`dreq_search-label`
         :return: :ref:`dres_search-label`
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, JOB_NOT_QUEUED
+        """
+        query = request["query"]
+        limit = request.get("limit", constants.SEARCH_DEFAULT_LIMIT)
+        offset = request.get("offset", 0)
+        session = await self.get_session(sid)
+        discussion_id = session["discussion_id"]
+
+        result = await self._run("search", sid, request,
+          discussion_id=discussion_id,
+          query=query,
+          limit=limit,
+          offset=offset
+        )
+        return result
+
+    @_process_responses("typeahead", ret="typeahead")
+    @_validate_request("typeahead")
+    @_check_user_session
+    async def on_typeahead(self, sid, request):
+        """
+        :event: :ref:`dreq_typeahead-label`
+        :return: :ref:`dres_typeahead-label`
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID
         """
         query = request["query"]
+        limit = request.get("limit", constants.TYPEAHEAD_DEFAULT_LIMIT)
         session = await self.get_session(sid)
         discussion_id = session["discussion_id"]
 
-        result = gm.discussion_manager.search(
+        result = gm.discussion_manager.typeahead(
           discussion_id=discussion_id, 
-          query=query
+          query=query,
+          limit=limit
         )
         return result
 
-    @_process_responses("send_to_doc", emits=["sent_to_doc", "doc_meta", "chat_meta"])
+    @_process_responses("send_to_doc", emits=["sent_to_doc", "doc_meta", "chat_meta", "doc_delta"])
     @_validate_request("send_to_doc")
     @_check_user_session
     async def on_send_to_doc(self, sid, request):
         """
         :event: :ref:`dreq_send_to_doc-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *chat_meta* (:ref:`dres_chat_meta-label`)
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *chat_meta* (:ref:`dres_chat_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_UNIT_ID
         """
         unit_id = request["unit_id"]
@@ -387,11 +567,13 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
-    @_process_responses("move_cursor", emits=["set_cursor"])
+    @_process_responses("move_cursor", emits=["set_cursor"], broadcast=False)
     @_validate_request("move_cursor")
     @_check_user_session
     async def on_move_cursor(self, sid, request): 
         """
+        NOTE: Others receive only the latest cursor, at `CURSOR_BROADCAST_RATE`.
+
         :event: :ref:`dreq_move_cursor-label`
         :emit: *set_cursor* (:ref:`dres_set_cursor-label`)
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, BAD_POSITION
@@ -402,59 +584,64 @@ class DiscussionNamespace(AsyncNamespace):
         discussion_id = session["discussion_id"]
         user_id = session["user_id"]
 
-        result = gm.discussion_manager.move_cursor(
+        result = gm.discussion_manager.hold_cursor(
           discussion_id=discussion_id, 
           user_id=user_id, 
           unit_id=unit_id, 
-          position=position
+          position=position,
+          sid=sid
         )
         return result
 
-    @_process_responses("hide_unit", emits=["doc_meta"])
+    @_process_responses("hide_unit", emits=["doc_meta", "doc_delta"])
     @_validate_request("hide_unit")
     @_check_user_session
     async def on_hide_unit(self, sid, request): 
         """
+        Runs on the worker if *background* is set (see :ref:`dres_offloaded-label`).
+
         :event: :ref:`dreq_hide_unit-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`)
-        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_UNIT_ID
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_UNIT_ID, JOB_NOT_QUEUED
         """
         unit_id = request["unit_id"]
         session = await self.get_session(sid)
         discussion_id = session["discussion_id"]
 
-        result = gm.discussion_manager.hide_unit(
-          discussion_id=discussion_id, 
+        result = await self._run("hide_unit", sid, request,
+          discussion_id=discussion_id,
           unit_id=unit_id
         )
         return result
 
-    @_process_responses("unhide_unit", emits=["doc_meta"])
+    @_process_responses("unhide_unit", emits=["doc_meta", "doc_delta"])
     @_validate_request("unhide_unit")
     @_check_user_session
     async def on_unhide_unit(self, sid, request): 
         """
+        Runs on the worker if *background* is set (see :ref:`dres_offloaded-label`).
+
         :event: :ref:`dreq_unhide_unit-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`)
-        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_UNIT_ID
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_UNIT_ID, JOB_NOT_QUEUED
         """
         unit_id = request["unit_id"]
         session = await self.get_session(sid)
         discussion_id = session["discussion_id"]
 
-        result = gm.discussion_manager.unhide_unit(
-          discussion_id=discussion_id, 
+        result = await self._run("unhide_unit", sid, request,
+          discussion_id=discussion_id,
           unit_id=unit_id
         )
         return result
 
-    @_process_responses("add_unit", emits=["added_unit", "doc_meta", "chat_meta"])
+    @_process_responses("add_unit", emits=["added_unit", "doc_meta", "chat_meta", "doc_delta"])
     @_validate_request("add_unit")
     @_check_user_session
     async def on_add_unit(self, sid, request): 
         """
         :event: :ref:`dreq_add_unit-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *chat_meta* (:ref:`dres_chat_meta-label`)
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *chat_meta* (:ref:`dres_chat_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID
         """
         pith = request["pith"]
@@ -471,13 +658,13 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
-    @_process_responses("select_unit", emits=["doc_meta"])
+    @_process_responses("select_unit", emits=["doc_meta", "doc_delta"])
     @_validate_request("select_unit")
     @_check_user_session
     async def on_select_unit(self, sid, request): 
         """
         :event: :ref:`dreq_select_unit-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) 
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, FAILED_POSITION_ACQUIRE
         """
         unit_id = request["unit_id"]
@@ -492,13 +679,13 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
-    @_process_responses("deselect_unit", emits=["doc_meta"])
+    @_process_responses("deselect_unit", emits=["doc_meta", "doc_delta"])
     @_validate_request("deselect_unit")
     @_check_user_session
     async def on_deselect_unit(self, sid, request): 
         """
         :event: :ref:`dreq_deselect_unit-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) 
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, BAD_POSITION_TRY
         """
         unit_id = request["unit_id"]
@@ -513,7 +700,7 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
-    @_process_responses("move_units", emits=["doc_meta"])
+    @_process_responses("move_units", emits=["doc_meta", "doc_delta"])
     @_validate_request("move_units")
     @_check_user_session
     async def on_move_units(self, sid, request): 
@@ -521,7 +708,7 @@ class DiscussionNamespace(AsyncNamespace):
         NOTE: Call `select_unit` before this.
 
         :event: :ref:`dreq_move_units-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) 
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, BAD_POSITION_TRY, BAD_PARENT
         """
         units = request["units"]
@@ -540,16 +727,18 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
-    @_process_responses("merge_units", emits=["merged_units", "doc_meta"])
+    @_process_responses("merge_units", emits=["merged_units", "doc_meta", "doc_delta"])
     @_validate_request("merge_units")
     @_check_user_session
     async def on_merge_units(self, sid, request): 
         """
         NOTE: Call `select_unit` before this.
 
+        Runs on the worker if *background* is set (see :ref:`dres_offloaded-label`).
+
         :event: :ref:`dreq_merge_units-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) 
-        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, BAD_POSITION_TRY, BAD_PARENT
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, BAD_POSITION_TRY, BAD_PARENT, JOB_NOT_QUEUED
         """
         units = request["units"]
         parent = request["parent"]
@@ -558,8 +747,8 @@ class DiscussionNamespace(AsyncNamespace):
         discussion_id = session["discussion_id"]
         user_id = session["user_id"]
 
-        result = gm.discussion_manager.merge_units(
-          discussion_id=discussion_id, 
+        result = await self._run("merge_units", sid, request,
+          discussion_id=discussion_id,
           user_id=user_id,
           units=units,
           parent=parent,
@@ -567,13 +756,13 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
-    @_process_responses("request_to_edit", emits=["doc_meta"])
+    @_process_responses("request_to_edit", emits=["doc_meta", "doc_delta"])
     @_validate_request("request_to_edit")
     @_check_user_session
     async def on_request_to_edit(self, sid, request):
         """
         :event: :ref:`dreq_request_to_edit-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) 
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, FAILED_EDIT_ACQUIRE
         """
         unit_id = request["unit_id"]
@@ -588,13 +777,13 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
-    @_process_responses("deedit_unit", emits=["doc_meta"])
+    @_process_responses("deedit_unit", emits=["doc_meta", "doc_delta"])
     @_validate_request("deedit_unit")
     @_check_user_session
     async def on_deedit_unit(self, sid, request):
         """
         :event: :ref:`dreq_deedit_unit-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) 
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
         :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, BAD_EDIT_TRY
         """
         unit_id = request["unit_id"]
@@ -609,16 +798,19 @@ class DiscussionNamespace(AsyncNamespace):
         )
         return result
 
-    @_process_responses("edit_unit", emits=["doc_meta", "chat_meta"])
+    @_process_responses("edit_unit", emits=["doc_meta", "chat_meta", "doc_delta"])
     @_validate_request("edit_unit")
     @_check_user_session
     async def on_edit_unit(self, sid, request):
         """
-        NOTE: Call `request_to_edit` before this.
+        NOTE: Call `request_to_edit` before this, or send the *version* of 
+        the unit the edit was made to. Then the edit is only made if the 
+        unit is unchanged and unlocked, and otherwise fails with 
+        EDIT_CONFLICT, whose *details* hold the unit's current content.
 
         :event: :ref:`dreq_edit_unit-label`
-        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *chat_meta* (:ref:`dres_chat_meta-label`) 
-        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, BAD_EDIT_TRY
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *chat_meta* (:ref:`dres_chat_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`)
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID, BAD_UNIT_ID, BAD_EDIT_TRY, EDIT_CONFLICT
         """
         unit_id = request["unit_id"]
         pith = request["pith"]
@@ -630,7 +822,81 @@ class DiscussionNamespace(AsyncNamespace):
           discussion_id=discussion_id, 
           user_id=user_id, 
           unit_id=unit_id, 
-          pith=pith
+          pith=pith,
+          version=request.get("version")
+        )
+        return result
+
+    @_process_responses("batch", ret="batched", 
+      emits=["doc_meta", "chat_meta", "doc_delta", "batched_events"])
+    @_validate_request("batch")
+    @_check_user_session
+    async def on_batch(self, sid, request):
+        """
+        Run several operations, e.g. `select_unit` then `move_units`, in one
+        round trip. They run in order without other events in between, and
+        stop at the first error, which is reported in its result. A batched
+        `move_cursor` is held and broadcast like a single one.
+
+        :event: :ref:`dreq_batch-label`
+        :return: :ref:`dres_batched-label`
+        :emit: *doc_meta* (:ref:`dres_doc_meta-label`) AND *chat_meta* (:ref:`dres_chat_meta-label`) AND *doc_delta* (:ref:`dres_doc_delta-label`) AND *batched_events* (:ref:`dres_batched_events-label`)
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, BAD_USER_ID
+        """
+        operations = []
+        for o in request["operations"]:
+          event = o["event"]
+          try:
+            validate(instance=o["request"], schema=dreq.schema[event])
+          except ValidationError:
+            return Errors.BAD_REQUEST
+          properties = dreq.schema[event]["properties"]
+          operations.append({
+            "event": event,
+            "request": {k: v for k, v in o["request"].items() 
+              if k in properties and k != "background"}
+          })
+        session = await self.get_session(sid)
+        discussion_id = session["discussion_id"]
+        user_id = session["user_id"]
+
+        result = gm.discussion_manager.batch(
+          discussion_id=discussion_id,
+          user_id=user_id,
+          operations=operations,
+          sid=sid
+        )
+        # the emits of each operation are checked as if sent on their own
+        if not is_error(result):
+          for e in result[1][3]:
+            for name, r in e["shared"].items():
+              try:
+                validate(instance=r, schema=dres.schema[name])
+              except ValidationError:
+                logger.info("Emit response: {}\nEmit schema: {}".format(r, name))
+                return Errors.BAD_RESPONSE
+        return result
+
+    @_process_responses("export", ret="export", broadcast=False)
+    @_validate_request("export")
+    @_check_user_session
+    async def on_export(self, sid, request):
+        """
+        Export the document as Markdown, HTML or JSON. The file is written by
+        the worker, which then sends *exported* to this client only.
+
+        :event: :ref:`dreq_export-label`
+        :return: :ref:`dres_export-label`
+        :emit: *exported* (:ref:`dres_exported-label`), later and only to the sender
+        :errors: BAD_REQUEST, BAD_RESPONSE, BAD_DISCUSSION_ID, JOB_NOT_QUEUED
+        """
+        session = await self.get_session(sid)
+        discussion_id = session["discussion_id"]
+
+        result = await gm.discussion_manager.export(
+          discussion_id=discussion_id,
+          format=request["format"],
+          sid=sid
         )
         return result
 
@@ -638,10 +904,71 @@ class DiscussionNamespace(AsyncNamespace):
 
 sio.register_namespace(DiscussionNamespace('/discussion'))
 
-def main():
+async def start_cursor_flush(app):
+    sio.start_background_task(gm.cursor_manager.run, sio, '/discussion')
+
+async def persist_cursors(app):
+    gm.cursor_manager.persist()
+
+def track_managers():
+    """
+    NOTE: Gauges are per worker, like the other metrics. With APP_REUSE_PORT
+    a scrape reaches whichever worker the kernel picks, so each worker's
+    series only shows up now and then, told apart by its worker label.
+    """
+    mgr = sio.manager
+    metrics.gauge("cache_hits_total", lambda: gm.cache_manager.hits)
+    metrics.gauge("cache_misses_total", lambda: gm.cache_manager.misses)
+    metrics.gauge("cache_shared_hits_total", lambda: gm.cache_manager.shared_hits)
+    metrics.gauge("cache_bytes", lambda: gm.cache_manager.size)
+    metrics.gauge("stem_cache_hits_total", lambda: stem_cache_stats()["hits"])
+    metrics.gauge("stem_cache_misses_total", lambda: stem_cache_stats()["misses"])
+    metrics.gauge("archive_restores_total", lambda: gm.archive_manager.restores)
+    metrics.gauge("archive_restore_seconds_total", 
+      lambda: gm.archive_manager.restore_seconds)
+    metrics.gauge("archive_bytes", gm.archive_manager.stored_bytes)
+    metrics.gauge("admitted_total", lambda: gm.admission_manager.admitted)
+    metrics.gauge("overloaded_total", lambda: gm.admission_manager.rejected)
+    metrics.gauge("admission_waiting", lambda: gm.admission_manager.waiting)
+    metrics.gauge("event_log_appended_total", lambda: gm.event_log_manager.appended)
+    metrics.gauge("resyncs_total", lambda: gm.event_log_manager.resyncs)
+    metrics.gauge("full_resyncs_total", lambda: gm.event_log_manager.full_resyncs)
+    metrics.gauge("local_emits_total", lambda: mgr.local_emits)
+    metrics.gauge("published_emits_total", lambda: mgr.published_emits)
+    metrics.gauge("connected_clients", 
+      lambda: len(mgr.rooms.get('/discussion', {}).get(None, {})))
+
+def serve(index=0):
+    """
+    Run one worker. Workers share the port with SO_REUSEPORT, or
+    otherwise each listens on its own port after PORT.
+    """
+    if constants.APP_UVLOOP:
+      try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+      except ImportError:
+        logger.info("uvloop is not installed, using asyncio loop\n")
+    metrics.set_labels(worker=index, pid=os.getpid())
+
     gm.start()
+    track_managers()
     aio_app = gm.aio_app
-    web.run_app(aio_app, port=constants.PORT)
+    aio_app.router.add_get('/metrics', metrics.handle)
+    os.makedirs(constants.EXPORT_DIR, exist_ok=True)
+    aio_app.router.add_static(constants.EXPORT_URL, constants.EXPORT_DIR)
+    aio_app.on_startup.append(start_cursor_flush)
+    aio_app.on_shutdown.append(persist_cursors)
+    if constants.APP_REUSE_PORT:
+      web.run_app(aio_app, port=int(constants.PORT), reuse_port=True)
+    else:
+      web.run_app(aio_app, port=int(constants.PORT) + index)
+
+def main():
+    if constants.APP_WORKERS > 1:
+      supervise(serve, constants.APP_WORKERS, overlap=constants.APP_REUSE_PORT)
+    else:
+      serve()
  
 if __name__ == '__main__':
     main()
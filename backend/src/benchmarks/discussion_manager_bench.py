@@ -0,0 +1,242 @@
+"""
+Micro-benchmarks of DiscussionManager service methods on large discussions.
+
+Seeds a discussion of the given shape straight into Mongo, then times each
+method and counts the Mongo commands it sends. Results are written as JSON
+(with the commit they were taken at) so runs can be compared.
+
+    python3.8 -m benchmarks.discussion_manager_bench --units 10000 \
+      --depth 50 --fanout 500 --chat 5000 --citations 3 --out bench.json
+"""
+
+import argparse
+from collections import Counter
+from json import dumps
+import random
+import subprocess
+import time
+
+import numpy as np
+from pymongo import monitoring
+
+from managers.global_manager import GlobalManager
+from models.discussion import (
+  Discussion,
+  Unit,
+)
+
+
+WORDS = ("river bank money flow current account deposit bridge stone water "
+  "tree leaf branch root ledger balance").split()
+
+
+class CommandCounter(monitoring.CommandListener):
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def started(self, event):
+        self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def sentence(n=8):
+    return " ".join(random.choice(WORDS) for _ in range(n))
+
+
+def seed(gm, units, depth, fanout, chat, citations):
+    """
+    Tree of `units` units under the root: a chain `depth` deep, the rest
+    filled breadth first with at most `fanout` children each. Each unit
+    cites up to `citations` earlier units.
+    Returns the discussion id and notable unit ids.
+    """
+    discussion_id = gm.board_manager.create()["discussion_id"]
+    root = Discussion.objects.get(id=discussion_id).document
+
+    docs = {}
+    order = [root]
+    children = {root: []}
+
+    def make(parent, in_chat=False):
+        unit = Unit(pith=sentence(), discussion=discussion_id,
+          parent=parent, in_chat=in_chat)
+        unit.original_pith = unit.pith
+        docs[unit.id] = unit
+        return unit.id
+
+    parent = root
+    for _ in range(min(depth, units)):
+        unit_id = make(parent)
+        children[parent].append(unit_id)
+        children[unit_id] = []
+        order.append(unit_id)
+        parent = unit_id
+    deepest = parent
+
+    queue = list(order)
+    while len(docs) < units:
+        parent = queue[0]
+        if len(children[parent]) >= fanout:
+          queue.pop(0)
+          continue
+        unit_id = make(parent)
+        children[parent].append(unit_id)
+        children[unit_id] = []
+        order.append(unit_id)
+        queue.append(unit_id)
+
+    chat_ids = [make("", in_chat=True) for _ in range(chat)]
+
+    ids = list(docs.keys())
+    for i, unit_id in enumerate(ids[1:], 1):
+        cited = random.sample(ids[:i], min(citations, i))
+        unit = docs[unit_id]
+        unit.pith = unit.pith + "".join("<cite>{}</cite>".format(c) for c in cited)
+        unit.forward_links = cited
+        for c in cited:
+          docs[c].backward_links.append(unit_id)
+
+    for unit_id, unit_children in children.items():
+        if unit_id in docs:
+          docs[unit_id].children = unit_children
+
+    Unit.objects.insert(list(docs.values()), load_bulk=False)
+    Unit.objects(id=root).update(set__children=children[root])
+    Discussion.objects(id=discussion_id).update(set__chat=chat_ids)
+
+    widest = max(children, key=lambda u: len(children[u]))
+    leaves = [u for u in order if len(children[u]) == 0]
+    return discussion_id, {
+      "root": root,
+      "deepest": deepest,
+      "widest": widest,
+      "leaves": leaves,
+    }
+
+
+def bench(gm, counter, args):
+    dm = gm.discussion_manager
+    discussion_id, units = seed(gm, args.units, args.depth, args.fanout,
+      args.chat, args.citations)
+    user_id = dm.create_user(discussion_id=discussion_id,
+      nickname="bench")[0]["user_id"]
+    dm.join(discussion_id=discussion_id, user_id=user_id)
+    base = {"discussion_id": discussion_id}
+    user = dict(base, user_id=user_id)
+
+    def edit_unit():
+        unit_id = random.choice(units["leaves"])
+        dm.request_to_edit(unit_id=unit_id, **user)
+        return lambda: dm.edit_unit(unit_id=unit_id, pith=sentence(), **user), \
+          lambda: dm.deedit_unit(unit_id=unit_id, **user)
+
+    def move_units():
+        unit_id = random.choice(units["leaves"])
+        dm.select_unit(unit_id=unit_id, **user)
+        return lambda: dm.move_units(units=[unit_id], parent=units["widest"],
+            position=0, **user), \
+          lambda: dm._release_position(unit_id=unit_id, **user)
+
+    def hide_unit():
+        unit_id = random.choice(units["leaves"])
+        return lambda: dm.hide_unit(unit_id=unit_id, **base), \
+          lambda: dm.unhide_unit(unit_id=unit_id, **base)
+
+    # name -> setup returning (timed call, cleanup)
+    cases = {
+      "load_user": lambda: (lambda: dm.load_user(**user), None),
+      "load_unit_page": lambda: (lambda: dm.load_unit_page(
+        unit_id=units["widest"], **user), None),
+      "get_ancestors": lambda: (lambda: dm.get_ancestors(
+        unit_id=units["deepest"], **base), None),
+      "hide_unit": hide_unit,
+      "move_units": move_units,
+      "search": lambda: (lambda: dm.search(query=random.choice(WORDS), **base), None),
+      "edit_unit": edit_unit,
+    }
+
+    results = {}
+    for name, setup in cases.items():
+        if args.methods and name not in args.methods:
+          continue
+        times = []
+        commands = Counter()
+        for _ in range(args.repeat):
+          call, cleanup = setup()
+          if args.cold:
+            gm.cache_manager.entries.clear()
+            gm.cache_manager.size = 0
+          counter.counts.clear()
+          start = time.perf_counter()
+          call()
+          times.append(time.perf_counter() - start)
+          commands.update(counter.counts)
+          if cleanup is not None:
+            cleanup()
+        ms = np.array(times) * 1000
+        results[name] = {
+          "mean_ms": float(ms.mean()),
+          "p50_ms": float(np.percentile(ms, 50)),
+          "p95_ms": float(np.percentile(ms, 95)),
+          "min_ms": float(ms.min()),
+          "mongo_commands": sum(commands.values()) / args.repeat,
+          "mongo_by_command": {k: v / args.repeat for k, v in commands.items()},
+        }
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DiscussionManager benchmarks.")
+    parser.add_argument("--units", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=50)
+    parser.add_argument("--fanout", type=int, default=500)
+    parser.add_argument("--chat", type=int, default=5000)
+    parser.add_argument("--citations", type=int, default=3,
+      help="units cited by each unit")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--cold", action="store_true",
+      help="empty the unit cache before each call")
+    parser.add_argument("--methods", nargs="*", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="write results as JSON")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # must be registered before the client connects
+    counter = CommandCounter()
+    monitoring.register(counter)
+    gm = GlobalManager()
+    gm.start()
+
+    results = bench(gm, counter, args)
+    output = {
+      "commit": commit(),
+      "shape": {k: getattr(args, k) for k in
+        ["units", "depth", "fanout", "chat", "citations", "repeat", "cold"]},
+      "results": results,
+    }
+    print("{:<16} {:>9} {:>9} {:>9} {:>8}".format(
+      "method", "mean ms", "p50 ms", "p95 ms", "mongo"))
+    for name, r in results.items():
+      print("{:<16} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.1f}".format(
+        name, r["mean_ms"], r["p50_ms"], r["p95_ms"], r["mongo_commands"]))
+    if args.out is not None:
+      with open(args.out, "w") as f:
+        f.write(dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Load generator for the socket.io interface.
+
+Creates N discussions through `create`, joins M users to each and has them
+post, move cursors, load pages, edit, move units and search with think time
+in between. Reports p50/p95/p99 latency per event and how long posts take
+to reach the other members of the discussion.
+
+    python3.8 -m benchmarks.load_test --url http://localhost:8080 \
+      --discussions 5 --users 20 --duration 60
+"""
+
+import argparse
+import asyncio
+from json import dumps, loads
+import random
+import time
+import uuid
+
+import numpy as np
+import socketio
+from socketio.exceptions import TimeoutError as CallTimeout
+
+
+NAMESPACE = "/discussion"
+
+# relative frequency of each action a user takes
+DEFAULT_MIX = {
+  "post": 20,
+  "move_cursor": 40,
+  "load_unit_page": 15,
+  "edit_unit": 10,
+  "move_units": 5,
+  "search": 10,
+}
+
+WORDS = ("river bank money flow current account deposit bridge stone water "
+  "tree leaf branch root ledger balance").split()
+
+
+class Stats:
+
+    def __init__(self):
+        # event -> latencies in seconds
+        self.latencies = {}
+        self.errors = {}
+        # post token -> send time
+        self.sent = {}
+        self.lags = []
+
+    def record(self, event, seconds, error=False):
+        self.latencies.setdefault(event, []).append(seconds)
+        if error:
+          self.errors[event] = self.errors.get(event, 0) + 1
+
+    def report(self, elapsed):
+        rows = []
+        for event, values in sorted(self.latencies.items()):
+          rows.append(self._row(event, values, self.errors.get(event, 0), elapsed))
+        if len(self.lags) > 0:
+          rows.append(self._row("post broadcast", self.lags, 0, elapsed))
+        return rows
+
+    def _row(self, name, values, errors, elapsed):
+        ms = np.array(values) * 1000
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        return {
+          "event": name,
+          "count": len(values),
+          "errors": errors,
+          "rate": len(values) / elapsed,
+          "p50": p50,
+          "p95": p95,
+          "p99": p99,
+        }
+
+
+def sentence(n=6):
+    return " ".join(random.choice(WORDS) for _ in range(n))
+
+
+class User:
+
+    def __init__(self, url, discussion_id, stats, think):
+        self.url = url
+        self.discussion_id = discussion_id
+        self.stats = stats
+        self.think = think
+        self.client = socketio.AsyncClient(reconnection=False)
+        self.root = None
+        self.units = [] # doc units added by this user
+
+        self.client.on("post", self._on_post, namespace=NAMESPACE)
+
+    async def _on_post(self, data):
+        now = time.monotonic()
+        shared = loads(data)
+        for c in shared.get("chat_meta", []):
+          for token in c["pith"].split():
+            if token in self.stats.sent:
+              self.stats.lags.append(now - self.stats.sent[token])
+
+    async def call(self, event, request):
+        start = time.monotonic()
+        try:
+          raw = await self.client.call(event, request,
+            namespace=NAMESPACE, timeout=30)
+          # handlers that raise acknowledge with nothing
+          res = loads(raw) if raw is not None else {"error": None}
+          error = "error" in res
+        except CallTimeout:
+          res, error = {}, True
+        self.stats.record(event, time.monotonic() - start, error)
+        return None if error else res
+
+    async def start(self):
+        await self.client.connect(
+          "{}?discussion_id={}".format(self.url, self.discussion_id),
+          namespaces=[NAMESPACE], transports=["websocket"]
+        )
+        await self.call("test_connect", {"discussion_id": self.discussion_id})
+        created = await self.call("create_user", {
+          "discussion_id": self.discussion_id,
+          "nickname": uuid.uuid4().hex[:12],
+        })
+        joined = await self.call("join", {
+          "discussion_id": self.discussion_id,
+          "user_id": created["user_id"]
+        })
+        self.root = joined["current_unit"]
+        for _ in range(3):
+          await self.add_unit()
+
+    async def stop(self):
+        await self.client.disconnect()
+
+    async def add_unit(self):
+        res = await self.call("add_unit", {
+          "pith": sentence(), "parent": self.root, "position": 0
+        })
+        if res is not None:
+          self.units.append(res["shared"]["added_unit"]["unit_id"])
+
+    """
+    Actions.
+    """
+
+    async def post(self):
+        token = "lt{}".format(uuid.uuid4().hex)
+        self.stats.sent[token] = time.monotonic()
+        await self.call("post", {"pith": "{} {}".format(sentence(), token)})
+
+    async def move_cursor(self):
+        await self.call("move_cursor", {"unit_id": self.root, "position": 0})
+
+    async def load_unit_page(self):
+        await self.call("load_unit_page", {"unit_id": self.root})
+
+    async def edit_unit(self):
+        if len(self.units) == 0:
+          return await self.add_unit()
+        unit_id = random.choice(self.units)
+        if await self.call("request_to_edit", {"unit_id": unit_id}) is None:
+          return
+        await self.call("edit_unit", {"unit_id": unit_id, "pith": sentence()})
+        await self.call("deedit_unit", {"unit_id": unit_id})
+
+    async def move_units(self):
+        if len(self.units) == 0:
+          return await self.add_unit()
+        unit_id = random.choice(self.units)
+        if await self.call("select_unit", {"unit_id": unit_id}) is None:
+          return
+        await self.call("move_units", {
+          "units": [unit_id], "parent": self.root, "position": 0
+        })
+        await self.call("deselect_unit", {"unit_id": unit_id})
+
+    async def search(self):
+        await self.call("search", {"query": random.choice(WORDS)})
+
+    async def run(self, mix, deadline):
+        actions = list(mix.keys())
+        weights = list(mix.values())
+        while time.monotonic() < deadline:
+          action = random.choices(actions, weights)[0]
+          await getattr(self, action)()
+          await asyncio.sleep(random.expovariate(1 / self.think))
+
+
+async def create_discussion(url):
+    client = socketio.AsyncClient(reconnection=False)
+    await client.connect(url, transports=["websocket"])
+    res = loads(await client.call("create", {}))
+    await client.disconnect()
+    return res["discussion_id"]
+
+
+async def run(args):
+    mix = dict(DEFAULT_MIX, **loads(args.mix)) if args.mix else DEFAULT_MIX
+    stats = Stats()
+
+    discussions = [await create_discussion(args.url) for _ in range(args.discussions)]
+    users = [User(args.url, d, stats, args.think) \
+      for d in discussions for _ in range(args.users)]
+    for i in range(0, len(users), args.ramp):
+      await asyncio.gather(*[u.start() for u in users[i:i + args.ramp]])
+    stats.latencies.clear()
+    stats.errors.clear()
+
+    start = time.monotonic()
+    await asyncio.gather(*[u.run(mix, start + args.duration) for u in users])
+    elapsed = time.monotonic() - start
+    await asyncio.gather(*[u.stop() for u in users])
+    return stats.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket.io load test for pith.")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--discussions", type=int, default=2)
+    parser.add_argument("--users", type=int, default=10,
+      help="users per discussion")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--think", type=float, default=1.0,
+      help="mean seconds between actions of a user")
+    parser.add_argument("--ramp", type=int, default=20,
+      help="users connected at once")
+    parser.add_argument("--mix", default=None,
+      help="JSON weights overriding the default action mix")
+    parser.add_argument("--out", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    rows = asyncio.get_event_loop().run_until_complete(run(args))
+    print("{:<16} {:>8} {:>7} {:>8} {:>9} {:>9} {:>9}".format(
+      "event", "count", "errors", "rate/s", "p50 ms", "p95 ms", "p99 ms"))
+    for r in rows:
+      print("{event:<16} {count:>8} {errors:>7} {rate:>8.1f} {p50:>9.1f} "
+        "{p95:>9.1f} {p99:>9.1f}".format(**r))
+    if args.out is not None:
+      with open(args.out, "w") as f:
+        f.write(dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Benchmark of search scoring on a large synthetic discussion.
+
+Compares the vectorized `DiscussionIndex.search` against scoring every unit
+in a Python loop, as `basic_search` does, and against BM25 accumulated over
+the postings dicts one unit at a time. Needs no database.
+
+    python3.8 -m benchmarks.search_bench --units 100000 --limit 20
+"""
+
+import argparse
+from datetime import datetime, timedelta
+from json import dumps
+import math
+import random
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from search.search import (
+  B,
+  basic_search,
+  DiscussionIndex,
+  K1,
+  pos_weights,
+)
+from utils import utils
+
+
+def vocabulary(size):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < size:
+      words.add("".join(random.choice(letters) for _ in range(random.randint(3, 9))))
+    return sorted(words)
+
+
+def make_units(count, words, length):
+    # word frequencies roughly follow Zipf's law
+    weights = [1 / (i + 1) for i in range(len(words))]
+    start = datetime(2020, 1, 1)
+    units = []
+    for i in range(count):
+      pith = " ".join(random.choices(words, weights, k=length))
+      units.append(SimpleNamespace(
+        id=str(i),
+        pith=pith,
+        created_at=start + timedelta(seconds=i),
+        freq_dict=utils.make_freq_dict(pith)
+      ))
+    return units
+
+
+def loop_bm25(index, query, limit):
+    """
+    BM25 over the postings dicts, one unit at a time.
+    """
+    terms = [t for t in set(utils.text_tokens(query)) if t in index.postings]
+    if len(terms) == 0:
+      return []
+    weights = pos_weights(terms)
+    n = len(index.units)
+    avg_length = index.total_length / n
+    scores = {}
+    for term in terms:
+      posting = index.postings[term]
+      idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+      for unit_id, freq in posting.items():
+        length = index.units[unit_id][1]
+        norm = K1 * (1 - B + B * length / avg_length)
+        scores[unit_id] = scores.get(unit_id, 0.0) + \
+          weights[term] * idf * freq * (K1 + 1) / (freq + norm)
+    ranked = sorted(scores.items(),
+      key=lambda s: (s[1], index.units[s[0]][2]), reverse=True)
+    return [unit_id for unit_id, _ in ranked[:limit]]
+
+
+def timed(call, queries):
+    times = []
+    for query in queries:
+      start = time.perf_counter()
+      call(query)
+      times.append(time.perf_counter() - start)
+    ms = np.array(times) * 1000
+    return {
+      "mean_ms": float(ms.mean()),
+      "p50_ms": float(np.percentile(ms, 50)),
+      "p95_ms": float(np.percentile(ms, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search scoring benchmark.")
+    parser.add_argument("--units", type=int, default=100000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--length", type=int, default=12, help="words per unit")
+    parser.add_argument("--terms", type=int, default=3, help="words per query")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="write results as JSON")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    words = vocabulary(args.vocabulary)
+    units = make_units(args.units, words, args.length)
+    start = time.perf_counter()
+    index = DiscussionIndex()
+    for u in units:
+      index.add(u.id, u.pith, u.created_at)
+    build_s = time.perf_counter() - start
+
+    # common words, so queries match many units
+    queries = [" ".join(random.sample(words[:200], args.terms))
+      for _ in range(args.queries)]
+    for query in queries[:5]:
+      assert index.search(query, args.limit) == loop_bm25(index, query, args.limit)
+
+    results = {
+      "index.search": timed(lambda q: index.search(q, args.limit), queries),
+      "loop bm25": timed(lambda q: loop_bm25(index, q, args.limit), queries),
+      "basic_search": timed(lambda q: basic_search(q, units)[:args.limit], queries),
+    }
+    print("built index of {} units in {:.1f} s".format(args.units, build_s))
+    print("{:<14} {:>9} {:>9} {:>9}".format("scorer", "mean ms", "p50 ms", "p95 ms"))
+    for name, r in results.items():
+      print("{:<14} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+        name, r["mean_ms"], r["p50_ms"], r["p95_ms"]))
+    if args.out is not None:
+      with open(args.out, "w") as f:
+        f.write(dumps({"args": vars(args), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,13 @@ load_dotenv()
 
 # the port to run the socketio server 
 PORT = os.getenv("PORT", 8080)
+# the number of app processes to run; workers after the first listen on PORT + i
+APP_WORKERS = int(os.getenv("APP_WORKERS", 1))
+# share PORT between workers with SO_REUSEPORT (Linux). The kernel spreads
+# connections, not sessions, so clients must use the websocket transport only
+APP_REUSE_PORT = os.getenv("APP_REUSE_PORT", "0") == "1"
+# run workers on uvloop (if installed) instead of the asyncio loop
+APP_UVLOOP = os.getenv("APP_UVLOOP", "0") == "1"
 
 # connect to the redis server instance. When running locally, use 127.0.0.1, or
 # use the container name if using docker within a docker network
@@ -25,6 +32,125 @@ MAX_QUEUED_JOB_RETRIES = 5
 # the maximum number of jobs we should try to run at once from the queue
 MAX_JOBS = 10
 
+# where exported documents are written, standing in for the S3 bucket. The app
+# serves them under EXPORT_URL, so the app and worker must share the directory
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_URL = "/exports"
+# the number of piths fetched at once while exporting
+EXPORT_BATCH_SIZE = 1000
+
+# where discussions without activity are archived; shared like EXPORT_DIR
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archives")
+# the number of days without activity after which a discussion is archived
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 30))
+# the hour (UTC) at which the worker looks for discussions to archive
+ARCHIVE_HOUR = int(os.getenv("ARCHIVE_HOUR", 4))
+# the number of units written at once while restoring
+ARCHIVE_BATCH_SIZE = 1000
+# how long (in seconds) to wait for a discussion another instance is restoring
+ARCHIVE_RESTORE_WAIT = 10
+# how often (in seconds) the size of the archives is read again, as the
+# worker archives without telling the app
+ARCHIVE_BYTES_REFRESH = 300
+
+# how often (in minutes, dividing 60) the worker rolls up timelines into stats
+STATS_ROLLUP_MINUTES = int(os.getenv("STATS_ROLLUP_MINUTES", 10))
+
+# at most this many joins and new users are handled at once in one discussion,
+# and across every discussion on an instance
+ADMISSION_PER_DISCUSSION = int(os.getenv("ADMISSION_PER_DISCUSSION", 4))
+ADMISSION_PER_INSTANCE = int(os.getenv("ADMISSION_PER_INSTANCE", 16))
+# the number that may wait in one discussion before more are turned away
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 64))
+# how long (in seconds) one may wait before being turned away
+ADMISSION_WAIT = float(os.getenv("ADMISSION_WAIT", 5))
+
+# redis keys of the per-discussion event logs clients resync from
+EVENT_LOG_PREFIX = "pith:events"
+# the number of events kept per discussion, roughly
+EVENT_LOG_MAX = int(os.getenv("EVENT_LOG_MAX", 1000))
+# past this many missed events, a resync is answered with a full join instead
+EVENT_LOG_MAX_RESYNC = int(os.getenv("EVENT_LOG_MAX_RESYNC", 200))
+# how long (in seconds) the log of a quiet discussion is kept
+EVENT_LOG_TTL = int(os.getenv("EVENT_LOG_TTL", 24 * 60 * 60))
+
+# token buckets limiting each connection: event class -> (events per second, burst)
+RATE_LIMITS = {
+  "session": (2, 5),
+  "read": (20, 40),
+  "search": (10, 20),
+  "write": (10, 30),
+  "cursor": (30, 60),
+  "export": (0.2, 2),
+}
+# the class of each limited event; a batch costs one per operation
+RATE_LIMIT_CLASSES = {
+  "test_connect": "session",
+  "create_user": "session",
+  "join": "session",
+  "resync": "session",
+  "load_unit_page": "read",
+  "get_ancestors": "read",
+  "get_unit_content": "read",
+  "get_doc_meta": "read",
+  "get_unit_context": "read",
+  "get_discussion_stats": "read",
+  "search": "search",
+  "typeahead": "search",
+  "post": "write",
+  "send_to_doc": "write",
+  "hide_unit": "write",
+  "unhide_unit": "write",
+  "add_unit": "write",
+  "select_unit": "write",
+  "deselect_unit": "write",
+  "move_units": "write",
+  "merge_units": "write",
+  "request_to_edit": "write",
+  "deedit_unit": "write",
+  "edit_unit": "write",
+  "batch": "write",
+  "move_cursor": "cursor",
+  "export": "export",
+}
+
+# the rate (in Hz) at which held cursor movements are broadcast to a discussion
+CURSOR_BROADCAST_RATE = float(os.getenv("CURSOR_BROADCAST_RATE", 10))
+# how often (in seconds) held cursor movements are written back to the database
+CURSOR_PERSIST_INTERVAL = float(os.getenv("CURSOR_PERSIST_INTERVAL", 5))
+
+# the memory (in bytes) each instance may use to cache hot units; 0 disables it
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# rough per-entry and per-unit-id overheads used to size the cache
+CACHE_ENTRY_BYTES = 1024
+CACHE_ID_BYTES = 80
+# redis channel on which instances tell each other to drop cached entries
+CACHE_CHANNEL = "pith:cache"
+# how long (in seconds) units shared between instances stay in redis
+CACHE_SHARED_TTL = int(os.getenv("CACHE_SHARED_TTL", 60 * 60))
+# how long a dropped entry keeps older copies of it from being put back
+CACHE_TOMBSTONE_SECONDS = int(os.getenv("CACHE_TOMBSTONE_SECONDS", 10))
+
+# the number of discussions each instance keeps a search index for
+SEARCH_MAX_DISCUSSIONS = int(os.getenv("SEARCH_MAX_DISCUSSIONS", 100))
+# search results per page unless the request asks for another limit
+SEARCH_DEFAULT_LIMIT = 20
+# ranked past the page, as hidden units are left out of it
+SEARCH_OVERFETCH = 10
+TYPEAHEAD_DEFAULT_LIMIT = 8
+# past this many units changed elsewhere, indexes are rebuilt instead of updated
+SEARCH_MAX_DIRTY = 1000
+# the number of distinct words whose stems are remembered
+STEM_CACHE_SIZE = int(os.getenv("STEM_CACHE_SIZE", 100000))
+
+# redis hashes of the instances with members in a room, each with the time 
+# it last said so; instances that stop saying so are left out
+ROOM_HOSTS_PREFIX = "pith:rooms"
+ROOM_HOSTS_HEARTBEAT = int(os.getenv("ROOM_HOSTS_HEARTBEAT", 10))
+ROOM_HOSTS_TTL = int(os.getenv("ROOM_HOSTS_TTL", 30))
+# how long the hosts of a room are used before they are read again
+ROOM_HOSTS_REFRESH = int(os.getenv("ROOM_HOSTS_REFRESH", 10))
+
 # using ISO so this can be easily parsed in js with Date()
 DATE_TIME_FMT = "%Y-%m-%dT%H:%M:%S.000Z"
 MONGODB_CONN = os.getenv("MONGODB_CONN", "mongodb://localhost:27017")
@@ -76,3 +76,24 @@ class Errors(enum.Enum):
   """
   A document unit cannot reference a chat unit.
   """
+
+  OVERLOADED = -16
+  """
+  Too many requests are waiting to be handled; try again later.
+  """
+
+  RATE_LIMITED = -17
+  """
+  Too many events of this kind were sent; slow down.
+  """
+
+  EDIT_CONFLICT = -18
+  """
+  Unit changed or was locked since the given version; its current content is
+  in the error's details.
+  """
+
+  JOB_NOT_QUEUED = -19
+  """
+  Work for the worker could not be queued; try again later.
+  """
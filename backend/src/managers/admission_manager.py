@@ -0,0 +1,105 @@
+"""
+Admission control for expensive events, like a storm of joins to one
+discussion.
+
+At most a few are let in at a time per discussion and per instance. The rest 
+wait in line until a deadline, and past the deadline, or once the line of a 
+discussion is full, they are turned away as overloaded.
+
+Admitted events run on the event loop like every other event, so nothing 
+runs in the middle of a batch and managers need no locks. Only restoring an 
+archived discussion, which touches nothing but mongo and the archive, runs 
+on a thread pool so the loop keeps serving other events.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import constants
+from error import Errors
+
+
+class AdmissionManager:
+
+    def __init__(self, gm):
+        self.gm = gm
+        self.executor = ThreadPoolExecutor(
+          max_workers=constants.ADMISSION_PER_INSTANCE,
+          thread_name_prefix="restore"
+        )
+        # made on first use, so they belong to the running loop
+        self.semaphore = None
+        # discussion id -> {"semaphore", "waiting", "holders"}
+        self.rooms = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.waiting = 0
+
+    def _room(self, discussion_id):
+        room = self.rooms.get(discussion_id)
+        if room is None:
+          room = {
+            "semaphore": asyncio.Semaphore(constants.ADMISSION_PER_DISCUSSION),
+            "waiting": 0,
+            "holders": 0,
+          }
+          self.rooms[discussion_id] = room
+        return room
+
+    async def _acquire(self, semaphore, deadline):
+        if not semaphore.locked():
+          await semaphore.acquire() # does not wait
+          return True
+        try:
+          await asyncio.wait_for(semaphore.acquire(),
+            max(deadline - time.monotonic(), 0))
+          return True
+        except asyncio.TimeoutError:
+          return False
+
+    async def run(self, func, **kwargs):
+        """
+        Call `func(**kwargs)` once admitted to the discussion of 
+        `kwargs["discussion_id"]`, after restoring the discussion if it was 
+        archived. Returns what it does, or OVERLOADED if not admitted in time.
+        """
+        discussion_id = kwargs["discussion_id"]
+        if self.semaphore is None:
+          self.semaphore = asyncio.Semaphore(constants.ADMISSION_PER_INSTANCE)
+        room = self._room(discussion_id)
+        if room["waiting"] >= constants.ADMISSION_MAX_QUEUE:
+          self.rejected += 1
+          return Errors.OVERLOADED
+
+        deadline = time.monotonic() + constants.ADMISSION_WAIT
+        acquired = []
+        room["holders"] += 1
+        room["waiting"] += 1
+        self.waiting += 1
+        try:
+          # the discussion first, so one busy discussion holds few of the
+          # instance's places
+          for semaphore in [room["semaphore"], self.semaphore]:
+            if not await self._acquire(semaphore, deadline):
+              break
+            acquired.append(semaphore)
+        finally:
+          room["waiting"] -= 1
+          self.waiting -= 1
+
+        try:
+          if len(acquired) < 2:
+            self.rejected += 1
+            return Errors.OVERLOADED
+          self.admitted += 1
+          loop = asyncio.get_event_loop()
+          await loop.run_in_executor(self.executor, 
+            self.gm.archive_manager.restore, discussion_id)
+          return func(**kwargs)
+        finally:
+          for semaphore in acquired:
+            semaphore.release()
+          room["holders"] -= 1
+          if room["holders"] == 0:
+            del self.rooms[discussion_id]
@@ -0,0 +1,206 @@
+"""
+Discussions nobody has touched for a while are moved out of mongo into
+gzipped archives, one per discussion, and moved back the next time someone
+connects to them.
+
+An archive holds the discussion document (with its users and their
+timelines) on its first line and one unit per line after it, in extended
+JSON so dates survive.
+"""
+
+from datetime import datetime, timedelta
+import gzip
+import os
+import threading
+import time
+import uuid
+
+from bson import json_util
+
+import constants
+from utils.utils import logger
+
+from models.discussion import (
+  Discussion,
+  Unit,
+)
+
+
+class ArchiveManager:
+
+    def __init__(self, gm):
+        self.gm = gm
+        self.restores = 0
+        self.restore_seconds = 0.0
+        self.archived = 0
+        self.archived_bytes = 0
+        # discussion id -> set once this instance has restored it
+        self.restoring = {}
+        # size of the archive directory as last read, kept up to date with
+        # what this process archives and restores
+        self.stored = None
+        self.stored_at = 0.0
+
+    def _path(self, discussion_id):
+        return os.path.join(constants.ARCHIVE_DIR, "{}.jsonl.gz".format(discussion_id))
+
+    def is_archived(self, discussion_id):
+        return os.path.exists(self._path(discussion_id))
+
+    def stored_bytes(self):
+        """
+        Size of all archives in bytes. The directory is only read again
+        every `ARCHIVE_BYTES_REFRESH` seconds, to see the worker's archives.
+        """
+        if self.stored is None or \
+          time.monotonic() - self.stored_at > constants.ARCHIVE_BYTES_REFRESH:
+          try:
+            self.stored = sum(e.stat().st_size for e in os.scandir(constants.ARCHIVE_DIR))
+          except FileNotFoundError:
+            self.stored = 0
+          self.stored_at = time.monotonic()
+        return self.stored
+
+    def _add_stored(self, size):
+        if self.stored is not None:
+          self.stored = max(self.stored + size, 0)
+
+    """
+    Archiving.
+    """
+
+    def cold(self, days=constants.ARCHIVE_AFTER_DAYS):
+        """
+        Discussions with no activity for `days` days and nobody in them.
+        """
+        now = datetime.utcnow()
+        # discussions from before activity was recorded start counting now
+        Discussion.objects(last_active__exists=False).update(set__last_active=now)
+        discussions = Discussion.objects(
+          last_active__lt=now - timedelta(days=days),
+          users__active__ne=True
+        ).only("id")
+        return [d.id for d in discussions]
+
+    def archive(self, discussion_id):
+        """
+        Returns the size of the archive in bytes, or None if the discussion
+        was used while it was being archived and so was left in place.
+        """
+        discussion = Discussion.objects(id=discussion_id).as_pymongo().first()
+        if discussion is None:
+          return None
+        last_active = discussion.get("last_active")
+        path = self._path(discussion_id)
+        partial = "{}.{}.part".format(path, uuid.uuid4().hex)
+        os.makedirs(constants.ARCHIVE_DIR, exist_ok=True)
+
+        #### MONGO
+        unit_ids = []
+        with gzip.open(partial, "wt", encoding="utf-8") as f:
+          f.write(json_util.dumps(discussion) + "\n")
+          for unit in Unit.objects(discussion=discussion_id).as_pymongo():
+            f.write(json_util.dumps(unit) + "\n")
+            unit_ids.append(unit["_id"])
+
+        # only if nothing happened since it was read
+        removed = Discussion.objects(id=discussion_id,
+          last_active=last_active).delete()
+        if removed == 0:
+          os.remove(partial)
+          return None
+        Unit.objects(discussion=discussion_id).delete()
+        #### MONGO
+        # published last, so a restore can never run before the units are gone
+        os.replace(partial, path)
+
+        self.gm.cache_manager.drop_discussion(discussion_id)
+        self.gm.cache_manager.drop_units(unit_ids)
+        size = os.path.getsize(path)
+        self.archived += 1
+        self.archived_bytes += size
+        self._add_stored(size)
+        return size
+
+    def archive_cold(self, days=constants.ARCHIVE_AFTER_DAYS):
+        total = 0
+        for discussion_id in self.cold(days):
+          try:
+            size = self.archive(discussion_id)
+          except Exception as e:
+            logger.info("archive exception: {}\n".format(e))
+            continue
+          if size is not None:
+            total += size
+            logger.info("archived {} ({} bytes)\n".format(discussion_id, size))
+        return total
+
+    """
+    Restoring.
+    """
+
+    def restore(self, discussion_id):
+        """
+        Bring the discussion back if it is archived. Returns whether it was.
+        NOTE: Blocks, so call from a thread rather than the event loop.
+        """
+        path = self._path(discussion_id)
+        if not os.path.exists(path):
+          return False
+        start = time.monotonic()
+        claimed = "{}.{}.restoring".format(path, uuid.uuid4().hex)
+        try:
+          # only one caller, on any instance, gets to restore it
+          os.rename(path, claimed)
+        except FileNotFoundError:
+          return self._wait_restored(discussion_id)
+
+        done = threading.Event()
+        self.restoring[discussion_id] = done
+        try:
+          with gzip.open(claimed, "rt", encoding="utf-8") as f:
+            discussion = json_util.loads(f.readline())
+            #### MONGO
+            # left over if archiving stopped part way
+            Unit.objects(discussion=discussion_id).delete()
+            batch = []
+            for line in f:
+              batch.append(json_util.loads(line))
+              if len(batch) == constants.ARCHIVE_BATCH_SIZE:
+                Unit._get_collection().insert_many(batch)
+                batch = []
+            if len(batch) > 0:
+              Unit._get_collection().insert_many(batch)
+            # last, so the discussion is only found once complete
+            discussion["last_active"] = datetime.utcnow()
+            Discussion._get_collection().insert_one(discussion)
+            #### MONGO
+        except Exception:
+          os.rename(claimed, path) # try again next time
+          raise
+        finally:
+          # wake callers waiting here, whether or not it worked
+          self.restoring.pop(discussion_id, None)
+          done.set()
+        size = os.path.getsize(claimed)
+        os.remove(claimed)
+        self._add_stored(-size)
+
+        self.restores += 1
+        self.restore_seconds += time.monotonic() - start
+        return True
+
+    def _wait_restored(self, discussion_id):
+        """
+        Wait for whoever claimed the archive. A restore on this instance is
+        waited on, one on another instance is polled for.
+        """
+        deadline = time.monotonic() + constants.ARCHIVE_RESTORE_WAIT
+        done = self.restoring.get(discussion_id)
+        if done is not None:
+          done.wait(constants.ARCHIVE_RESTORE_WAIT)
+        while time.monotonic() < deadline:
+          if Discussion.objects(id=discussion_id).only("id").first() is not None:
+            return True
+          time.sleep(0.05)
+        return Discussion.objects(id=discussion_id).only("id").first() is not None
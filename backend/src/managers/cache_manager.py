@@ -0,0 +1,281 @@
+"""
+In-memory model of hot discussions, so reads of units do not go to the
+database. Writes go to the database first and the updated unit replaces the
+cached one; other instances are told to drop their copy over redis. Dropped
+entries leave a tombstone for a few seconds, so a read that started before
+the drop cannot put back what it read.
+
+Below the in-memory cache, units are shared between instances in redis,
+keyed by unit id and tagged with their version so an older copy never
+replaces a newer one.
+
+The parts of the join payload every user gets are kept too, tagged with the
+version of the discussion they were built from, so a storm of joins builds
+them once.
+"""
+
+from collections import OrderedDict
+from json import dumps, loads
+import sys
+import threading
+import time
+import uuid
+
+import redis
+
+import constants
+from utils.utils import logger
+
+from models.discussion import (
+  Discussion,
+  Unit,
+)
+
+
+# only replace the shared copy of a unit with a newer version
+SHARE_SCRIPT = """
+local version = redis.call("HGET", KEYS[1], "version")
+if version and tonumber(version) >= tonumber(ARGV[1]) then
+  return 0
+end
+redis.call("HMSET", KEYS[1], "version", ARGV[1], "doc", ARGV[2])
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class CacheManager:
+
+    def __init__(self, gm):
+        self.gm = gm
+        self.host_id = uuid.uuid4().hex
+        # (kind, id) -> (size, value, version), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # (kind, id) -> (version dropped, or None for any, when), oldest first
+        self.tombstones = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.lock = threading.Lock()
+        # called with unit ids other instances changed, from the redis thread
+        self.listeners = []
+
+        self.redis = redis.Redis.from_url(constants.SOCKET_REDIS)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(**{constants.CACHE_CHANNEL: self._on_invalidate})
+        self.thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+        self.share_script = self.redis.register_script(SHARE_SCRIPT)
+
+    def _sizeof(self, unit):
+        ids = len(unit.children) + len(unit.forward_links) + len(unit.backward_links)
+        return sys.getsizeof(unit.pith) + ids * constants.CACHE_ID_BYTES + \
+          constants.CACHE_ENTRY_BYTES
+
+    def _lookup(self, key):
+        with self.lock:
+          if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][1]
+          self.misses += 1
+          return None
+
+    def _put(self, key, value, size, version=None):
+        """
+        With a `version`, a cached entry is only replaced by a newer one, as 
+        in the shared cache, so a slow reader cannot put back an old copy.
+        Nothing older than a recent drop is put either.
+        """
+        if size > constants.CACHE_MAX_BYTES:
+          return
+        with self.lock:
+          self._bury()
+          if key in self.tombstones:
+            dropped = self.tombstones[key][0]
+            if dropped is None or version is None or version < dropped:
+              return
+          if key in self.entries:
+            cached = self.entries[key][2]
+            if version is not None and cached is not None and cached >= version:
+              return
+            self.size -= self.entries.pop(key)[0]
+          self.entries[key] = (size, value, version)
+          self.size += size
+          while self.size > constants.CACHE_MAX_BYTES:
+            _, (old_size, _, _) = self.entries.popitem(last=False)
+            self.size -= old_size
+
+    def _bury(self):
+        # NOTE: Requires the lock.
+        oldest = time.monotonic() - constants.CACHE_TOMBSTONE_SECONDS
+        while len(self.tombstones) > 0 and \
+          next(iter(self.tombstones.values()))[1] < oldest:
+          self.tombstones.popitem(last=False)
+
+    def _drop(self, key, version=None):
+        """
+        With a `version`, copies at least that new may still be put.
+        """
+        with self.lock:
+          if key in self.entries:
+            self.size -= self.entries.pop(key)[0]
+          self.tombstones.pop(key, None)
+          self.tombstones[key] = (version, time.monotonic())
+
+    def _on_invalidate(self, message):
+        try:
+          data = loads(message["data"])
+          if data["host_id"] == self.host_id:
+            return
+          for kind, id, version in data["keys"]:
+            self._drop((kind, id), version)
+          unit_ids = [id for kind, id, _ in data["keys"] if kind == "unit"]
+          for listener in self.listeners:
+            listener(unit_ids)
+        except Exception as e:
+          logger.info("cache invalidate exception: {}\n".format(e))
+
+    def _publish(self, keys):
+        """
+        `keys` are (kind, id, version or None) to drop.
+        """
+        data = dumps({"host_id": self.host_id, "keys": keys})
+        try:
+          self.redis.publish(constants.CACHE_CHANNEL, data)
+        except redis.RedisError as e:
+          logger.info("cache invalidate exception: {}\n".format(e))
+
+    def _shared_key(self, unit_id):
+        return "{}:unit:{}".format(constants.CACHE_CHANNEL, unit_id)
+
+    def _fetch_shared(self, unit_id):
+        try:
+          doc = self.redis.hget(self._shared_key(unit_id), "doc")
+        except redis.RedisError as e:
+          logger.info("shared cache exception: {}\n".format(e))
+          return None
+        if doc is None:
+          return None
+        self.shared_hits += 1
+        return Unit.from_json(doc)
+
+    def _share(self, unit):
+        try:
+          self.share_script(
+            keys=[self._shared_key(unit.id)],
+            args=[unit.version, unit.to_json(), constants.CACHE_SHARED_TTL]
+          )
+        except redis.RedisError as e:
+          logger.info("shared cache exception: {}\n".format(e))
+
+    """
+    Units.
+    """
+
+    def get_unit(self, unit_id):
+        """
+        NOTE: Raises DoesNotExist like `Unit.objects.get`.
+        Do not modify the returned unit.
+        """
+        unit = self._lookup(("unit", unit_id))
+        if unit is None:
+          unit = self._fetch_shared(unit_id)
+          if unit is None:
+            unit = Unit.objects.get(id=unit_id)
+            self._share(unit)
+          self._put(("unit", unit_id), unit, self._sizeof(unit), unit.version)
+        return unit
+
+    def get_units(self, unit_ids):
+        """
+        Units by ID, fetching those not in memory together. Missing units
+        are left out.
+        """
+        units = {}
+        missing = []
+        for unit_id in unit_ids:
+          unit = self._lookup(("unit", unit_id))
+          if unit is None:
+            missing.append(unit_id)
+          else:
+            units[unit_id] = unit
+
+        if len(missing) > 0:
+          try:
+            pipe = self.redis.pipeline()
+            for unit_id in missing:
+              pipe.hget(self._shared_key(unit_id), "doc")
+            docs = pipe.execute()
+          except redis.RedisError as e:
+            logger.info("shared cache exception: {}\n".format(e))
+            docs = [None] * len(missing)
+          fetched = []
+          for unit_id, doc in zip(missing, docs):
+            if doc is None:
+              fetched.append(unit_id)
+            else:
+              self.shared_hits += 1
+              units[unit_id] = Unit.from_json(doc)
+          for unit in Unit.objects(id__in=fetched):
+            self._share(unit)
+            units[unit.id] = unit
+          for unit_id in missing:
+            if unit_id in units:
+              unit = units[unit_id]
+              self._put(("unit", unit_id), unit, self._sizeof(unit), unit.version)
+        return units
+
+    def put_unit(self, unit):
+        """
+        Write-through after saving or modifying a unit.
+        """
+        self._put(("unit", unit.id), unit, self._sizeof(unit), unit.version)
+        self._share(unit)
+        self._publish([("unit", unit.id, unit.version)])
+
+    def drop_units(self, unit_ids):
+        for unit_id in unit_ids:
+          self._drop(("unit", unit_id))
+        if len(unit_ids) > 0:
+          try:
+            self.redis.delete(*[self._shared_key(u) for u in unit_ids])
+          except redis.RedisError as e:
+            logger.info("shared cache exception: {}\n".format(e))
+        self._publish([("unit", u, None) for u in unit_ids])
+
+    """
+    Discussions.
+    """
+
+    def has_discussion(self, discussion_id):
+        if self._lookup(("discussion", discussion_id)) is not None:
+          return True
+        exists = Discussion.objects(id=discussion_id).only("id").first() is not None
+        if exists:
+          self._put(("discussion", discussion_id), True, constants.CACHE_ENTRY_BYTES)
+        return exists
+
+    def drop_discussion(self, discussion_id):
+        self._drop(("discussion", discussion_id))
+        self._publish([("discussion", discussion_id, None)])
+
+    """
+    Join snapshots.
+    """
+
+    def get_snapshot(self, discussion_id, version):
+        """
+        The part of the join payload shared by every user, if it was built
+        at this version of the discussion. Do not modify it.
+        """
+        entry = self._lookup(("snapshot", discussion_id))
+        if entry is None or entry[0] != version:
+          return None
+        return entry[1]
+
+    def put_snapshot(self, discussion_id, version, snapshot):
+        size = constants.CACHE_ENTRY_BYTES + \
+          len(snapshot["chat_history"]) * constants.CACHE_ID_BYTES + \
+          sum(sys.getsizeof(m["pith"]) for m in snapshot["chat_meta"])
+        self._put(("snapshot", discussion_id), (version, snapshot), size, version)
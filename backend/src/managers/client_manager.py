@@ -0,0 +1,318 @@
+"""
+Socket.io client manager that knows where the members of each room are.
+
+Discussions are routed to instances by haproxy, so most rooms only have
+members on one instance. Each instance keeps in memory which instances have
+members in a room, so emits to a room with only local members skip redis.
+
+Instances say in redis which rooms they have members in, refreshed on a
+heartbeat so a crashed instance drops out, and tell the others over pub/sub
+when they gain or lose a room. The hosts of a room are read again in the
+background once they are a few seconds old.
+
+Emits to a room with remote members are delivered locally and published on
+the room's own channel, which only instances with members in the room
+subscribe to. Messages are encoded as JSON rather than pickled.
+"""
+
+import asyncio
+from json import dumps, loads
+import time
+
+import aioredis
+from aioredis.pubsub import Receiver
+import socketio
+
+import constants
+from utils.utils import logger
+
+
+class DiscussionClientManager(socketio.AsyncRedisManager):
+
+    def __init__(self, url, **kwargs):
+        super().__init__(url, **kwargs)
+        self.receiver = None
+        # room channels this instance has members for
+        self.room_channels = set()
+        # (namespace, room) this instance has members in
+        self.hosted = set()
+        # (namespace, room) -> {"hosts", "fetched"}, as last known
+        self.room_hosts = {}
+        # (namespace, room) -> {host id: present} announced while reading
+        self.refreshing = {}
+        # (namespace, room) -> last task changing this instance's membership
+        self.room_tasks = {}
+        self.local_emits = 0
+        self.published_emits = 0
+
+    def initialize(self):
+        super().initialize()
+        if not self.write_only:
+          self.server.start_background_task(self._heartbeat)
+
+    def _room_key(self, namespace, room):
+        return "{}:{}:{}".format(constants.ROOM_HOSTS_PREFIX, namespace, room)
+
+    def _room_channel(self, namespace, room):
+        return "{}:{}:{}".format(self.channel, namespace, room)
+
+    def _tracked(self, sid, room):
+        # every client has its own room, which never leaves its instance
+        return room is not None and room != sid
+
+    def _has_local(self, namespace, room):
+        return len(self.rooms.get(namespace, {}).get(room, {})) > 0
+
+    async def _connection(self):
+        if self.pub is None:
+          self.pub = await aioredis.create_redis(
+            (self.host, self.port), db=self.db,
+            password=self.password, ssl=self.ssl
+          )
+        return self.pub
+
+    """
+    Room hosts.
+    """
+
+    def _room_hosts(self, namespace, room):
+        """
+        The instances with members in the room as last known, or None if
+        not known yet. Read again in the background once old.
+        """
+        key = (namespace, room)
+        entry = self.room_hosts.get(key)
+        if (entry is None or time.monotonic() - entry["fetched"] > \
+          constants.ROOM_HOSTS_REFRESH) and key not in self.refreshing:
+          self.refreshing[key] = {}
+          asyncio.ensure_future(self._refresh(namespace, room))
+        if entry is None:
+          return None
+        hosts = set(entry["hosts"])
+        if key in self.hosted:
+          hosts.add(self.host_id)
+        return list(hosts)
+
+    async def _refresh(self, namespace, room):
+        key = (namespace, room)
+        self.refreshing.setdefault(key, {})
+        try:
+          conn = await self._connection()
+          beats = await conn.hgetall(self._room_key(namespace, room))
+        except (aioredis.RedisError, OSError) as e:
+          logger.info("room hosts exception: {}\n".format(e))
+          self.pub = None
+          self.refreshing.pop(key, None)
+          return
+        oldest = time.time() - constants.ROOM_HOSTS_TTL
+        hosts = set([h.decode() for h, beat in beats.items() \
+          if float(beat) > oldest])
+        # announced after the read was sent
+        for host_id, present in self.refreshing.pop(key, {}).items():
+          if present:
+            hosts.add(host_id)
+          else:
+            hosts.discard(host_id)
+        self.room_hosts[key] = {"hosts": hosts, "fetched": time.monotonic()}
+
+    def _on_room_host(self, message):
+        key = (message["namespace"], message["room"])
+        host_id = message["host_id"]
+        if host_id == self.host_id:
+          return
+        if key in self.refreshing:
+          self.refreshing[key][host_id] = message["present"]
+        entry = self.room_hosts.get(key)
+        if entry is not None:
+          if message["present"]:
+            entry["hosts"].add(host_id)
+          else:
+            entry["hosts"].discard(host_id)
+
+    async def _beat(self, rooms):
+        if len(rooms) == 0:
+          return
+        try:
+          conn = await self._connection()
+          pipe = conn.pipeline()
+          now = time.time()
+          for namespace, room in rooms:
+            key = self._room_key(namespace, room)
+            pipe.hset(key, self.host_id, now)
+            pipe.expire(key, constants.ROOM_HOSTS_TTL)
+          await pipe.execute()
+        except (aioredis.RedisError, OSError) as e:
+          logger.info("room hosts exception: {}\n".format(e))
+          self.pub = None
+
+    async def _heartbeat(self):
+        """
+        Background task that says again which rooms this instance has
+        members in, and forgets the hosts of rooms no longer emitted to.
+        """
+        while True:
+          await asyncio.sleep(constants.ROOM_HOSTS_HEARTBEAT)
+          await self._beat(list(self.hosted))
+          oldest = time.monotonic() - constants.ROOM_HOSTS_TTL
+          for key, entry in list(self.room_hosts.items()):
+            if entry["fetched"] < oldest:
+              del self.room_hosts[key]
+
+    async def _add_host(self, namespace, room):
+        # subscribed before anyone is told to publish to it
+        await self._subscribe(self._room_channel(namespace, room))
+        await self._beat([(namespace, room)])
+        await self._publish({"method": "room_host", "namespace": namespace,
+          "room": room, "host_id": self.host_id, "present": True})
+        await self._refresh(namespace, room)
+
+    async def _remove_host(self, namespace, room):
+        try:
+          conn = await self._connection()
+          await conn.hdel(self._room_key(namespace, room), self.host_id)
+        except (aioredis.RedisError, OSError) as e:
+          logger.info("room hosts exception: {}\n".format(e))
+          self.pub = None
+        await self._publish({"method": "room_host", "namespace": namespace,
+          "room": room, "host_id": self.host_id, "present": False})
+        await self._unsubscribe(self._room_channel(namespace, room))
+        self.room_hosts.pop((namespace, room), None)
+
+    def _change_room(self, namespace, room, change):
+        """
+        Run `change` after any earlier change to the same room, so a quick
+        enter and leave are applied in order.
+        """
+        key = (namespace, room)
+        previous = self.room_tasks.get(key)
+
+        async def run():
+          if previous is not None:
+            await previous
+          await change(namespace, room)
+
+        task = asyncio.ensure_future(run())
+        self.room_tasks[key] = task
+
+        def done(task):
+          if self.room_tasks.get(key) is task:
+            del self.room_tasks[key]
+        task.add_done_callback(done)
+
+    """
+    Subscriptions.
+    """
+
+    async def _subscribe(self, channel):
+        try:
+          if self.sub is not None:
+            await self.sub.subscribe(self.receiver.channel(channel))
+        except (aioredis.RedisError, OSError) as e:
+          logger.info("room subscribe exception: {}\n".format(e))
+
+    async def _unsubscribe(self, channel):
+        try:
+          if self.sub is not None:
+            await self.sub.unsubscribe(channel)
+        except (aioredis.RedisError, OSError) as e:
+          logger.info("room unsubscribe exception: {}\n".format(e))
+
+    def enter_room(self, sid, namespace, room):
+        first = self._tracked(sid, room) and not self._has_local(namespace, room)
+        super().enter_room(sid, namespace, room)
+        if first and not self.write_only:
+          self.hosted.add((namespace, room))
+          self.room_channels.add(self._room_channel(namespace, room))
+          self._change_room(namespace, room, self._add_host)
+
+    def leave_room(self, sid, namespace, room):
+        left = self._tracked(sid, room) and \
+          sid in self.rooms.get(namespace, {}).get(room, {})
+        super().leave_room(sid, namespace, room)
+        if left and not self._has_local(namespace, room) and not self.write_only:
+          self.hosted.discard((namespace, room))
+          self.room_channels.discard(self._room_channel(namespace, room))
+          self._change_room(namespace, room, self._remove_host)
+
+    """
+    Messages.
+    """
+
+    async def emit(self, event, data, namespace=None, room=None, skip_sid=None,
+                   callback=None, **kwargs):
+        namespace = namespace or "/"
+        if kwargs.get("ignore_queue") or callback is not None:
+          return await super().emit(event, data, namespace=namespace, room=room,
+            skip_sid=skip_sid, callback=callback, **kwargs)
+
+        if room is not None and self.is_connected(room, namespace):
+          hosts = [self.host_id] # a single local client
+        else:
+          hosts = self._room_hosts(namespace, room) if room is not None else None
+
+        if not hosts: # unknown members, so every instance has to look
+          self.published_emits += 1
+          return await super().emit(event, data, namespace=namespace, room=room,
+            skip_sid=skip_sid)
+
+        await super().emit(event, data, namespace=namespace, room=room,
+          skip_sid=skip_sid, ignore_queue=True)
+        if all(h == self.host_id for h in hosts):
+          self.local_emits += 1
+        else:
+          self.published_emits += 1
+          await self._publish({"method": "emit", "event": event, "data": data,
+            "namespace": namespace, "room": room, "skip_sid": skip_sid,
+            "callback": None, "host_id": self.host_id, "delivered": True},
+            channel=self._room_channel(namespace, room))
+
+    async def _handle_emit(self, message):
+        if message.get("delivered") and message.get("host_id") == self.host_id:
+          return
+        await super()._handle_emit(message)
+
+    async def _publish(self, data, channel=None):
+        retry = True
+        while True:
+          try:
+            conn = await self._connection()
+            return await conn.publish(channel or self.channel, dumps(data))
+          except (aioredis.RedisError, OSError):
+            self.pub = None
+            if retry:
+              self._get_logger().error("Cannot publish to redis... retrying")
+              retry = False
+            else:
+              self._get_logger().error("Cannot publish to redis... giving up")
+              break
+
+    async def _listen(self):
+        retry_sleep = 1
+        while True:
+          try:
+            if self.sub is None:
+              self.sub = await aioredis.create_redis(
+                (self.host, self.port), db=self.db,
+                password=self.password, ssl=self.ssl
+              )
+              self.receiver = Receiver()
+              channels = [self.channel] + list(self.room_channels)
+              await self.sub.subscribe(*[self.receiver.channel(c) for c in channels])
+            received = await self.receiver.get()
+            if received is None: # receiver closed
+              self.sub = None
+              continue
+            try:
+              message = loads(received[1])
+            except ValueError:
+              return None # not ours, ignored
+            if isinstance(message, dict) and message.get("method") == "room_host":
+              self._on_room_host(message)
+              continue
+            return message
+          except (aioredis.RedisError, OSError):
+            self._get_logger().error("Cannot receive from redis... retrying "
+              "in {} secs".format(retry_sleep))
+            self.sub = None
+            await asyncio.sleep(retry_sleep)
+            retry_sleep = min(retry_sleep * 2, 60)
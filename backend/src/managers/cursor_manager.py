@@ -0,0 +1,83 @@
+"""
+Cursor movements are held in memory and coalesced per (discussion, user), so
+only the latest position is broadcast at a fixed rate and written back lazily.
+"""
+
+from json import dumps
+import time
+
+import constants
+from utils.utils import (
+  logger,
+  DictEncoder,
+)
+
+
+class CursorManager:
+
+    def __init__(self, gm):
+        self.gm = gm
+        # (discussion_id, user_id) -> (sid, set_cursor response) to broadcast
+        self.pending = {}
+        # (discussion_id, user_id) -> cursor to write to the database
+        self.unsaved = {}
+
+    def _keys(self, held, discussion_id=None, user_id=None):
+        # copied, as entries are popped while going through them
+        return [k for k in list(held) if \
+          (discussion_id is None or k[0] == discussion_id) and \
+          (user_id is None or k[1] == user_id)]
+
+    def hold(self, discussion_id, user_id, response, sid=None):
+        """
+        Replace any held cursor of the user with the latest one.
+        """
+        key = (discussion_id, user_id)
+        self.pending[key] = (sid, response)
+        self.unsaved[key] = response["cursor"]
+
+    def forget(self, discussion_id, user_id):
+        """
+        Drop the held cursor of the user without broadcasting or saving it.
+        """
+        key = (discussion_id, user_id)
+        self.pending.pop(key, None)
+        self.unsaved.pop(key, None)
+
+    def persist(self, discussion_id=None, user_id=None):
+        """
+        Write held cursors to the database, optionally only those of one
+        discussion or user. Call before reading cursors from the database.
+        """
+        for key in self._keys(self.unsaved, discussion_id, user_id):
+          cursor = self.unsaved.pop(key, None)
+          if cursor is None: # persisted by another thread
+            continue
+          self.gm.discussion_manager._save_cursor(
+            discussion_id=key[0],
+            user_id=key[1],
+            unit_id=cursor["unit_id"],
+            position=cursor["position"]
+          )
+
+    async def broadcast(self, sio, namespace):
+        pending, self.pending = self.pending, {}
+        for (discussion_id, user_id), (sid, response) in pending.items():
+          shared = dumps({"set_cursor": response}, cls=DictEncoder)
+          await sio.emit("move_cursor", shared, room=discussion_id,
+            skip_sid=sid, namespace=namespace)
+
+    async def run(self, sio, namespace):
+        """
+        Background task that broadcasts and saves held cursors.
+        """
+        last_persist = time.monotonic()
+        while True:
+          await sio.sleep(1 / constants.CURSOR_BROADCAST_RATE)
+          try:
+            await self.broadcast(sio, namespace)
+            if time.monotonic() - last_persist >= constants.CURSOR_PERSIST_INTERVAL:
+              self.persist()
+              last_persist = time.monotonic()
+          except Exception as e:
+            logger.info("cursor flush exception: {}\n".format(e))
@@ -6,9 +6,13 @@ Many of the unit functions have no need of the discussion information.
 from datetime import datetime
 import logging
 from mongoengine import DoesNotExist
+import threading
+import uuid
+import weakref
 
 import constants
 from error import Errors
+from search.search import token_stats
 from utils import utils
 
 from models.discussion import (
@@ -22,9 +26,43 @@ from models.discussion import (
 
 class DiscussionManager:
 
+    # operations allowed in a batch: whether they take the user ID, and their emits
+    _batch_operations = {
+      "post": (True, ["created_post", "doc_meta", "chat_meta", "doc_delta"]),
+      "send_to_doc": (True, ["sent_to_doc", "doc_meta", "chat_meta", "doc_delta"]),
+      "move_cursor": (True, ["set_cursor"]),
+      "hide_unit": (False, ["doc_meta", "doc_delta"]),
+      "unhide_unit": (False, ["doc_meta", "doc_delta"]),
+      "add_unit": (False, ["added_unit", "doc_meta", "chat_meta", "doc_delta"]),
+      "select_unit": (True, ["doc_meta", "doc_delta"]),
+      "deselect_unit": (True, ["doc_meta", "doc_delta"]),
+      "move_units": (True, ["doc_meta", "doc_delta"]),
+      "merge_units": (True, ["merged_units", "doc_meta", "doc_delta"]),
+      "request_to_edit": (True, ["doc_meta", "doc_delta"]),
+      "deedit_unit": (True, ["doc_meta", "doc_delta"]),
+      "edit_unit": (True, ["doc_meta", "chat_meta", "doc_delta"]),
+    }
+
+    # batched operations run as another whose emits the cursor manager sends
+    _batch_held = {
+      "move_cursor": "hold_cursor",
+    }
+
+    # operations that may run on the worker: their return and emits
+    _offload_operations = {
+      "search": ("search", None),
+      "hide_unit": (None, ["doc_meta", "doc_delta"]),
+      "unhide_unit": (None, ["doc_meta", "doc_delta"]),
+      "merge_units": (None, ["merged_units", "doc_meta", "doc_delta"]),
+    }
+
     def __init__(self, gm):
         self.gm = gm
         self.redis_queue = self.gm.redis_queue
+        # discussion id -> lock held while its join snapshot is built, 
+        # dropped once no build holds it
+        self.snapshot_locks = weakref.WeakValueDictionary()
+        self.snapshot_locks_lock = threading.Lock()
 
     """
     Unprotected helper functions.
@@ -38,6 +76,41 @@ class DiscussionManager:
     def _get_unit(self, unit_id):
         return Unit.objects(id=unit_id)
 
+    def _update_unit(self, unit_id, expect=None, **kwargs):
+        """
+        Every change to a unit bumps its version, so clients can tell whether 
+        a doc_delta applies to their copy. With `expect`, the unit is only 
+        changed if it matches, and None is returned otherwise.
+        """
+        #### MONGO
+        unit = self._get_unit(unit_id).filter(**(expect or {})) \
+          .modify(new=True, inc__version=1, **kwargs)
+        #### MONGO
+        if unit is not None:
+          self.gm.cache_manager.put_unit(unit)
+        return unit
+
+    def _load_unit(self, unit_id):
+        """
+        NOTE: Served from the cache, so do not use for lock checks and
+        do not modify the returned unit.
+        """
+        return self.gm.cache_manager.get_unit(unit_id)
+
+    def _mark_written(self, discussion_id, snapshot=False):
+        """
+        Marks the discussion active, and with `snapshot`, bumps its version 
+        so the join snapshot is built again. Called once per event, and with 
+        `snapshot` only if the chat history or a pith in its chat_meta changed.
+        """
+        #### MONGO
+        if snapshot:
+          self._get(discussion_id).update(inc__version=1, 
+            set__last_active=datetime.utcnow())
+        else:
+          self._get(discussion_id).update(set__last_active=datetime.utcnow())
+        #### MONGO
+
     # access
     def _get_user(self, discussion_id, user_id):
         discussion = self._get(discussion_id)
@@ -53,7 +126,7 @@ class DiscussionManager:
         curr = unit_id
         while curr != "": # root 
           ancestors.append(curr)
-          unit = self._get_unit(curr).get()
+          unit = self._load_unit(curr)
           curr = unit.parent
         return ancestors
 
@@ -63,7 +136,7 @@ class DiscussionManager:
         while len(curr_depth) > 0:
           next_depth = []
           for c in curr_depth:
-            unit = self._get_unit(c).get()
+            unit = self._load_unit(c)
             next_depth += unit.children
           tree += next_depth
           curr_depth = next_depth
@@ -92,34 +165,39 @@ class DiscussionManager:
         return user.get().timeline[-1] #time_interval
 
     def _acquire_edit(self, discussion_id, user_id, unit_id):
-        unit = self._get_unit(unit_id)
         user_ref = self._get_user_ref(discussion_id, user_id)
         #### MONGO
-        unit.update(edit_privilege=user_id)
+        self._update_unit(unit_id, edit_privilege=user_id)
         user_ref.update(push__users__S__editing=unit_id)
         #### MONGO
 
     def _acquire_position(self, discussion_id, user_id, unit_id):
-        unit = self._get_unit(unit_id)
         user_ref = self._get_user_ref(discussion_id, user_id)
         #### MONGO
-        unit.update(position_privilege=user_id)
+        self._update_unit(unit_id, position_privilege=user_id)
         user_ref.update(push__users__S__moving=unit_id)
         #### MONGO
 
     def _release_edit(self, discussion_id, user_id, unit_id):
-        unit = self._get_unit(unit_id)
         user_ref = self._get_user_ref(discussion_id, user_id)
         #### MONGO
-        unit.update(edit_privilege=None)
+        self._update_unit(unit_id, edit_privilege=None)
         user_ref.update(pull__users__S__editing=unit_id)
         #### MONGO
 
+    def _save_cursor(self, discussion_id, user_id, unit_id, position):
+        user_ref = self._get_user_ref(discussion_id, user_id)
+        #### MONGO
+        user_ref.update(
+          set__users__S__cursor__unit_id=unit_id,
+          set__users__S__cursor__position=position
+        )
+        #### MONGO
+
     def _release_position(self, discussion_id, user_id, unit_id):
-        unit = self._get_unit(unit_id)
         user_ref = self._get_user_ref(discussion_id, user_id)
         #### MONGO
-        unit.update(position_privilege=None)
+        self._update_unit(unit_id, position_privilege=None)
         user_ref.update(pull__users__S__moving=unit_id)
         #### MONGO
 
@@ -130,7 +208,7 @@ class DiscussionManager:
 
     def _contains_chat_link(self, links):
       for unit_id in links:
-          unit = self._get_unit(unit_id).get()
+          unit = self._load_unit(unit_id)
           if unit.in_chat:
             return True
       return False
@@ -138,32 +216,41 @@ class DiscussionManager:
     def _remove_chat_links(self, pith):
       links = self._retrieve_links(pith)
       chat_links = [unit_id for unit_id in links \
-        if self._get_unit(unit_id).get().in_chat]
+        if self._load_unit(unit_id).in_chat]
       formatted = set([constants.LINK_WRAPPER.format(c) for c in chat_links])
       for f in formatted:
         pith = pith.replace(f, constants.DEAD_LINK)
       return pith
 
     def _get_position(self, parent, unit_id):
-      children = self._get_unit(parent).get().children
+      children = self._load_unit(parent).children
       if unit_id in children:
         return children.index(unit_id)
       else:
         return -1
 
-    def _chat_meta(self, discussion_id, unit_id):
-      unit = self._get_unit(unit_id).get()
-      user = self._get_user(discussion_id, unit.author)
+    def _user_names(self, discussion_id):
+      discussion = self._get(discussion_id).only("users").get()
+      return {u.id: u.name for u in discussion.users}
+
+    def _chat_meta(self, discussion_id, unit_id, unit=None, names=None):
+      if unit is None:
+        unit = self._load_unit(unit_id)
+      if names is None:
+        name = self._get_user(discussion_id, unit.author).get().name
+      else:
+        name = names[unit.author]
       response = {
         "unit_id": unit_id,
         "pith": unit.pith,
-        "author": user.get().name,
+        "author": name,
         "created_at": unit.created_at.strftime(constants.DATE_TIME_FMT)
       }
       return response
 
-    def _doc_meta(self, discussion_id, unit_id):
-      unit = self._get_unit(unit_id).get()
+    def _doc_meta(self, discussion_id, unit_id, unit=None):
+      if unit is None:
+        unit = self._load_unit(unit_id)
       response = {
         "unit_id": unit_id,
         "pith": unit.pith,
@@ -173,33 +260,143 @@ class DiscussionManager:
         "position_privilege": unit.position_privilege,
         "children": list(unit.children),
         "backlinks": list(unit.backward_links),
+        "version": unit.version,
+      }
+      return response
+
+    def _doc_delta(self, before, after):
+      """
+      Changes from the `before` doc_meta to the `after` doc_meta, which 
+      clients apply to their copy if it is at `from_version`. When `before` 
+      is None the unit is new, and the delta holds all of it.
+      """
+      if before is None:
+        before = {"version": None, "children": [], "backlinks": []}
+      elif before["version"] == after["version"]:
+        return None # unchanged
+
+      fields = {}
+      for key in ["pith", "hidden", "created_at", "edit_privilege", "position_privilege"]:
+        if key not in before or before[key] != after[key]:
+          fields[key] = after[key]
+      response = {
+        "unit_id": after["unit_id"],
+        "from_version": before["version"],
+        "version": after["version"],
+        "fields": fields,
+        "children": utils.list_delta(before["children"], after["children"]),
+        "backlinks": utils.list_delta(before["backlinks"], after["backlinks"]),
       }
       return response
 
     def _chat_metas(self, discussion_id, chat_meta_ids):
-        chat_meta = [self._chat_meta(discussion_id, id) for id in list(set(chat_meta_ids))]
+        if len(chat_meta_ids) == 0:
+          return []
+        units = self.gm.cache_manager.get_units(list(set(chat_meta_ids)))
+        names = self._user_names(discussion_id)
+        chat_meta = [self._chat_meta(discussion_id, id, unit, names) \
+          for id, unit in units.items()]
         return chat_meta
 
     def _doc_metas(self, discussion_id, doc_meta_ids):
-        doc_meta = [self._doc_meta(discussion_id, id) for id in list(set(doc_meta_ids))]
+        units = self.gm.cache_manager.get_units(list(set(doc_meta_ids)))
+        doc_meta = [self._doc_meta(discussion_id, id, unit) \
+          for id, unit in units.items()]
         return doc_meta
 
+    def _join_snapshot(self, discussion_id, version):
+        """
+        Chat history and its chat_meta, the part of the join payload every 
+        user gets. Built once per version of the discussion, however many 
+        users join at once.
+        """
+        snapshot = self.gm.cache_manager.get_snapshot(discussion_id, version)
+        if snapshot is not None:
+          return snapshot
+        with self.snapshot_locks_lock:
+          lock = self.snapshot_locks.setdefault(discussion_id, threading.Lock())
+        with lock:
+          # built while waiting for the lock
+          snapshot = self.gm.cache_manager.get_snapshot(discussion_id, version)
+          if snapshot is not None:
+            return snapshot
+
+          # read after the version, so never older than it
+          chat = self._get(discussion_id).only("chat").get().chat
+          units = self.gm.cache_manager.get_units(chat)
+          chat_meta_ids = list(chat)
+          for unit in units.values():
+            chat_meta_ids += unit.forward_links
+          snapshot = {
+            "chat_history": list(chat),
+            "chat_meta": self._chat_metas(discussion_id, chat_meta_ids)
+          }
+          self.gm.cache_manager.put_snapshot(discussion_id, version, snapshot)
+        return snapshot
+
+    def _edit_conflict(self, unit):
+        details = {
+          "unit_id": unit.id,
+          "pith": unit.pith,
+          "version": unit.version,
+          "edit_privilege": unit.edit_privilege,
+        }
+        return Errors.EDIT_CONFLICT, details
+
+    def _doc_meta_map(self, discussion_id, doc_meta_ids):
+        """
+        Snapshot of doc_meta by unit ID, taken before a change to make deltas.
+        """
+        doc_meta = self._doc_metas(discussion_id, doc_meta_ids)
+        return {d["unit_id"]: d for d in doc_meta}
+
+    def _doc_deltas(self, before, doc_meta):
+        doc_delta = [self._doc_delta(before.get(d["unit_id"]), d) for d in doc_meta]
+        return [d for d in doc_delta if d is not None]
+
+    def _merge_doc_delta(self, first, second):
+      """
+      One delta with the changes of both, if `second` follows `first`.
+      Otherwise, someone else changed the unit in between, so only `second` 
+      can be applied.
+      """
+      if first is None or second["from_version"] != first["version"]:
+        return second
+      response = {
+        "unit_id": first["unit_id"],
+        "from_version": first["from_version"],
+        "version": second["version"],
+        "fields": dict(first["fields"], **second["fields"]),
+        "children": first["children"] + second["children"],
+        "backlinks": first["backlinks"] + second["backlinks"],
+      }
+      return response
+
     """
     Verification functions. Require specific arguments in most cases.
     args should only contain self. Other arguments should be in kwargs so they are queryable.
     """
 
+    def _restore_archived(func):
+      """
+      Bring the discussion back first if it was archived.
+      NOTE: Blocks while restoring. Events that may find an archive go 
+      through the admission manager, which restores it off the loop first.
+      """
+      def helper(self, **kwargs):
+        self.gm.archive_manager.restore(kwargs["discussion_id"])
+        return func(self, **kwargs)
+      return helper
+
     def _check_discussion_id(func):
       """
       Check discussion_id is valid.
       """
       def helper(self, **kwargs):
         discussion_id = kwargs["discussion_id"]
-        try:
-          self._get(discussion_id).get()
-          #Discussion.objects.get(id=discussion_id)
+        if self.gm.cache_manager.has_discussion(discussion_id):
           return func(self, **kwargs)
-        except DoesNotExist:
+        else:
           return Errors.BAD_DISCUSSION_ID
       return helper
           
@@ -225,7 +422,7 @@ class DiscussionManager:
       def helper(self, **kwargs):
         unit_id = kwargs["unit_id"]
         try:
-          Unit.objects.get(id=unit_id)
+          self._load_unit(unit_id)
           return func(self, **kwargs)
         except DoesNotExist:
           return Errors.BAD_UNIT_ID
@@ -239,7 +436,7 @@ class DiscussionManager:
         units = kwargs["units"]
         try:
           for unit_id in units:
-            Unit.objects.get(id=unit_id)
+            self._load_unit(unit_id)
           return func(self, **kwargs)
         except DoesNotExist:
           return  Errors.BAD_UNIT_ID
@@ -253,7 +450,7 @@ class DiscussionManager:
       def helper(self, **kwargs):
         unit_id = kwargs["unit_id"]
         position = kwargs["position"]
-        unit = self._get_unit(unit_id).get()
+        unit = self._load_unit(unit_id)
         if position > len(unit.children) or position < -1:
           return Errors.BAD_POSITION
         else: 
@@ -266,6 +463,9 @@ class DiscussionManager:
       NOTE: Requires _check_user_id and _check_unit_id.
       """
       def helper(self, **kwargs):
+        # edits to a version are checked as they are made instead
+        if kwargs.get("version") is not None:
+          return func(self, **kwargs)
         unit_id = kwargs["unit_id"]
         user_id = kwargs["user_id"]
         unit = self._get_unit(unit_id).get()
@@ -302,12 +502,11 @@ class DiscussionManager:
         position = kwargs["position"]
 
         try:
-          Unit.objects.get(id=parent)
+          parent_unit = self._load_unit(parent)
         except DoesNotExist:
           return Errors.BAD_UNIT_ID
 
-        parent_ptr = self._get_unit(parent)
-        if position > len(parent_ptr.get().children) or position < 0: # fixed
+        if position > len(parent_unit.children) or position < 0: # fixed
           return Errors.BAD_POSITION 
 
         ancestors = self._get_ancestors(parent)
@@ -322,6 +521,7 @@ class DiscussionManager:
     Service functions.
     """
 
+    @_restore_archived
     def test_connect(self, discussion_id):
         try:
           self._get(discussion_id).get()
@@ -331,16 +531,12 @@ class DiscussionManager:
 
     @_check_discussion_id
     def create_user(self, discussion_id, nickname, user_id=None):
+        """
+        NOTE: Users may be created concurrently, so the nickname and ID are 
+        checked in the same update that adds the user.
+        """
         discussion = self._get(discussion_id)
-        if len(discussion.filter(users__name=nickname)) > 0:
-          return Errors.NICKNAME_EXISTS 
-
-        if user_id is not None:
-          user_ref = self._get_user_ref(discussion_id, user_id)
-          if len(user_ref) > 0:
-            return Errors.USER_ID_EXISTS 
-
-        unit_id = discussion.get().document
+        unit_id = discussion.only("document").get().document
         cursor = Cursor(unit_id=unit_id, position=-1) 
         user = User(
           name=nickname,
@@ -352,8 +548,13 @@ class DiscussionManager:
           user.id = user_id
 
         #### MONGO
-        discussion.update(push__users=user)
+        added = discussion.filter(users__name__ne=nickname, users__id__ne=user.id) \
+          .update(push__users=user)
         #### MONGO
+        if added == 0:
+          if len(discussion.filter(users__name=nickname)) > 0:
+            return Errors.NICKNAME_EXISTS
+          return Errors.USER_ID_EXISTS
 
         response = {"user_id": user.id}
         return response, None
@@ -361,24 +562,18 @@ class DiscussionManager:
     @_check_discussion_id
     @_check_user_id
     def load_user(self, discussion_id, user_id):
-        discussion = self._get(discussion_id).get()
-        user = self._get_user(discussion_id, user_id)
+        # cursors are read from the database
+        self.gm.cursor_manager.persist(discussion_id=discussion_id)
 
-        doc_meta_ids = []
-        chat_meta_ids = []
+        discussion = self._get(discussion_id).exclude("chat").get()
+        user = discussion.users.get(id=user_id)
+        snapshot = self._join_snapshot(discussion_id, discussion.version)
 
-        cursors = []
-        for p in discussion.users:
-          if p.active:
-            cursors.append({
-              "user_id": p.id,
-              "nickname": p.name, 
-              "cursor": p.cursor.to_mongo().to_dict()
-            })
-          doc_meta_ids.append(p.cursor.unit_id)
+        cursors = self._cursors(discussion)
+        doc_meta_ids = [p.cursor.unit_id for p in discussion.users]
 
         timeline = []
-        for i in user.get().timeline: 
+        for i in user.timeline: 
           timeline.append({
             "unit_id": i.unit_id,
             "start_time": i.start_time.strftime(constants.DATE_TIME_FMT),
@@ -386,33 +581,30 @@ class DiscussionManager:
           })
           doc_meta_ids.append(i.unit_id)
 
-        unit_ids = []
-        for u in discussion.chat:
-          unit = self._get_unit(u).get()
-          unit_ids.append(u)
-          unit_ids += unit.forward_links 
-        unit_ids = list(set(unit_ids))
-
-        for u in unit_ids: # chat units and forward links
-          unit = self._get_unit(u).get()
-          chat_meta_ids.append(u)
-
         doc_meta = self._doc_metas(discussion_id, doc_meta_ids)
-        chat_meta = self._chat_metas(discussion_id, chat_meta_ids)
 
         response = {
-          "nickname": user.get().name,
+          "nickname": user.name,
           "cursors": cursors,
-          "current_unit": user.get().viewed_unit, 
+          "current_unit": user.viewed_unit, 
           "timeline": timeline,
-          "chat_history": list(discussion.chat), 
-          "chat_meta": chat_meta,
+          "chat_history": snapshot["chat_history"], 
+          "chat_meta": snapshot["chat_meta"],
           "doc_meta": doc_meta
         }
         return response
 
-    @_check_discussion_id
-    def join(self, discussion_id, user_id):
+    def _cursors(self, discussion):
+        """
+        The cursors of active users. Held cursors must be persisted first.
+        """
+        return [{
+          "user_id": p.id,
+          "nickname": p.name, 
+          "cursor": p.cursor.to_mongo().to_dict()
+        } for p in discussion.users if p.active]
+
+    def _activate(self, discussion_id, user_id):
         """
         Update start time of current unit.
         """
@@ -422,25 +614,72 @@ class DiscussionManager:
         user_ref.update(
           set__users__S__active=True,
           set__users__S__start_time=
-            datetime.utcnow()
+            datetime.utcnow(),
+          set__last_active=datetime.utcnow()
         ) 
         #### MONGO
 
-        response = self.load_user(discussion_id=discussion_id, user_id=user_id)
+    def _cursor_response(self, discussion_id, user_id):
         user = self._get_user(discussion_id, user_id)
         cursor_response = {
           "user_id": user_id,
           "nickname": user.get().name,
           "cursor": user.get().cursor.to_mongo().to_dict()
         }
+        return cursor_response
+
+    @_restore_archived
+    @_check_discussion_id
+    def join(self, discussion_id, user_id):
+        self._activate(discussion_id, user_id)
+        response = self.load_user(discussion_id=discussion_id, user_id=user_id)
+        cursor_response = self._cursor_response(discussion_id, user_id)
         return response, [cursor_response]
 
+    @_restore_archived
+    @_check_discussion_id
+    @_check_user_id
+    def resync(self, discussion_id, user_id, seq):
+        """
+        Join again after a reconnect, with only the events broadcast since 
+        `seq` if they are all still logged, or else all of join. Cursor moves 
+        are not logged, so the current cursors are sent with the events.
+        """
+        event_log_manager = self.gm.event_log_manager
+        logged = event_log_manager.since(discussion_id, seq)
+        event_log_manager.resyncs += 1
+
+        if logged is not None:
+          events, latest = logged
+          self._activate(discussion_id, user_id)
+          # cursors are read from the database
+          self.gm.cursor_manager.persist(discussion_id=discussion_id)
+          discussion = self._get(discussion_id).only("users").get()
+          response = {
+            "seq": latest, 
+            "events": events, 
+            "cursors": self._cursors(discussion)
+          }
+          cursor_response = self._cursor_response(discussion_id, user_id)
+          return response, [cursor_response]
+
+        # read first, so no event after it is left out of what is loaded;
+        # None if the log could not be read, as no seq is known to be covered
+        latest = event_log_manager.latest(discussion_id)
+        joined, emits = self.join(discussion_id=discussion_id, user_id=user_id)
+        event_log_manager.full_resyncs += 1
+        response = {"seq": latest, "joined": joined}
+        return response, emits
+
     @_check_discussion_id
     @_check_user_id
     def leave(self, discussion_id, user_id):
         """
         Create new time interval for last visited unit.
         """
+        self.gm.cursor_manager.persist(discussion_id=discussion_id, user_id=user_id)
+        self.gm.cursor_manager.forget(discussion_id, user_id)
+
         user = self._get_user(discussion_id, user_id)
         editing_locks = user.get().editing
         position_locks = user.get().moving
@@ -453,7 +692,8 @@ class DiscussionManager:
         self._time_entry(discussion_id, user_id)
         user_ref = self._get_user_ref(discussion_id, user_id)
         user_ref.update(
-          set__users__S__active=False
+          set__users__S__active=False,
+          set__last_active=datetime.utcnow()
         ) 
         #### MONGO
 
@@ -475,23 +715,24 @@ class DiscussionManager:
         user_ref = self._get_user_ref(discussion_id, user_id)
 
         # perform unit-based operations
-        unit = self._get_unit(unit_id).get()
+        unit = self._load_unit(unit_id)
 
         doc_meta_ids = []
         doc_meta_ids.append(unit_id)
         for c in unit.children:
-          c_unit = self._get_unit(c).get()
+          c_unit = self._load_unit(c)
           doc_meta_ids.append(c)
           for g in c_unit.children:
             doc_meta_ids.append(g)
         for b in unit.backward_links:
-          b_unit = self._get_unit(b).get()
+          b_unit = self._load_unit(b)
           doc_meta_ids.append(b)
           for g in b_unit.backward_links:
             doc_meta_ids.append(g)
 
         #### MONGO
-        # update cursor
+        # update cursor, replacing any held one
+        self.gm.cursor_manager.forget(discussion_id, user_id)
         user_ref.update(
           set__users__S__cursor__unit_id=unit_id, # new page
           set__users__S__cursor__position=-1 # for now, default to end
@@ -553,20 +794,32 @@ class DiscussionManager:
     @_check_discussion_id
     @_check_unit_id
     def get_unit_content(self, discussion_id, unit_id):
-        unit = self._get_unit(unit_id).get()
+        unit = self._load_unit(unit_id)
         response = {
           "pith": unit.pith,
           "hidden": unit.hidden
         }
         return response, None
   
+    @_check_discussion_id
+    @_check_units
+    def get_doc_meta(self, discussion_id, units):
+        """
+        Full doc_meta, for clients whose copy does not match a doc_delta.
+        """
+        doc_meta = self._doc_metas(discussion_id, units)
+        response = {
+          "doc_meta": doc_meta
+        }
+        return response, None
+
     @_check_discussion_id
     @_check_unit_id
     def get_unit_context(self, discussion_id, unit_id):
         """
         Make sure the unit is in the document.
         """
-        unit = self._get_unit(unit_id).get()
+        unit = self._load_unit(unit_id)
         in_chat = unit.in_chat
         if in_chat:
           doc_meta = self._chat_meta(discussion_id, unit_id)
@@ -592,12 +845,14 @@ class DiscussionManager:
 
         forward_links = self._retrieve_links(pith)
         for f in forward_links:
-            unit = self._get_unit(f)
-            if unit.get().in_chat:
+            unit = self._load_unit(f)
+            if unit.in_chat:
               chat_meta_ids.append(f)
             else:
               doc_meta_ids.append(f)
+        before = self._doc_meta_map(discussion_id, doc_meta_ids)
 
+        term_freqs, token_count = token_stats(pith)
         unit = Unit(
           pith=pith,
           discussion=discussion_id,
@@ -606,6 +861,8 @@ class DiscussionManager:
           in_chat=True,
           forward_links=forward_links,
           original_pith=pith,
+          term_freqs=term_freqs,
+          token_count=token_count,
         )
         unit_id = unit.id
 
@@ -613,49 +870,86 @@ class DiscussionManager:
         unit.save()
         discussion.update(push__chat=unit_id)
         #### MONGO
+        self._mark_written(discussion_id, snapshot=True)
+        self.gm.cache_manager.put_unit(unit)
+        self.gm.search_manager.index_unit(unit)
 
         chat_meta_ids.append(unit_id)
 
         # make backlinks
         for f in forward_links:
-          self._get_unit(f).update(
+          self._update_unit(f,
             push__backward_links = unit_id
           )
-          unit = self._get_unit(f)
-          if unit.get().in_chat:
+          unit = self._load_unit(f)
+          if unit.in_chat:
             chat_meta_ids.append(f)
           else:
             doc_meta_ids.append(f)
 
         doc_meta = self._doc_metas(discussion_id, doc_meta_ids)
         chat_meta = self._chat_metas(discussion_id, chat_meta_ids)
+        doc_delta = self._doc_deltas(before, doc_meta)
 
         response = {
           "unit_id": unit_id,
         }
-        return None, [response, doc_meta, chat_meta]
+        return None, [response, doc_meta, chat_meta, doc_delta]
 
     @_check_discussion_id
-    def search(self, discussion_id, query):
+    def search(self, discussion_id, query, 
+      limit=constants.SEARCH_DEFAULT_LIMIT, offset=0):
         """
+        One page of the units matching the query, best first, without hidden
+        units. Ranked by the in-memory index, or by the Mongo text index if
+        it is unavailable.
         https://docs.mongodb.com/manual/reference/operator/query/text/
         """
-        # by default, only search within own discussion
-        results = Unit.objects()._collection.find({
-          "discussion": discussion_id, "$text": {"$search": query}
-        })
-        results = [r for r in results]
-
         chat_meta_ids = []
         doc_meta_ids = []
 
-        # TODO: don't show if hidden
-        for unit in results: # dict form
-          unit_id = unit["_id"]
-          if unit["in_chat"]:
-            chat_meta_ids.append(unit_id)
-          else:
-            doc_meta_ids.append(unit_id)
+        ranking = offset + limit + constants.SEARCH_OVERFETCH
+        ranked = self.gm.search_manager.search(discussion_id, query, ranking)
+        if ranked is not None:
+          shown = []
+          start = 0
+          while len(shown) < offset + limit:
+            if start >= len(ranked):
+              if len(ranked) < ranking: # nothing more matches
+                break
+              # hidden units took up the places ranked, so rank further
+              ranking *= 2
+              more = self.gm.search_manager.search(discussion_id, query, ranking)
+              if more is None:
+                break
+              ranked = more
+              continue
+            # hidden units take part of the page, so load more after them
+            loading = ranked[start:start + offset + limit - len(shown)]
+            start += len(loading)
+            # units deleted elsewhere, not yet reindexed, are left out
+            units = self.gm.cache_manager.get_units(loading)
+            shown += [units[u] for u in loading \
+              if u in units and not units[u].hidden]
+          for unit in shown[offset:offset + limit]:
+            if unit.in_chat:
+              chat_meta_ids.append(unit.id)
+            else:
+              doc_meta_ids.append(unit.id)
+        else:
+          # by default, only search within own discussion
+          results = Unit.objects()._collection.find(
+            {"discussion": discussion_id, "hidden": {"$ne": True},
+              "$text": {"$search": query}},
+            {"score": {"$meta": "textScore"}, "in_chat": 1}
+          ).sort([("score", {"$meta": "textScore"})]).skip(offset).limit(limit)
+
+          for unit in results: # dict form
+            unit_id = unit["_id"]
+            if unit["in_chat"]:
+              chat_meta_ids.append(unit_id)
+            else:
+              doc_meta_ids.append(unit_id)
 
         chat = [{"unit_id": c} for c in chat_meta_ids] 
         doc = [{"unit_id": d} for d in doc_meta_ids] 
@@ -672,6 +966,25 @@ class DiscussionManager:
         }
         return response, None
       
+    @_check_discussion_id
+    def typeahead(self, discussion_id, query, 
+      limit=constants.TYPEAHEAD_DEFAULT_LIMIT):
+        """
+        Units to cite, completing the last word of the query. Served only
+        from the in-memory index.
+        """
+        unit_ids = self.gm.search_manager.typeahead(discussion_id, query, limit,
+          keep=lambda u: not self._load_unit(u).hidden)
+        units = self.gm.cache_manager.get_units(unit_ids)
+        response = {
+          "units": [{
+            "unit_id": u,
+            "pith": units[u].pith,
+            "in_chat": units[u].in_chat
+          } for u in unit_ids if u in units]
+        }
+        return response, None
+
     @_check_discussion_id
     @_check_unit_id
     def send_to_doc(self, discussion_id, user_id, unit_id):
@@ -681,17 +994,22 @@ class DiscussionManager:
         Instead, we have a pointer to the chat unit, so we can use that to find
         "backlinks".
         """
+        # position comes from the cursor
+        self.gm.cursor_manager.persist(discussion_id=discussion_id, user_id=user_id)
+
         user = self._get_user(discussion_id, user_id)
-        chat_unit = self._get_unit(unit_id).get()
+        chat_unit = self._load_unit(unit_id)
 
         position = user.get().cursor.position if user.get().cursor.position != -1 else \
-          len(self._get_unit(user.get().cursor.unit_id).get().children)
+          len(self._load_unit(user.get().cursor.unit_id).children)
         parent_id = user.get().cursor.unit_id
 
         # remove chat links
         pith = self._remove_chat_links(chat_unit.pith)
         forward_links = self._retrieve_links(pith)
+        before = self._doc_meta_map(discussion_id, [parent_id] + forward_links)
 
+        term_freqs, token_count = token_stats(chat_unit.pith)
         unit = Unit(
           pith=chat_unit.pith,
           discussion=discussion_id,
@@ -699,16 +1017,20 @@ class DiscussionManager:
           parent=parent_id,
           source_unit_id=unit_id, # from chat
           original_pith=chat_unit.pith,
+          term_freqs=term_freqs,
+          token_count=token_count,
         )
         unit_id = unit.id
 
-        parent = self._get_unit(parent_id)
         key = "push__children__{}".format(position)
 
         #### MONGO
         unit.save()
-        parent.update(**{key: [unit_id]})
+        self._update_unit(parent_id, **{key: [unit_id]})
         #### MONGO
+        self._mark_written(discussion_id)
+        self.gm.cache_manager.put_unit(unit)
+        self.gm.search_manager.index_unit(unit)
 
         doc_meta_ids = []
         chat_meta_ids = []
@@ -716,14 +1038,14 @@ class DiscussionManager:
         doc_meta_ids.append(parent_id)
 
         for f in forward_links:
-          unit = self._get_unit(f)
-          if unit.get().in_chat:
+          unit = self._load_unit(f)
+          if unit.in_chat:
             chat_meta_ids.append(f)
           else:
             doc_meta_ids.append(f)
 
         for f in forward_links:
-          self._get_unit(f).update(
+          self._update_unit(f,
             push__backward_links = unit_id
           )
           doc_meta_ids.append(f)
@@ -731,21 +1053,18 @@ class DiscussionManager:
         response = {"unit_id": unit_id}
         doc_meta = self._doc_metas(discussion_id, doc_meta_ids)
         chat_meta = self._chat_metas(discussion_id, chat_meta_ids)
+        doc_delta = self._doc_deltas(before, doc_meta)
         
-        return None, [response, doc_meta, chat_meta]
+        return None, [response, doc_meta, chat_meta, doc_delta]
 
     @_check_discussion_id
     @_check_user_id
     @_check_unit_id
     @_verify_position
     def move_cursor(self, discussion_id, user_id, unit_id, position):
-        user_ref = self._get_user_ref(discussion_id, user_id)
-
         #### MONGO
-        user_ref.update(
-          set__users__S__cursor__unit_id=unit_id,
-          set__users__S__cursor__position=position
-        )
+        self.gm.cursor_manager.forget(discussion_id, user_id)
+        self._save_cursor(discussion_id, user_id, unit_id, position)
         #### MONGO
 
         user = self._get_user(discussion_id, user_id)
@@ -756,6 +1075,24 @@ class DiscussionManager:
         }
         return None, [response]
 
+    @_check_discussion_id
+    @_check_user_id
+    @_check_unit_id
+    @_verify_position
+    def hold_cursor(self, discussion_id, user_id, unit_id, position, sid=None):
+        """
+        Like `move_cursor`, but the cursor is held by the cursor manager, 
+        which broadcasts and saves only the latest one at a fixed rate.
+        """
+        user = self._get_user(discussion_id, user_id)
+        response = {
+            "user_id": user_id,
+            "nickname": user.get().name,
+            "cursor": {"unit_id": unit_id, "position": position}
+        }
+        self.gm.cursor_manager.hold(discussion_id, user_id, response, sid)
+        return None, [response]
+
     @_check_discussion_id
     @_check_unit_id
     def hide_unit(self, discussion_id, unit_id):
@@ -763,29 +1100,31 @@ class DiscussionManager:
         Not a locked operation, so may hide a unit being edited/moved.
         """
         tree = self._get_tree(unit_id)
+        before = self._doc_meta_map(discussion_id, tree)
 
         #### MONGO
         for t in tree:
-          unit = self._get_unit(t)
-          unit.update(hidden=True)
+          self._update_unit(t, hidden=True)
         #### MONGO
 
         doc_meta = self._doc_metas(discussion_id, tree)
-        return None, [doc_meta]
+        doc_delta = self._doc_deltas(before, doc_meta)
+        return None, [doc_meta, doc_delta]
         
     @_check_discussion_id
     @_check_unit_id
     def unhide_unit(self, discussion_id, unit_id):
         tree = self._get_tree(unit_id)
+        before = self._doc_meta_map(discussion_id, tree)
 
         #### MONGO
         for t in tree:
-          unit = self._get_unit(t)
-          unit.update(hidden=False)
+          self._update_unit(t, hidden=False)
         #### MONGO
         
         doc_meta = self._doc_metas(discussion_id, tree)
-        return None, [doc_meta]
+        doc_delta = self._doc_deltas(before, doc_meta)
+        return None, [doc_meta, doc_delta]
 
     @_check_discussion_id
     def add_unit(self, discussion_id, pith, parent, position):
@@ -797,21 +1136,28 @@ class DiscussionManager:
         if self._contains_chat_link(forward_links):
           return Errors.INVALID_REFERENCE
 
+        before = self._doc_meta_map(discussion_id, [parent] + forward_links)
+
+        term_freqs, token_count = token_stats(pith)
         unit = Unit(
           pith=pith,
           discussion=discussion_id,
           forward_links=forward_links,
           parent=parent,
+          term_freqs=term_freqs,
+          token_count=token_count,
         )
         unit_id = unit.id
 
-        parent_ptr = self._get_unit(parent)
         key = "push__children__{}".format(position)
 
         #### MONGO
         unit.save()
-        parent_ptr.update(**{key: [unit_id]})
+        self._update_unit(parent, **{key: [unit_id]})
         #### MONGO
+        self._mark_written(discussion_id)
+        self.gm.cache_manager.put_unit(unit)
+        self.gm.search_manager.index_unit(unit)
 
         doc_meta_ids = []
         chat_meta_ids = []
@@ -819,19 +1165,19 @@ class DiscussionManager:
         doc_meta_ids.append(parent)
 
         for f in forward_links:
-          unit = self._get_unit(f)
-          if unit.get().in_chat:
+          unit = self._load_unit(f)
+          if unit.in_chat:
             chat_meta_ids.append(f)
           else:
             doc_meta_ids.append(f)
 
         # make backlinks
         for f in forward_links:
-          self._get_unit(f).update(
+          self._update_unit(f,
             push__backward_links = unit_id
           )
-          unit = self._get_unit(f)
-          if unit.get().in_chat:
+          unit = self._load_unit(f)
+          if unit.in_chat:
             chat_meta_ids.append(f)
           else:
             doc_meta_ids.append(f)
@@ -839,8 +1185,9 @@ class DiscussionManager:
         response = {"unit_id": unit_id}
         doc_meta = self._doc_metas(discussion_id, doc_meta_ids)
         chat_meta = self._chat_metas(discussion_id, chat_meta_ids)
+        doc_delta = self._doc_deltas(before, doc_meta)
 
-        return None, [response, doc_meta, chat_meta]
+        return None, [response, doc_meta, chat_meta, doc_delta]
 
     # TODO: might support multi-select
     @_check_discussion_id
@@ -853,26 +1200,30 @@ class DiscussionManager:
         unit = self._get_unit(unit_id) 
         if unit.get().position_privilege is not None: 
           return Errors.FAILED_POSITION_ACQUIRE 
+        before = self._doc_meta_map(discussion_id, [unit_id])
 
         #### MONGO
         self._acquire_position(discussion_id, user_id, unit_id)
         #### MONGO
 
         doc_meta = self._doc_metas(discussion_id, [unit_id])
-        return None, [doc_meta]
+        doc_delta = self._doc_deltas(before, doc_meta)
+        return None, [doc_meta, doc_delta]
 
     @_check_discussion_id
     @_check_user_id
     @_check_unit_id
     @_verify_positions_privilege
     def deselect_unit(self, discussion_id, user_id, unit_id):
+        before = self._doc_meta_map(discussion_id, [unit_id])
 
         #### MONGO
         self._release_position(discussion_id, user_id, unit_id)
         #### MONGO
 
         doc_meta = self._doc_metas(discussion_id, [unit_id])
-        return None, [doc_meta]
+        doc_delta = self._doc_deltas(before, doc_meta)
+        return None, [doc_meta, doc_delta]
 
     # TODO: MULTIPLE MONGO OPERATIONS
     @_check_discussion_id
@@ -886,31 +1237,30 @@ class DiscussionManager:
           Removes each of the units from old parent and puts under new parent.
         """
         doc_meta_ids = []
+        old_parents = [self._load_unit(unit_id).parent for unit_id in units]
+        before = self._doc_meta_map(discussion_id, old_parents + [parent])
 
         # remove from old
-        for unit_id in units:
-          unit = self._get_unit(unit_id)
-          old_parent = unit.get().parent
-          self._get_unit(old_parent).update(
+        for unit_id, old_parent in zip(units, old_parents):
+          self._update_unit(old_parent,
             pull__children=unit_id
           )
           doc_meta_ids.append(old_parent)
 
         # add to new
         key = "push__children__{}".format(position)
-        parent_ptr = self._get_unit(parent)
-        parent_ptr.update(**{key: units})
+        self._update_unit(parent, **{key: units})
         for unit_id in units:
-          unit = self._get_unit(unit_id)
-          unit.update(
+          self._update_unit(unit_id,
             set__parent=parent,
           )
           self._release_position(discussion_id, user_id, unit_id)
         doc_meta_ids.append(parent)
 
         doc_meta = self._doc_metas(discussion_id, doc_meta_ids)
+        doc_delta = self._doc_deltas(before, doc_meta)
       
-        return None, [doc_meta]
+        return None, [doc_meta, doc_delta]
 
     # TODO: MULTIPLE MONGO OPERATIONS
     @_check_discussion_id
@@ -923,6 +1273,9 @@ class DiscussionManager:
           Releases position lock.
           Removes each of the units from old parent and puts under new parent.
         """
+        old_parents = [self._load_unit(unit_id).parent for unit_id in units]
+        before = self._doc_meta_map(discussion_id, old_parents + [parent])
+
         added_unit_response = self.add_unit(
           discussion_id=discussion_id, pith="", 
           parent=parent, position=position
@@ -938,10 +1291,11 @@ class DiscussionManager:
         # get most up-to-date information
         doc_meta_ids = [d["unit_id"] for d in doc_meta + doc_meta2]
         doc_meta = self._doc_metas(discussion_id, doc_meta_ids)
+        doc_delta = self._doc_deltas(before, doc_meta)
 
         response = {"unit_id": unit_id}
 
-        return None, [response, doc_meta]
+        return None, [response, doc_meta, doc_delta]
 
     @_check_discussion_id
     @_check_user_id
@@ -953,57 +1307,83 @@ class DiscussionManager:
         unit = self._get_unit(unit_id) 
         if unit.get().edit_privilege is not None: 
           return Errors.FAILED_EDIT_ACQUIRE
+        before = self._doc_meta_map(discussion_id, [unit_id])
 
         #### MONGO
         self._acquire_edit(discussion_id, user_id, unit_id)
         #### MONGO
 
         doc_meta = self._doc_metas(discussion_id, [unit_id])
-        return None, [doc_meta]
+        doc_delta = self._doc_deltas(before, doc_meta)
+        return None, [doc_meta, doc_delta]
 
     @_check_discussion_id
     @_check_user_id
     @_check_unit_id
     @_verify_edit_privilege
     def deedit_unit(self, discussion_id, user_id, unit_id):
+        before = self._doc_meta_map(discussion_id, [unit_id])
+
         #### MONGO
         self._release_edit(discussion_id, user_id, unit_id)
         #### MONGO
 
         doc_meta = self._doc_metas(discussion_id, [unit_id])
-        return None, [doc_meta]
+        doc_delta = self._doc_deltas(before, doc_meta)
+        return None, [doc_meta, doc_delta]
 
     # TODO: MULTIPLE MONGO OPERATIONS
     @_check_discussion_id
     @_check_user_id
     @_check_unit_id
     @_verify_edit_privilege
-    def edit_unit(self, discussion_id, user_id, unit_id, pith):
+    def edit_unit(self, discussion_id, user_id, unit_id, pith, version=None):
         """
-          Releases edit lock.
+        Without the edit lock, `version` is the version of the unit that was 
+        edited, and the edit is only made if the unit is still at it and 
+        nobody else holds the lock.
         """
         forward_links = self._retrieve_links(pith)
         if self._contains_chat_link(forward_links):
           return Errors.INVALID_REFERENCE
 
-        unit = self._get_unit(unit_id) 
-        old_forward_links = unit.get().forward_links
-
-        unit.update(
+        unit = self._get_unit(unit_id).get()
+        expect = None
+        if version is not None:
+          if unit.version != version or unit.edit_privilege not in [None, user_id]:
+            return self._edit_conflict(unit)
+          # in case it changed since it was read
+          expect = {"version": version, "edit_privilege__in": [None, user_id]}
+        old_forward_links = unit.forward_links
+        before = self._doc_meta_map(discussion_id, 
+          [unit_id] + old_forward_links + forward_links)
+
+        term_freqs, token_count = token_stats(pith)
+        edited = self._update_unit(unit_id,
+          expect=expect,
           pith=pith, 
           forward_links=forward_links,
-          edit_count=unit.get().edit_count + 1 # increment
+          edit_count=unit.edit_count + 1, # increment
+          term_freqs=term_freqs,
+          token_count=token_count,
         )
+        if edited is None:
+          return self._edit_conflict(self._get_unit(unit_id).get())
+        self.gm.search_manager.index_unit(edited)
+        # its pith is in the join snapshot if a chat unit links to it
+        linked = self.gm.cache_manager.get_units(edited.backward_links).values()
+        self._mark_written(discussion_id, 
+          snapshot=edited.in_chat or any(u.in_chat for u in linked))
 
         # handle backlinks
         removed_links = set(old_forward_links).difference(set(forward_links)) 
         for r in removed_links: # remove backlink 
-          unit = self._get_unit(r).update(
+          self._update_unit(r,
             pull__backward_links = unit_id
           )
         added_links = set(forward_links).difference(set(old_forward_links))
         for a in added_links: # add backlink 
-          unit = self._get_unit(a).update(
+          self._update_unit(a,
             push__backward_links = unit_id
           )
 
@@ -1013,16 +1393,142 @@ class DiscussionManager:
 
         # backward links added/removed
         for b in removed_links.union(added_links):
-          unit = self._get_unit(b)
-          if unit.get().in_chat:
+          unit = self._load_unit(b)
+          if unit.in_chat:
             chat_meta_ids.append(b)
           else:
             doc_meta_ids.append(b)
 
         doc_meta = self._doc_metas(discussion_id, doc_meta_ids)
         chat_meta = self._chat_metas(discussion_id, chat_meta_ids)
+        doc_delta = self._doc_deltas(before, doc_meta)
 
-        return None, [doc_meta, chat_meta]
+        return None, [doc_meta, chat_meta, doc_delta]
+
+    @_check_discussion_id
+    @_check_user_id
+    def batch(self, discussion_id, user_id, operations, sid=None):
+        """
+        Runs operations in order, stopping at the first error. The changes of
+        all of them are merged, so they can be sent in one broadcast. Cursor
+        moves are held and broadcast by the cursor manager instead.
+        """
+        results = []
+        doc_meta = {}
+        chat_meta = {}
+        doc_delta = {}
+        events = []
+
+        for o in operations:
+          event = o["event"]
+          takes_user, emits = self._batch_operations[event]
+          kwargs = dict(o["request"], discussion_id=discussion_id)
+          if takes_user:
+            kwargs["user_id"] = user_id
+
+          held = self._batch_held.get(event)
+          if held is not None:
+            product = getattr(self, held)(sid=sid, **kwargs)
+          else:
+            product = getattr(self, event)(**kwargs)
+          if utils.is_error(product):
+            error, details = utils.split_error(product)
+            result = {"event": event, "error": error.value}
+            if details is not None:
+              result["details"] = details
+            results.append(result)
+            break
+          results.append({"event": event})
+          if held is not None:
+            continue
+
+          # later doc_meta and chat_meta are more up to date
+          shared = {}
+          for r, e in zip(product[1], emits):
+            if e == "doc_meta":
+              doc_meta.update({d["unit_id"]: d for d in r})
+            elif e == "chat_meta":
+              chat_meta.update({c["unit_id"]: c for c in r})
+            elif e == "doc_delta":
+              for d in r:
+                doc_delta[d["unit_id"]] = self._merge_doc_delta(
+                  doc_delta.get(d["unit_id"]), d)
+            else:
+              shared[e] = r
+          events.append({"event": event, "shared": shared})
+
+        response = {"results": results}
+        return response, [
+          list(doc_meta.values()), 
+          list(chat_meta.values()), 
+          list(doc_delta.values()), 
+          events
+        ]
+
+    @_check_discussion_id
+    def get_discussion_stats(self, discussion_id):
+        """
+        Time spent on each unit and by each user, as of the worker's last
+        rollup.
+        """
+        stats = self.gm.stats_manager.get(discussion_id)
+        units = stats.units if stats is not None else {}
+        users = stats.users if stats is not None else {}
+        response = {
+          "units": [{
+            "unit_id": unit_id,
+            "seconds": u.get("seconds", 0),
+            "visits": u.get("visits", 0)
+          } for unit_id, u in units.items()],
+          "users": [{
+            "user_id": user_id,
+            "nickname": u.get("name", ""),
+            "seconds": u.get("seconds", 0),
+            "visits": u.get("visits", 0)
+          } for user_id, u in users.items()]
+        }
+        if stats is not None and stats.updated_at is not None:
+          response["updated_at"] = stats.updated_at.strftime(constants.DATE_TIME_FMT)
+        return response, None
+
+    async def _enqueue(self, function, *args, job_id):
+        """
+        Queue a job for the worker, returning whether it was queued.
+        """
+        try:
+          job = await self.redis_queue.enqueue_job(function, *args, _job_id=job_id)
+        except Exception as e:
+          utils.logger.info("enqueue exception: {}\n".format(e))
+          return False
+        return job is not None # None if the job id was taken
+
+    async def offload(self, discussion_id, event, operation, sid):
+        """
+        Queues an operation for the worker, which sends `job_done` to the
+        client and the operation's emits to the rest of the discussion.
+        """
+        if not self.gm.cache_manager.has_discussion(discussion_id):
+          return Errors.BAD_DISCUSSION_ID
+        job_id = uuid.uuid4().hex
+        if not await self._enqueue("run_operation", event, operation, sid,
+            job_id=job_id):
+          return Errors.JOB_NOT_QUEUED
+        response = {"job_id": job_id}
+        return response, None
+
+    async def export(self, discussion_id, format, sid):
+        """
+        Queues an export of the document. The worker sends `exported` to
+        the client once the file is written.
+        """
+        if not self.gm.cache_manager.has_discussion(discussion_id):
+          return Errors.BAD_DISCUSSION_ID
+        export_id = uuid.uuid4().hex
+        if not await self._enqueue("export_document", discussion_id, format,
+            export_id, sid, job_id=export_id):
+          return Errors.JOB_NOT_QUEUED
+        response = {"export_id": export_id}
+        return response, None
 
     def test(self, a):
       return a
@@ -1032,25 +1538,3 @@ class DiscussionManager:
       job = await self.redis_queue.enqueue_job("test", 4)
       print("2")
       print("result", await job.result(timeout=3))
-
-#     def export_unit_tree(self, unit_id):
-# 
-#     def export_units(self, units, method):
-#       """
-#       method = doc, pdf, raw, html
-#       """
-#       doc = []
-#       for unit_id in units:
-#         doc.append(self.export_unit_tree(unit_id))
-#       # process doc according to method
-#       # call function to upload
-# 
-#     def export_document(self, discussion_id, method):
-#       """
-#       method = doc, pdf, raw, html
-#       """
-#       discussion = self._get(discussion_id).get()
-#       root = discussion.document
-#       doc = self.export_unit_tree(root)
-#       # process doc according to method
-#       # call function to upload
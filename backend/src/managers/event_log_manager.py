@@ -0,0 +1,103 @@
+"""
+A bounded log of the events broadcast to each discussion, kept in a redis
+stream, so a client that reconnects is sent only what it missed instead of
+the whole discussion again.
+
+Each event gets the next sequence number of its discussion, which is also
+its ID in the stream, so the missed events are one range read. The counter
+outlives the stream, so a number is never reused.
+"""
+
+from json import dumps, loads
+
+import redis
+
+import constants
+from utils.utils import (
+  logger,
+  DictEncoder,
+)
+
+
+# number the event and add it to the log in one step
+APPEND_SCRIPT = """
+local seq = redis.call("INCR", KEYS[1])
+redis.call("XADD", KEYS[2], "MAXLEN", "~", ARGV[1], seq .. "-0",
+  "event", ARGV[2], "shared", ARGV[3])
+redis.call("EXPIRE", KEYS[2], ARGV[4])
+return seq
+"""
+
+
+class EventLogManager:
+
+    def __init__(self, gm):
+        self.gm = gm
+        self.appended = 0
+        self.resyncs = 0
+        self.full_resyncs = 0
+
+        self.redis = redis.Redis.from_url(constants.SOCKET_REDIS)
+        self.append_script = self.redis.register_script(APPEND_SCRIPT)
+
+    def _keys(self, discussion_id):
+        prefix = "{}:{}".format(constants.EVENT_LOG_PREFIX, discussion_id)
+        return [prefix + ":seq", prefix + ":log"]
+
+    def append(self, discussion_id, event, shared):
+        """
+        Returns the sequence number of the event, or None if it could not
+        be logged.
+        """
+        try:
+          seq = self.append_script(
+            keys=self._keys(discussion_id),
+            args=[constants.EVENT_LOG_MAX, event, dumps(shared, cls=DictEncoder),
+              constants.EVENT_LOG_TTL]
+          )
+        except redis.RedisError as e:
+          logger.info("event log exception: {}\n".format(e))
+          return None
+        self.appended += 1
+        return int(seq)
+
+    def latest(self, discussion_id):
+        try:
+          seq = self.redis.get(self._keys(discussion_id)[0])
+        except redis.RedisError as e:
+          logger.info("event log exception: {}\n".format(e))
+          return None
+        return int(seq or 0)
+
+    def since(self, discussion_id, seq):
+        """
+        (events after `seq`, latest sequence number), or None if some of
+        them are no longer logged or there are too many to be worth sending.
+        """
+        seq_key, log_key = self._keys(discussion_id)
+        try:
+          # read together, so the log holds every event up to the latest
+          pipe = self.redis.pipeline(transaction=True)
+          pipe.get(seq_key)
+          pipe.xrange(log_key, min="{}-0".format(seq + 1),
+            count=constants.EVENT_LOG_MAX_RESYNC + 1)
+          latest, entries = pipe.execute()
+        except redis.RedisError as e:
+          logger.info("event log exception: {}\n".format(e))
+          return None
+        latest = int(latest or 0)
+
+        events = []
+        for expected, (entry_id, fields) in enumerate(entries, seq + 1):
+          # trimmed away, or never logged
+          if int(entry_id.split(b"-")[0]) != expected:
+            return None
+          events.append({
+            "seq": expected,
+            "event": fields[b"event"].decode(),
+            "shared": loads(fields[b"shared"])
+          })
+        if len(events) > constants.EVENT_LOG_MAX_RESYNC or \
+          seq + len(events) != latest:
+          return None
+        return events, latest
@@ -6,8 +6,16 @@ import mongoengine
 import socketio
 
 import constants
+from managers.admission_manager import AdmissionManager
+from managers.archive_manager import ArchiveManager
 from managers.board_manager import BoardManager
+from managers.cache_manager import CacheManager
+from managers.client_manager import DiscussionClientManager
+from managers.cursor_manager import CursorManager
 from managers.discussion_manager import DiscussionManager
+from managers.event_log_manager import EventLogManager
+from managers.search_manager import SearchManager
+from managers.stats_manager import StatsManager
 
 from models.discussion import (
   Unit,
@@ -17,7 +25,7 @@ from models.discussion import (
 class GlobalManager:
 
     def __init__(self):
-        mgr = socketio.AsyncRedisManager(constants.SOCKET_REDIS)
+        mgr = DiscussionClientManager(constants.SOCKET_REDIS)
         # need this to define app
         self.sio = socketio.AsyncServer(
             async_mode='aiohttp',
@@ -38,6 +46,13 @@ class GlobalManager:
         Unit.create_index([('pith', 'text')])
 
         # these get all the other variables
+        self.cache_manager = CacheManager(self)
+        self.search_manager = SearchManager(self)
+        self.archive_manager = ArchiveManager(self)
+        self.stats_manager = StatsManager(self)
+        self.event_log_manager = EventLogManager(self)
+        self.cursor_manager = CursorManager(self)
         self.discussion_manager = DiscussionManager(self)
         self.board_manager = BoardManager(self)
+        self.admission_manager = AdmissionManager(self)
 
@@ -0,0 +1,106 @@
+"""
+Per-discussion inverted indexes kept in memory, so searches do not go to the
+database. An index is built from Mongo the first time its discussion is
+searched and then kept up to date as units are written.
+"""
+
+from collections import OrderedDict
+import threading
+
+import constants
+from utils.utils import logger
+from search.search import DiscussionIndex
+
+from models.discussion import Unit
+
+
+class SearchManager:
+
+    def __init__(self, gm):
+        self.gm = gm
+        # discussion id -> index, least recently searched first
+        self.indexes = OrderedDict()
+        # unit ids changed by other instances, to reindex before searching
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.gm.cache_manager.listeners.append(self.mark_dirty)
+
+    def _build(self, discussion_id):
+        index = DiscussionIndex()
+        units = Unit.objects(discussion=discussion_id).only(
+          "id", "pith", "created_at", "term_freqs", "token_count")
+        untokenized = []
+        for u in units:
+          if u.token_count > 0 or u.pith == "":
+            index.add_freqs(u.id, u.term_freqs, u.created_at)
+          else: # written before token counts were stored
+            untokenized.append((u.id, u.pith, u.created_at))
+        index.add_many(untokenized)
+        self.indexes[discussion_id] = index
+        while len(self.indexes) > constants.SEARCH_MAX_DISCUSSIONS:
+          self.indexes.popitem(last=False)
+        return index
+
+    def _refresh(self):
+        """
+        Reindex units other instances changed.
+        """
+        with self.lock:
+          dirty, self.dirty = self.dirty, set()
+        if len(dirty) > constants.SEARCH_MAX_DIRTY:
+          self.indexes.clear() # cheaper to rebuild on demand
+          return
+        for unit_id in dirty:
+          try:
+            unit = self.gm.cache_manager.get_unit(unit_id)
+          except Unit.DoesNotExist: # deleted or archived
+            self.remove_unit(unit_id)
+            continue
+          self.index_unit(unit)
+
+    def mark_dirty(self, unit_ids):
+        """
+        NOTE: Called from the cache invalidation thread.
+        """
+        with self.lock:
+          self.dirty.update(unit_ids)
+
+    def index_unit(self, unit):
+        index = self.indexes.get(unit.discussion)
+        if index is None:
+          return
+        if unit.token_count > 0 or unit.pith == "":
+          index.add_freqs(unit.id, unit.term_freqs, unit.created_at)
+        else:
+          index.add(unit.id, unit.pith, unit.created_at)
+
+    def remove_unit(self, unit_id):
+        # the discussion of a deleted unit is not known
+        for index in self.indexes.values():
+          index.remove(unit_id)
+
+    def _index(self, discussion_id):
+        self._refresh()
+        index = self.indexes.get(discussion_id)
+        if index is None:
+          index = self._build(discussion_id)
+        else:
+          self.indexes.move_to_end(discussion_id)
+        return index
+
+    def typeahead(self, discussion_id, query, limit, keep):
+        try:
+          return self._index(discussion_id).typeahead(query, limit, keep)
+        except Exception as e:
+          logger.info("typeahead exception: {}\n".format(e))
+          return []
+
+    def search(self, discussion_id, query, limit=None):
+        """
+        The best `limit` unit ids ranked, or None if the index could not be used.
+        """
+        try:
+          return self._index(discussion_id).search(query, limit)
+        except Exception as e:
+          logger.info("search index exception: {}\n".format(e))
+          return None
@@ -0,0 +1,97 @@
+"""
+Rollups of how long users spent on each unit, so analytics do not scan
+every timeline interval. The worker adds the intervals recorded since the
+last rollup into per-unit and per-user totals, which are then read as they
+are.
+"""
+
+from datetime import datetime
+
+from mongoengine.queryset.visitor import Q
+import numpy as np
+import pandas as pd
+
+from utils.utils import logger
+
+from models.discussion import (
+  Discussion,
+  DiscussionStats,
+)
+
+
+class StatsManager:
+
+    def __init__(self, gm):
+        self.gm = gm
+
+    def pending(self, since):
+        """
+        Discussions that may have new timeline intervals: those active since
+        `since` and those with anyone still in them.
+        """
+        discussions = Discussion.objects(
+          Q(last_active__gte=since) | Q(users__active=True)
+        ).only("id")
+        return [d.id for d in discussions]
+
+    def rollup(self, discussion_id):
+        """
+        Adds the timeline intervals not counted yet. Returns how many.
+        """
+        discussion = Discussion.objects(id=discussion_id).only("users").first()
+        if discussion is None:
+          return 0
+        stats = DiscussionStats.objects(id=discussion_id).only("rolled_up").first()
+        rolled_up = stats.rolled_up if stats is not None else {}
+
+        rows = []
+        counted = {}
+        names = {}
+        for user in discussion.users:
+          start = rolled_up.get(user.id, 0)
+          for interval in user.timeline[start:]:
+            rows.append((user.id, interval.unit_id, interval.start_time,
+              interval.end_time))
+          counted[user.id] = len(user.timeline)
+          names[user.id] = user.name
+        if len(rows) == 0:
+          return 0
+
+        frame = pd.DataFrame(rows, 
+          columns=["user_id", "unit_id", "start_time", "end_time"])
+        frame["seconds"] = ((frame.end_time - frame.start_time) / \
+          np.timedelta64(1, "s")).clip(lower=0)
+
+        inc = {}
+        set_ = {"updated_at": datetime.utcnow()}
+        for key, field in (("units", "unit_id"), ("users", "user_id")):
+          totals = frame.groupby(field)["seconds"].agg(["sum", "count"])
+          for id, seconds, visits in zip(totals.index, totals["sum"], totals["count"]):
+            inc["{}.{}.seconds".format(key, id)] = float(seconds)
+            inc["{}.{}.visits".format(key, id)] = int(visits)
+        for user_id, count in counted.items():
+          set_["users.{}.name".format(user_id)] = names[user_id]
+          set_["rolled_up.{}".format(user_id)] = count
+
+        #### MONGO
+        # the totals and what they count change together
+        DiscussionStats._get_collection().update_one({"_id": discussion_id},
+          {"$inc": inc, "$set": set_}, upsert=True)
+        #### MONGO
+        return len(frame)
+
+    def rollup_pending(self, since):
+        total = 0
+        for discussion_id in self.pending(since):
+          try:
+            total += self.rollup(discussion_id)
+          except Exception as e:
+            logger.info("stats rollup exception: {}\n".format(e))
+        return total
+
+    def get(self, discussion_id):
+        """
+        NOTE: One read of precomputed totals, however long the timelines.
+        """
+        return DiscussionStats.objects(id=discussion_id) \
+          .only("units", "users", "updated_at").first()
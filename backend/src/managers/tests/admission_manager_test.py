@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import threading
+import time
+import unittest
+from unittest import mock
+
+from error import Errors
+from managers.admission_manager import AdmissionManager
+
+
+class AdmissionManagerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.gm = mock.Mock()
+        self.gm.archive_manager.restore.return_value = False
+        self.admission_manager = AdmissionManager(self.gm)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.log = logging.getLogger("AdmissionManagerTest")
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def test_limits(self) -> None:
+        lock = threading.Lock()
+        running = {"now": 0, "most": 0}
+
+        def slow_restore(discussion_id):
+            with lock:
+              running["now"] += 1
+              running["most"] = max(running["most"], running["now"])
+            time.sleep(0.05)
+            with lock:
+              running["now"] -= 1
+            return False
+        self.gm.archive_manager.restore.side_effect = slow_restore
+
+        async def storm(count):
+            return await asyncio.gather(*[self.admission_manager.run(
+              lambda discussion_id, value: value, discussion_id="a", value=i) 
+              for i in range(count)])
+
+        with mock.patch.multiple("constants", ADMISSION_PER_DISCUSSION=2,
+            ADMISSION_MAX_QUEUE=100, ADMISSION_WAIT=5):
+          results = self.loop.run_until_complete(storm(6))
+        self.assertEqual(results, list(range(6)))
+        self.assertEqual(running["most"], 2)
+        self.assertEqual(self.admission_manager.admitted, 6)
+        # idle discussions are forgotten
+        self.assertEqual(self.admission_manager.rooms, {})
+
+    def test_overloaded(self) -> None:
+        def slow_restore(discussion_id):
+            time.sleep(0.1)
+            return False
+        self.gm.archive_manager.restore.side_effect = slow_restore
+
+        def slow(discussion_id):
+            return None, None
+
+        async def storm():
+            return await asyncio.gather(*[self.admission_manager.run(
+              slow, discussion_id="a") for _ in range(4)])
+
+        # one runs, one waits past the deadline, two find the line full
+        with mock.patch.multiple("constants", ADMISSION_PER_DISCUSSION=1,
+            ADMISSION_MAX_QUEUE=1, ADMISSION_WAIT=0.05):
+          results = self.loop.run_until_complete(storm())
+        self.assertEqual(results[0], (None, None))
+        self.assertEqual(results[1:], [Errors.OVERLOADED] * 3)
+        self.assertEqual(self.admission_manager.rejected, 3)
+
+        # other discussions are not held up
+        result = self.loop.run_until_complete(
+          self.admission_manager.run(slow, discussion_id="b"))
+        self.assertEqual(result, (None, None))
+
+    def test_alongside_batch(self) -> None:
+        log = []
+
+        def slow_restore(discussion_id):
+            time.sleep(0.02)
+            return False
+        self.gm.archive_manager.restore.side_effect = slow_restore
+
+        def join(discussion_id):
+            log.append("join")
+
+        async def batch():
+            await asyncio.sleep(0.01)
+            log.append("batch started")
+            time.sleep(0.05) # on the loop, like every other event
+            log.append("batch done")
+
+        async def both():
+            await asyncio.gather(
+              self.admission_manager.run(join, discussion_id="a"), batch())
+
+        # restored meanwhile, but joined only once the batch is done
+        self.loop.run_until_complete(both())
+        self.assertEqual(log, ["batch started", "batch done", "join"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
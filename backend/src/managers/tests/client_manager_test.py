@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import time
+import unittest
+import uuid
+
+import constants
+from managers.client_manager import DiscussionClientManager
+
+
+class ClientManagerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.local = DiscussionClientManager(constants.SOCKET_REDIS)
+        self.remote = DiscussionClientManager(constants.SOCKET_REDIS)
+        self.room = uuid.uuid4().hex
+        self.log = logging.getLogger("ClientManagerTest")
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def _settle(self, manager) -> None:
+        tasks = list(manager.room_tasks.values())
+        if len(tasks) > 0:
+          self.loop.run_until_complete(asyncio.wait(tasks))
+
+    def test_room_hosts(self) -> None:
+        namespace = "/discussion"
+        run = self.loop.run_until_complete
+        # not known until read
+        self.assertEqual(self.local._room_hosts(namespace, self.room), None)
+        run(self.local._refresh(namespace, self.room))
+        self.assertEqual(self.local._room_hosts(namespace, self.room), [])
+
+        self.local.connect("a", namespace)
+        self.local.enter_room("a", namespace, self.room)
+        self._settle(self.local)
+        self.assertEqual(self.local._room_hosts(namespace, self.room),
+          [self.local.host_id])
+        # client rooms are not tracked
+        self.assertFalse((namespace, "a") in self.local.hosted)
+
+        # members on another instance need the room channel
+        self.remote.connect("b", namespace)
+        self.remote.enter_room("b", namespace, self.room)
+        self._settle(self.remote)
+        run(self.local._refresh(namespace, self.room))
+        self.assertEqual(set(self.local._room_hosts(namespace, self.room)),
+          set([self.local.host_id, self.remote.host_id]))
+
+        # told without reading again
+        self.local._on_room_host({"namespace": namespace, "room": self.room,
+          "host_id": self.remote.host_id, "present": False})
+        self.assertEqual(self.local._room_hosts(namespace, self.room),
+          [self.local.host_id])
+
+        # instances that stop beating are left out
+        key = self.local._room_key(namespace, self.room)
+        conn = run(self.local._connection())
+        run(conn.hset(key, "crashed", time.time() - constants.ROOM_HOSTS_TTL - 1))
+        self.remote.disconnect("b", namespace)
+        self._settle(self.remote)
+        run(self.local._refresh(namespace, self.room))
+        self.assertEqual(self.local._room_hosts(namespace, self.room),
+          [self.local.host_id])
+
+        run(conn.hdel(key, "crashed"))
+        self.local.disconnect("a", namespace)
+        self._settle(self.local)
+        self.assertEqual(run(conn.hgetall(key)), {})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -2,6 +2,7 @@ import asyncio
 import logging
 import time
 import unittest
+from unittest import mock
 
 from error import Errors
 from managers.global_manager import GlobalManager
@@ -335,6 +336,54 @@ class DiscussionManagerTest(unittest.TestCase):
         )[0]
         self.assertEqual(len(res["chat_units"]), 0)
         self.assertEqual(len(res["doc_units"]), 2)
+        # units with both terms rank first
+        self.assertEqual(res["doc_units"][0]["unit_id"], unit_id1)
+
+        # the index follows edits
+        self.discussion_manager.request_to_edit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id2)
+        self.discussion_manager.edit_unit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id2,
+          pith="I really like whales.")
+        res = self.discussion_manager.search(
+          discussion_id=discussion_id, query="whale"
+        )[0]
+        self.assertEqual(len(res["doc_units"]), 2)
+        res = self.discussion_manager.search(
+          discussion_id=discussion_id, query="monkey"
+        )[0]
+        self.assertEqual([d["unit_id"] for d in res["doc_units"]], [unit_id1])
+
+        # pages, without hidden units
+        res = self.discussion_manager.search(
+          discussion_id=discussion_id, query="whale", limit=1, offset=1
+        )[0]
+        self.assertEqual(len(res["doc_units"]), 1)
+        self.assertEqual(len(res["doc_meta"]), 1)
+        self.discussion_manager.hide_unit(
+          discussion_id=discussion_id, unit_id=unit_id2)
+        res = self.discussion_manager.search(
+          discussion_id=discussion_id, query="whale"
+        )[0]
+        self.assertEqual([d["unit_id"] for d in res["doc_units"]], [unit_id1])
+        # ranked further when hidden units fill the places ranked
+        with mock.patch("constants.SEARCH_OVERFETCH", 0):
+          for offset, expected in [(0, [unit_id1]), (1, [])]:
+            res = self.discussion_manager.search(discussion_id=discussion_id, 
+              query="whale", limit=1, offset=offset)[0]
+            self.assertEqual([d["unit_id"] for d in res["doc_units"]], expected)
+
+        # units deleted elsewhere are skipped, then dropped from the index
+        search_manager = self.discussion_manager.gm.search_manager
+        Unit.objects(id=unit_id1).delete()
+        self.discussion_manager.gm.cache_manager.drop_units([unit_id1])
+        res = self.discussion_manager.search(
+          discussion_id=discussion_id, query="whale"
+        )[0]
+        self.assertEqual(res["doc_units"], [])
+        search_manager.mark_dirty([unit_id1])
+        self.discussion_manager.search(discussion_id=discussion_id, query="whale")
+        self.assertFalse(unit_id1 in search_manager.indexes[discussion_id].units)
 
         self.discussion_manager.leave(
           discussion_id=discussion_id, user_id=user_id)
@@ -1181,6 +1230,554 @@ class DiscussionManagerTest(unittest.TestCase):
         self.discussion_manager.leave(
           discussion_id=discussion_id, user_id=user_id)
 
+    def test_doc_delta(self) -> None:
+        discussion_id = self.board_manager.create()["discussion_id"]
+        discussion = self.discussion_manager._get(discussion_id)
+        root = discussion.get().document
+
+        nickname = "whales"
+        user_id = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname=nickname)[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+
+        added = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="first", parent=root, position=0
+        )[1]
+        unit_id1 = added[0]["unit_id"]
+        doc_delta = {d["unit_id"]: d for d in added[3]}
+        self.assertEqual(doc_delta[unit_id1]["from_version"], None)
+        self.assertEqual(doc_delta[unit_id1]["fields"]["pith"], "first")
+        self.assertEqual(doc_delta[root]["from_version"], 0)
+        self.assertEqual(doc_delta[root]["version"], 1)
+        self.assertEqual(doc_delta[root]["children"], 
+          [{"op": "insert", "position": 0, "units": [unit_id1]}])
+
+        added = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="second", parent=root, position=1
+        )[1]
+        unit_id2 = added[0]["unit_id"]
+        doc_delta = {d["unit_id"]: d for d in added[3]}
+        self.assertEqual(doc_delta[root]["from_version"], 1)
+        self.assertEqual(doc_delta[root]["children"], 
+          [{"op": "insert", "position": 1, "units": [unit_id2]}])
+
+        # only changed fields are sent
+        self.discussion_manager.request_to_edit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id1)
+        res = self.discussion_manager.edit_unit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id1, 
+          pith="<cite>{}</cite>".format(unit_id2))[1]
+        doc_delta = {d["unit_id"]: d for d in res[2]}
+        self.assertEqual(doc_delta[unit_id1]["fields"], 
+          {"pith": "<cite>{}</cite>".format(unit_id2)})
+        self.assertEqual(doc_delta[unit_id2]["fields"], {})
+        self.assertEqual(doc_delta[unit_id2]["backlinks"], 
+          [{"op": "insert", "position": 0, "units": [unit_id1]}])
+
+        # full doc_meta to resync
+        res = self.discussion_manager.get_doc_meta(
+          discussion_id=discussion_id, units=[unit_id1])[0]
+        self.assertEqual(res["doc_meta"][0]["version"], 
+          doc_delta[unit_id1]["version"])
+
+        self.discussion_manager.leave(
+          discussion_id=discussion_id, user_id=user_id)
+
+    def test_batch(self) -> None:
+        discussion_id = self.board_manager.create()["discussion_id"]
+        discussion = self.discussion_manager._get(discussion_id)
+        root = discussion.get().document
+
+        nickname = "whales"
+        user_id = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname=nickname)[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+
+        unit_id1 = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="", parent=root, position=0
+        )[1][0]["unit_id"]
+        unit_id2 = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="", parent=root, position=1
+        )[1][0]["unit_id"]
+
+        res, emits = self.discussion_manager.batch(
+          discussion_id=discussion_id, user_id=user_id, operations=[
+            {"event": "select_unit", "request": {"unit_id": unit_id2}},
+            {"event": "move_units", "request": 
+              {"units": [unit_id2], "parent": unit_id1, "position": 0}},
+            {"event": "move_cursor", "request": {"unit_id": unit_id1, "position": 0}},
+          ]
+        )
+        self.assertEqual(res["results"], [
+          {"event": "select_unit"}, {"event": "move_units"}, {"event": "move_cursor"}
+        ])
+        doc_meta, chat_meta, doc_delta, events = emits
+        self.assertEqual(len(doc_meta), len(set([d["unit_id"] for d in doc_meta])))
+        self.assertEqual(
+          self.discussion_manager._get_unit(unit_id1).get().children, [unit_id2])
+        # deltas of both operations are merged into one
+        doc_delta = {d["unit_id"]: d for d in doc_delta}
+        self.assertEqual(doc_delta[unit_id2]["fields"], {})
+        self.assertEqual(doc_delta[unit_id2]["version"] - doc_delta[unit_id2]["from_version"], 3)
+        # the cursor is held like a single move
+        self.assertEqual([e["event"] for e in events], ["select_unit", "move_units"])
+        cursor_manager = self.discussion_manager.gm.cursor_manager
+        self.assertEqual(cursor_manager.pending[(discussion_id, user_id)][1]
+          ["cursor"]["unit_id"], unit_id1)
+
+        # stops at first error
+        res = self.discussion_manager.batch(
+          discussion_id=discussion_id, user_id=user_id, operations=[
+            {"event": "move_units", "request": 
+              {"units": [unit_id2], "parent": root, "position": 0}},
+            {"event": "hide_unit", "request": {"unit_id": unit_id1}},
+          ]
+        )[0]
+        self.assertEqual(res["results"], 
+          [{"event": "move_units", "error": Errors.BAD_POSITION_TRY.value}])
+        self.assertFalse(self.discussion_manager._get_unit(unit_id1).get().hidden)
+
+        self.discussion_manager.leave(
+          discussion_id=discussion_id, user_id=user_id)
+
+    def test_hold_cursor(self) -> None:
+        discussion_id = self.board_manager.create()["discussion_id"]
+        discussion = self.discussion_manager._get(discussion_id)
+        root = discussion.get().document
+        cursor_manager = self.discussion_manager.gm.cursor_manager
+
+        nickname = "whales"
+        user_id = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname=nickname)[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+
+        added = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="", parent=root, position=0
+        )[1][0]
+        unit_id = added["unit_id"]
+
+        res = self.discussion_manager.hold_cursor(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id, position=5
+        )
+        self.assertEqual(res, Errors.BAD_POSITION)
+
+        self.discussion_manager.hold_cursor(
+          discussion_id=discussion_id, user_id=user_id, unit_id=root, position=0
+        )
+        res = self.discussion_manager.hold_cursor(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id, position=0
+        )[1][0]
+        self.assertEqual(res["cursor"]["unit_id"], unit_id)
+
+        # only the latest is held, and nothing is written yet
+        self.assertEqual(len(cursor_manager.pending), 1)
+        user = discussion.get().users.filter(id=user_id).get()
+        self.assertEqual(user.cursor.unit_id, root)
+
+        cursor_manager.persist(discussion_id=discussion_id)
+        user = discussion.get().users.filter(id=user_id).get()
+        self.assertEqual(user.cursor.unit_id, unit_id)
+        self.assertEqual(user.cursor.position, 0)
+
+        # held cursors are saved on leave, and not broadcast afterwards
+        self.discussion_manager.hold_cursor(
+          discussion_id=discussion_id, user_id=user_id, unit_id=root, position=1
+        )
+        self.discussion_manager.leave(
+          discussion_id=discussion_id, user_id=user_id)
+        self.assertEqual(len(cursor_manager.pending), 0)
+        user = discussion.get().users.filter(id=user_id).get()
+        self.assertEqual(user.cursor.unit_id, root)
+        self.assertEqual(user.cursor.position, 1)
+
+
+    def test_cache(self) -> None:
+        cache_manager = self.discussion_manager.gm.cache_manager
+        discussion_id = self.board_manager.create()["discussion_id"]
+        discussion = self.discussion_manager._get(discussion_id)
+        root = discussion.get().document
+
+        nickname = "whales"
+        user_id = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname=nickname)[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+
+        unit_id = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="first", parent=root, position=0
+        )[1][0]["unit_id"]
+
+        # new units and their parents are written through
+        self.assertEqual(cache_manager.get_unit(unit_id).pith, "first")
+        self.assertEqual(cache_manager.get_unit(root).children, [unit_id])
+
+        hits = cache_manager.hits
+        res = self.discussion_manager.get_unit_content(
+          discussion_id=discussion_id, unit_id=unit_id)[0]
+        self.assertEqual(res["pith"], "first")
+        self.assertTrue(cache_manager.hits > hits)
+
+        # cached copy follows edits
+        old = Unit.objects.get(id=unit_id)
+        self.discussion_manager.request_to_edit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id)
+        self.discussion_manager.edit_unit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id, 
+          pith="second")
+        unit = cache_manager.get_unit(unit_id)
+        self.assertEqual(unit.pith, "second")
+        self.assertEqual(unit.version, Unit.objects.get(id=unit_id).version)
+
+        # a slow reader does not put back an older copy
+        cache_manager._put(("unit", unit_id), old, cache_manager._sizeof(old), 
+          old.version)
+        self.assertEqual(cache_manager.get_unit(unit_id).pith, "second")
+        # nor into the place of a copy dropped for a newer version
+        cache_manager._drop(("unit", unit_id), unit.version)
+        cache_manager._put(("unit", unit_id), old, cache_manager._sizeof(old), 
+          old.version)
+        self.assertEqual(cache_manager._lookup(("unit", unit_id)), None)
+
+        # other instances are served the shared copy
+        cache_manager._drop(("unit", unit_id))
+        shared_hits = cache_manager.shared_hits
+        self.assertEqual(cache_manager.get_unit(unit_id).pith, "second")
+        self.assertEqual(cache_manager.shared_hits, shared_hits + 1)
+
+        # dropped entries are read again
+        cache_manager.drop_units([unit_id])
+        self.assertEqual(cache_manager.get_unit(unit_id).pith, "second")
+        self.assertEqual(cache_manager.shared_hits, shared_hits + 1)
+
+    def test_typeahead(self) -> None:
+        discussion_id = self.board_manager.create()["discussion_id"]
+        discussion = self.discussion_manager._get(discussion_id)
+        root = discussion.get().document
+        nickname = "whales"
+        user_id = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname=nickname)[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+
+        unit_id1 = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="Monkeys swing.", parent=root, position=0
+        )[1][0]["unit_id"]
+        res = self.discussion_manager.typeahead(
+          discussion_id=discussion_id, query="monk")[0]
+        self.assertEqual([u["unit_id"] for u in res["units"]], [unit_id1])
+        self.assertEqual(res["units"][0]["pith"], "Monkeys swing.")
+
+        # new units and edits are picked up
+        unit_id2 = self.discussion_manager.post(
+          discussion_id=discussion_id, user_id=user_id, pith="Monkeys nap."
+        )[1][0]["unit_id"]
+        res = self.discussion_manager.typeahead(
+          discussion_id=discussion_id, query="monkeys n")[0]
+        self.assertEqual([u["unit_id"] for u in res["units"]], [unit_id2])
+        self.assertTrue(res["units"][0]["in_chat"])
+
+        self.discussion_manager.request_to_edit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id1)
+        self.discussion_manager.edit_unit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id1,
+          pith="Apes swing.")
+        res = self.discussion_manager.typeahead(
+          discussion_id=discussion_id, query="monk")[0]
+        self.assertEqual([u["unit_id"] for u in res["units"]], [unit_id2])
+
+    def test_token_stats(self) -> None:
+        discussion_id = self.board_manager.create()["discussion_id"]
+        discussion = self.discussion_manager._get(discussion_id)
+        root = discussion.get().document
+        user_id = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname="whales")[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+
+        unit_id1 = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="Whales sing to whales.", parent=root, position=0
+        )[1][0]["unit_id"]
+        unit = Unit.objects.get(id=unit_id1)
+        self.assertEqual(unit.term_freqs, {"whale": 2, "sing": 1, "to": 1})
+        self.assertEqual(unit.token_count, 4)
+
+        post_id = self.discussion_manager.post(
+          discussion_id=discussion_id, user_id=user_id, pith="Whales nap."
+        )[1][0]["unit_id"]
+        self.assertEqual(Unit.objects.get(id=post_id).term_freqs, 
+          {"whale": 1, "nap": 1})
+
+        # edits replace them
+        self.discussion_manager.request_to_edit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id1)
+        self.discussion_manager.edit_unit(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id1,
+          pith="Apes sing.")
+        unit = Unit.objects.get(id=unit_id1)
+        self.assertEqual(unit.term_freqs, {"ape": 1, "sing": 1})
+        self.assertEqual(unit.token_count, 2)
+
+    def test_archive(self) -> None:
+        archive_manager = self.discussion_manager.gm.archive_manager
+        discussion_id = self.board_manager.create()["discussion_id"]
+        discussion = self.discussion_manager._get(discussion_id)
+        root = discussion.get().document
+        user_id = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname="whales")[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+        unit_id = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="Whales sing.", parent=root, position=0
+        )[1][0]["unit_id"]
+
+        # someone is still in it
+        self.assertFalse(discussion_id in archive_manager.cold(days=0))
+        self.discussion_manager.leave(
+          discussion_id=discussion_id, user_id=user_id)
+        self.assertTrue(discussion_id in archive_manager.cold(days=0))
+        self.assertFalse(discussion_id in archive_manager.cold(days=1))
+
+        stored = archive_manager.stored_bytes()
+        size = archive_manager.archive(discussion_id)
+        self.assertTrue(size > 0)
+        self.assertTrue(archive_manager.is_archived(discussion_id))
+        # kept up to date without reading the directory again
+        self.assertEqual(archive_manager.stored_bytes(), stored + size)
+        self.assertEqual(len(Discussion.objects(id=discussion_id)), 0)
+        self.assertEqual(len(Unit.objects(discussion=discussion_id)), 0)
+
+        # comes back as it was on connecting
+        res = self.discussion_manager.test_connect(discussion_id=discussion_id)
+        self.assertEqual(res, (None, None))
+        self.assertFalse(archive_manager.is_archived(discussion_id))
+        self.assertEqual(Unit.objects.get(id=unit_id).pith, "Whales sing.")
+        self.assertEqual(discussion.get().users[0].name, "whales")
+        self.assertEqual(len(discussion.get().users[0].timeline), 1)
+        self.assertEqual(archive_manager.restores, 1)
+        self.assertEqual(archive_manager.stored_bytes(), stored)
+
+    def test_offload(self) -> None:
+        discussion_id = self.board_manager.create()["discussion_id"]
+        operation = {"discussion_id": discussion_id, "query": "whales"}
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(self.discussion_manager.offload(
+          discussion_id=discussion_id, event="search", operation=operation, 
+          sid="sid"))
+        self.assertEqual(len(res[0]["job_id"]), 32)
+        self.assertEqual(res[1], None)
+
+        res = loop.run_until_complete(self.discussion_manager.offload(
+          discussion_id="...", event="search", operation=operation, sid="sid"))
+        self.assertEqual(res, Errors.BAD_DISCUSSION_ID)
+
+        # the client is told when the job could not be queued
+        async def fail(*args, **kwargs):
+          raise ConnectionError("redis is down")
+        with mock.patch.object(self.discussion_manager.redis_queue, 
+            "enqueue_job", fail):
+          res = loop.run_until_complete(self.discussion_manager.export(
+            discussion_id=discussion_id, format="markdown", sid="sid"))
+        self.assertEqual(res, Errors.JOB_NOT_QUEUED)
+
+        # the worker runs them by name
+        for event in DiscussionManager._offload_operations:
+          self.assertTrue(callable(getattr(self.discussion_manager, event)))
+
+    def test_discussion_stats(self) -> None:
+        stats_manager = self.discussion_manager.gm.stats_manager
+        discussion_id = self.board_manager.create()["discussion_id"]
+        discussion = self.discussion_manager._get(discussion_id)
+        root = discussion.get().document
+        user_id = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname="whales")[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+        unit_id = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="Whales sing.", parent=root, position=0
+        )[1][0]["unit_id"]
+
+        res = self.discussion_manager.get_discussion_stats(
+          discussion_id=discussion_id)[0]
+        self.assertEqual(res, {"units": [], "users": []})
+
+        # one interval on the root, one on the unit
+        self.discussion_manager.load_unit_page(
+          discussion_id=discussion_id, user_id=user_id, unit_id=unit_id)
+        self.discussion_manager.leave(
+          discussion_id=discussion_id, user_id=user_id)
+        self.assertEqual(stats_manager.rollup(discussion_id), 2)
+        self.assertEqual(stats_manager.rollup(discussion_id), 0)
+
+        res = self.discussion_manager.get_discussion_stats(
+          discussion_id=discussion_id)[0]
+        self.assertEqual(sorted(u["unit_id"] for u in res["units"]), 
+          sorted([root, unit_id]))
+        self.assertEqual(res["users"][0]["nickname"], "whales")
+        self.assertEqual(res["users"][0]["visits"], 2)
+        self.assertTrue("updated_at" in res)
+
+        # only new intervals are added
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+        self.discussion_manager.leave(
+          discussion_id=discussion_id, user_id=user_id)
+        self.assertEqual(stats_manager.rollup(discussion_id), 1)
+        res = self.discussion_manager.get_discussion_stats(
+          discussion_id=discussion_id)[0]
+        self.assertEqual(res["users"][0]["visits"], 3)
+
+    def test_join_snapshot(self) -> None:
+        discussion_id = self.board_manager.create()["discussion_id"]
+        cache_manager = self.discussion_manager.gm.cache_manager
+        user_id1 = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname="whales")[0]["user_id"]
+        user_id2 = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname="apes")[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id1)
+        post_id = self.discussion_manager.post(
+          discussion_id=discussion_id, user_id=user_id1, pith="Whales sing."
+        )[1][0]["unit_id"]
+        version = self.discussion_manager._get(discussion_id).get().version
+
+        res1 = self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id2)[0]
+        self.assertEqual(res1["chat_history"], [post_id])
+        self.assertEqual(res1["chat_meta"][0]["author"], "whales")
+        self.assertEqual(res1["nickname"], "apes")
+        snapshot = cache_manager.get_snapshot(discussion_id, version)
+        self.assertEqual(snapshot["chat_history"], [post_id])
+
+        # the same version is served from the snapshot, per-user parts are not
+        res2 = self.discussion_manager.load_user(
+          discussion_id=discussion_id, user_id=user_id1)
+        self.assertTrue(res2["chat_meta"] is snapshot["chat_meta"])
+        self.assertEqual(res2["nickname"], "whales")
+
+        # writing a pith makes a new version
+        post_id2 = self.discussion_manager.post(
+          discussion_id=discussion_id, user_id=user_id2, pith="Apes nap."
+        )[1][0]["unit_id"]
+        self.assertEqual(
+          self.discussion_manager._get(discussion_id).get().version, version + 1)
+        res3 = self.discussion_manager.load_user(
+          discussion_id=discussion_id, user_id=user_id1)
+        self.assertEqual(res3["chat_history"], [post_id, post_id2])
+        self.assertEqual(len(res3["chat_meta"]), 2)
+
+        # other writes, like locks, do not
+        root = self.discussion_manager._get(discussion_id).get().document
+        self.discussion_manager.request_to_edit(
+          discussion_id=discussion_id, user_id=user_id1, unit_id=root)
+        self.assertEqual(
+          self.discussion_manager._get(discussion_id).get().version, version + 1)
+        res4 = self.discussion_manager.load_user(
+          discussion_id=discussion_id, user_id=user_id1)
+        self.assertTrue(res4["chat_meta"] is res3["chat_meta"])
+        # locks are not kept once built
+        self.assertEqual(len(self.discussion_manager.snapshot_locks), 0)
+
+    def test_resync(self) -> None:
+        discussion_id = self.board_manager.create()["discussion_id"]
+        event_log_manager = self.discussion_manager.gm.event_log_manager
+        user_id = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname="whales")[0]["user_id"]
+        self.discussion_manager.join(
+          discussion_id=discussion_id, user_id=user_id)
+        self.assertEqual(event_log_manager.latest(discussion_id), 0)
+
+        seqs = [event_log_manager.append(discussion_id, "post", {"n": i}) 
+          for i in range(3)]
+        self.assertEqual(seqs, [1, 2, 3])
+
+        # only what was missed
+        res = self.discussion_manager.resync(
+          discussion_id=discussion_id, user_id=user_id, seq=1)[0]
+        self.assertEqual(res["seq"], 3)
+        self.assertEqual([e["seq"] for e in res["events"]], [2, 3])
+        self.assertEqual(res["events"][0]["shared"], {"n": 1})
+        res = self.discussion_manager.resync(
+          discussion_id=discussion_id, user_id=user_id, seq=3)[0]
+        self.assertEqual(res["seq"], 3)
+        self.assertEqual(res["events"], [])
+
+        # cursor moves are not logged, so they come along
+        root = self.discussion_manager._get(discussion_id).get().document
+        self.discussion_manager.hold_cursor(discussion_id=discussion_id, 
+          user_id=user_id, unit_id=root, position=0)
+        res = self.discussion_manager.resync(
+          discussion_id=discussion_id, user_id=user_id, seq=3)[0]
+        self.assertEqual(res["cursors"][0]["user_id"], user_id)
+        self.assertEqual(res["cursors"][0]["cursor"]["position"], 0)
+
+        # too far behind, or ahead of the log, gets everything
+        with mock.patch("constants.EVENT_LOG_MAX_RESYNC", 1):
+          res = self.discussion_manager.resync(
+            discussion_id=discussion_id, user_id=user_id, seq=0)[0]
+        self.assertEqual(res["seq"], 3)
+        self.assertEqual(res["joined"]["nickname"], "whales")
+        res = self.discussion_manager.resync(
+          discussion_id=discussion_id, user_id=user_id, seq=10)[0]
+        self.assertTrue("joined" in res)
+
+        # a log that cannot be read covers nothing
+        with mock.patch.object(event_log_manager, "since", return_value=None), \
+          mock.patch.object(event_log_manager, "latest", return_value=None):
+          res = self.discussion_manager.resync(
+            discussion_id=discussion_id, user_id=user_id, seq=3)[0]
+        self.assertEqual(res["seq"], None)
+        self.assertTrue("joined" in res)
+
+    def test_optimistic_edit(self) -> None:
+        discussion_id = self.board_manager.create()["discussion_id"]
+        root = self.discussion_manager._get(discussion_id).get().document
+        user_id1 = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname="whales")[0]["user_id"]
+        user_id2 = self.discussion_manager.create_user(
+          discussion_id=discussion_id, nickname="apes")[0]["user_id"]
+        unit_id = self.discussion_manager.add_unit(
+          discussion_id=discussion_id, 
+          pith="Whales sing.", parent=root, position=0
+        )[1][0]["unit_id"]
+        version = Unit.objects.get(id=unit_id).version
+
+        # no lock needed for an edit to the current version
+        res = self.discussion_manager.edit_unit(discussion_id=discussion_id, 
+          user_id=user_id1, unit_id=unit_id, pith="Whales hum.", version=version)
+        self.assertEqual(res[1][0][0]["pith"], "Whales hum.")
+        unit = Unit.objects.get(id=unit_id)
+        self.assertEqual(unit.version, version + 1)
+        self.assertEqual(unit.term_freqs, {"whale": 1, "hum": 1})
+
+        # an edit to an older version gets the current one back
+        res = self.discussion_manager.edit_unit(discussion_id=discussion_id, 
+          user_id=user_id2, unit_id=unit_id, pith="Apes hum.", version=version)
+        self.assertEqual(res[0], Errors.EDIT_CONFLICT)
+        self.assertEqual(res[1]["pith"], "Whales hum.")
+        self.assertEqual(res[1]["version"], version + 1)
+
+        # nor can it be made while someone else holds the lock
+        self.discussion_manager.request_to_edit(
+          discussion_id=discussion_id, user_id=user_id1, unit_id=unit_id)
+        res = self.discussion_manager.edit_unit(discussion_id=discussion_id, 
+          user_id=user_id2, unit_id=unit_id, pith="Apes hum.", 
+          version=Unit.objects.get(id=unit_id).version)
+        self.assertEqual(res[0], Errors.EDIT_CONFLICT)
+        self.assertEqual(res[1]["edit_privilege"], user_id1)
+        self.assertEqual(Unit.objects.get(id=unit_id).pith, "Whales hum.")
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -150,6 +150,29 @@ class Unit(Document):
     :nullable: True
     """
 
+    # incremented on every change, to order doc_delta
+    version = IntField(default=0)
+    """
+    :type: *int*
+    :required: False
+    :default: 0
+    """
+
+    # stemmed term frequencies of pith, set whenever pith is written
+    term_freqs = DictField(default={})
+    """
+    :type: *Dict[str, int]*
+    :required: False
+    :default: {}
+    """
+
+    token_count = IntField(default=0)
+    """
+    :type: *int*
+    :required: False
+    :default: 0
+    """
+
 class Cursor(EmbeddedDocument):
     """
     Position of a user within a document for editing.
@@ -295,3 +318,63 @@ class Discussion(Document):
     :required: False
     :default: []
     """
+
+    # when anyone last joined, left or wrote, to find discussions to archive
+    last_active = DateTimeField(default=datetime.utcnow)
+    """
+    :type: *datetime*
+    :required: False
+    :default: Automatically generated.
+    """
+
+    # incremented whenever the chat or a pith shown with it changes, to tell
+    # when join snapshots are stale
+    version = IntField(default=0)
+    """
+    :type: *int*
+    :required: False
+    :default: 0
+    """
+
+
+class DiscussionStats(Document):
+    """
+    Time users spent on units, rolled up from their timelines by the worker.
+    """
+
+    meta = {'collection': 'discussion_stats'}
+
+    id = StringField(primary_key=True)
+    """
+    :type: *str*
+    :required: True
+    :default: None
+    """
+
+    units = DictField(default={}) # unit id -> seconds and visits
+    """
+    :type: *Dict[str, Dict[str, float]]*
+    :required: False
+    :default: {}
+    """
+
+    users = DictField(default={}) # user id -> name, seconds and visits
+    """
+    :type: *Dict[str, Dict[str, Any]]*
+    :required: False
+    :default: {}
+    """
+
+    rolled_up = DictField(default={}) # user id -> timeline intervals counted
+    """
+    :type: *Dict[str, int]*
+    :required: False
+    :default: {}
+    """
+
+    updated_at = DateTimeField()
+    """
+    :type: *datetime*
+    :required: False
+    :default: None
+    """
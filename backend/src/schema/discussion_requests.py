@@ -9,12 +9,16 @@ schema_names = [
   "test_connect",
   "create_user",
   "join",
+  "resync",
   "load_unit_page",
   "get_ancestors",
   "get_unit_content",
   "get_unit_context",
+  "get_doc_meta",
+  "get_discussion_stats",
   "post",
   "search",
+  "typeahead",
   "send_to_doc",
   "move_cursor",
   "hide_unit",
@@ -27,6 +31,8 @@ schema_names = [
   "request_to_edit",
   "deedit_unit",
   "edit_unit",
+  "batch",
+  "export",
 ]
 
 for schema_name in schema_names:
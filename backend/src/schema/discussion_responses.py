@@ -8,18 +8,29 @@ schema = {}
 schema_names = [
   "created_user",
   "joined_user",
+  "resynced",
   "left_user",
   "loaded_unit_page",
   "get_ancestors",
   "get_unit_content",
   "get_unit_context",
+  "get_doc_meta",
+  "get_discussion_stats",
   "created_post",
   "search",
+  "typeahead",
   "set_cursor",
   "added_unit",
   "sent_to_doc",
   "merged_units",
+  "batched",
+  "batched_events",
+  "export",
+  "exported",
+  "offloaded",
+  "job_done",
   "doc_meta",
+  "doc_delta",
   "chat_meta"
 ]
 
@@ -1,19 +1,30 @@
+from bisect import bisect_left, insort
 import math
 import nltk
 from nltk import pos_tag
-from nltk.stem import PorterStemmer
+import numpy as np
 from typing import (
+  Any,
   Callable,
   Dict,
   List,
+  Optional,
+  Tuple,
 )
 
-from models.discussion import Block
+import constants
 from utils import utils
 
 
 nltk.download('averaged_perceptron_tagger', quiet=True)
-ps = PorterStemmer()
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# the number of words a partly typed word is completed to
+TYPEAHEAD_MAX_TERMS = 50
+# rows allocated for an empty index
+INDEX_INITIAL_ROWS = 64
 
 
 # very rudimentary and misses things like pronouns and adverbs
@@ -34,10 +45,25 @@ def assign_pos_weight(cat: str) -> int:
         return 0
 
 
+def pos_weights(terms: List[str]) -> Dict[str, int]:
+    """
+    Weight of each query term by part of speech. Without the tagger, or if
+    no term is weighted, every term counts.
+    """
+    try:
+        weights = {w: assign_pos_weight(c) for w, c in pos_tag(terms)}
+    except LookupError:
+        weights = {}
+    if sum(weights.values()) == 0:
+        weights = {w: 1 for w in terms}
+    return weights
+
+
 def make_metric(key_word_list: List[str]) -> Callable[[Dict[str, int]], float]:
-    stemmed = [ps.stem(w) for w in key_word_list]
-    pos = pos_tag(stemmed)#key_word_list)
-    weights = {w: assign_pos_weight(c) for w, c in pos}
+    """
+    NOTE: key words should already be stemmed, as from `utils.text_tokens`.
+    """
+    weights = pos_weights(key_word_list)
 
     def metric(fd: Dict[str, int]) -> float:
         word_freq = {w: fd[w] for w in key_word_list if w in fd}
@@ -47,16 +73,232 @@ def make_metric(key_word_list: List[str]) -> Callable[[Dict[str, int]], float]:
     return metric
 
 
-def basic_search(query: str, blocks: List[Block]) -> List[str]:
+def basic_search(query: str, units: List[Any]) -> List[str]:
+    """
+    Rank anything with `freq_dict`, `created_at` and `id` by the query,
+    newest first among equals.
+    """
     key_word_list = list(set(utils.text_tokens(query)))
     metric = make_metric(key_word_list)
 
-    blocks_order = [(
-        metric(b.freq_dict),
-        b.created_at,
-        b.id
-    ) for b in blocks]
-    blocks_order.sort(reverse=True)
-    block_ids = [b for f, t, b in blocks_order if f > 0]
+    units_order = [(
+        metric(u.freq_dict),
+        u.created_at,
+        u.id
+    ) for u in units]
+    units_order.sort(reverse=True)
+    unit_ids = [u for f, t, u in units_order if f > 0]
+
+    return unit_ids
+
+
+def index_text(pith: str) -> str:
+    # citations are not part of what a unit says
+    return constants.LINK_PATTERN.sub(" ", pith)
+
+
+def token_stats(pith: str) -> Tuple[Dict[str, int], int]:
+    """
+    Term frequencies and token count of a pith, as stored on its unit.
+    """
+    freqs = utils.make_freq_dict(index_text(pith))
+    return freqs, sum(freqs.values())
+
+
+class DiscussionIndex:
+    """
+    Inverted index of the units of one discussion, scored with BM25 and
+    weighted by part of speech of the query terms.
+
+    Each unit has a row. The postings of each term are kept as arrays of
+    rows and frequencies, the columns of a sparse term-document matrix, so
+    a query is scored with a few vector operations per term.
+    """
+
+    def __init__(self) -> None:
+        # term -> unit id -> term frequency
+        self.postings: Dict[str, Dict[str, int]] = {}
+        # unit id -> (term frequencies, length, created at)
+        self.units: Dict[str, Tuple[Dict[str, int], int, Any]] = {}
+        self.total_length = 0
+        # sorted terms, for prefix lookups
+        self.vocabulary: List[str] = []
+
+        # unit id -> row, row -> unit id
+        self.rows: Dict[str, int] = {}
+        self.ids: List[Optional[str]] = []
+        self.free_rows: List[int] = []
+        # per row
+        self.lengths = np.zeros(INDEX_INITIAL_ROWS)
+        self.times = np.zeros(INDEX_INITIAL_ROWS)
+        # term -> (rows, frequencies), built when the term is next queried
+        self.columns: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self.units)
+
+    def _take_row(self, unit_id: str) -> int:
+        if len(self.free_rows) > 0:
+            row = self.free_rows.pop()
+            self.ids[row] = unit_id
+        else:
+            row = len(self.ids)
+            self.ids.append(unit_id)
+            if row == len(self.lengths):
+                self.lengths = np.concatenate([self.lengths, np.zeros(row)])
+                self.times = np.concatenate([self.times, np.zeros(row)])
+        self.rows[unit_id] = row
+        return row
+
+    def _column(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        column = self.columns.get(term)
+        if column is None:
+            posting = self.postings[term]
+            column = (
+                np.fromiter((self.rows[u] for u in posting), np.intp, len(posting)),
+                np.fromiter(posting.values(), np.float64, len(posting))
+            )
+            self.columns[term] = column
+        return column
+
+    def remove(self, unit_id: str) -> None:
+        if unit_id not in self.units:
+            return
+        freqs, length, _ = self.units.pop(unit_id)
+        self.total_length -= length
+        for term in freqs:
+            posting = self.postings[term]
+            del posting[unit_id]
+            self.columns.pop(term, None)
+            if len(posting) == 0:
+                del self.postings[term]
+                del self.vocabulary[bisect_left(self.vocabulary, term)]
+        row = self.rows.pop(unit_id)
+        self.ids[row] = None
+        self.lengths[row] = 0
+        self.times[row] = 0
+        self.free_rows.append(row)
+
+    def add(self, unit_id: str, pith: str, created_at: Any) -> None:
+        """
+        Index the unit, replacing any previous version of it.
+        """
+        self.add_freqs(unit_id, token_stats(pith)[0], created_at)
+
+    def add_many(self, units: List[Tuple[str, str, Any]]) -> None:
+        """
+        Index (unit id, pith, created at) triples, tokenized together.
+        """
+        freq_dicts = utils.batch_freq_dicts([index_text(p) for _, p, _ in units])
+        for (unit_id, _, created_at), freqs in zip(units, freq_dicts):
+            self.add_freqs(unit_id, freqs, created_at)
+
+    def add_freqs(self, unit_id: str, freqs: Dict[str, int], created_at: Any) -> None:
+        """
+        Index the unit from its stored term frequencies.
+        """
+        self.remove(unit_id)
+        length = sum(freqs.values())
+        self.units[unit_id] = (freqs, length, created_at)
+        self.total_length += length
+        row = self._take_row(unit_id)
+        self.lengths[row] = length
+        self.times[row] = created_at.timestamp() if created_at is not None else 0
+        for term, freq in freqs.items():
+            if term not in self.postings:
+                self.postings[term] = {}
+                insort(self.vocabulary, term)
+            self.postings[term][unit_id] = freq
+            self.columns.pop(term, None)
+
+    def scores(self, terms: List[str]) -> np.ndarray:
+        """
+        BM25 score of every row for the already stemmed terms.
+        """
+        scores = np.zeros(len(self.ids))
+        terms = [t for t in terms if t in self.postings]
+        if len(terms) == 0:
+            return scores
+        weights = pos_weights(terms)
+        n = len(self.units)
+        avg_length = self.total_length / n
+        for term in terms:
+            if weights[term] == 0:
+                continue
+            rows, freqs = self._column(term)
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            if avg_length > 0:
+                norm = K1 * (1 - B + B * self.lengths[rows] / avg_length)
+            else:
+                norm = K1
+            # rows of a term are unique, so fancy indexing adds once each
+            scores[rows] += weights[term] * idf * freqs * (K1 + 1) / (freqs + norm)
+        return scores
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[str]:
+        terms = list(set(utils.text_tokens(query)))
+        scores = self.scores(terms)
+        rows = np.flatnonzero(scores > 0)
+        if limit is not None and limit < len(rows):
+            # keep every row tied with the last one, so ties still go newest first
+            kth = np.partition(scores[rows], len(rows) - limit)[len(rows) - limit]
+            rows = rows[scores[rows] >= kth]
+        # last key sorts first
+        order = np.lexsort((-self.times[rows], -scores[rows]))
+        ranked = [self.ids[r] for r in rows[order]]
+        return ranked if limit is None else ranked[:limit]
+
+    def prefix_terms(self, prefix: str, limit: int) -> List[str]:
+        start = bisect_left(self.vocabulary, prefix)
+        terms = []
+        for term in self.vocabulary[start:start + limit]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def typeahead(self, text: str, limit: int, 
+        keep: Callable[[str], bool] = lambda u: True) -> List[str]:
+        """
+        Units containing every complete word of the text and a word starting
+        with the last, partly typed one. Ranked by how much of each unit the
+        words make up, newest first among equals.
+        """
+        words = utils.text_words(text)
+        if len(words) == 0:
+            return []
+        terms = [utils.stem(w) for w in words[:-1]]
+        last = words[-1]
+        # a partly typed word may be a prefix of the word or of its stem
+        prefixes = set([last, utils.stem(last)])
+        if text[-1:].isspace(): # the last word is complete too
+            terms.append(utils.stem(last))
+            prefixes = set()
+
+        candidates = None
+        for term in terms:
+            units = set(self.postings.get(term, {}))
+            candidates = units if candidates is None else candidates & units
+        matched: Dict[str, int] = {}
+        if len(prefixes) > 0:
+            for prefix in prefixes:
+                for term in self.prefix_terms(prefix, TYPEAHEAD_MAX_TERMS):
+                    for unit_id, freq in self.postings[term].items():
+                        matched[unit_id] = max(matched.get(unit_id, 0), freq)
+            candidates = set(matched) if candidates is None \
+                else candidates & set(matched)
+        if not candidates:
+            return []
+
+        def rank(unit_id: str) -> Tuple[float, Any]:
+            freqs, length, created_at = self.units[unit_id]
+            count = sum(freqs[t] for t in terms) + matched.get(unit_id, 0)
+            return (count / length, created_at)
 
-    return block_ids
+        results: List[str] = []
+        for unit_id in sorted(candidates, key=rank, reverse=True):
+            if len(results) >= limit:
+                break
+            if keep(unit_id):
+                results.append(unit_id)
+        return results
@@ -1,113 +1,106 @@
 from datetime import datetime
 import logging
+from types import SimpleNamespace
 import unittest
 
 from constants import DATE_TIME_FMT
-from models.discussion import (
-    Block,
-    Tag,
+from search.search import (
+  basic_search,
+  DiscussionIndex,
 )
-from search.basic_search import basic_search
-from search.tag_search import tag_search
 from utils.utils import make_freq_dict 
 
 
-class SearchTest(unittest.TestCase):
+def make_unit(id, pith, created_at):
+    return SimpleNamespace(
+      id=id,
+      pith=pith,
+      created_at=datetime.strptime(created_at, DATE_TIME_FMT),
+      freq_dict=make_freq_dict(pith)
+    )
 
-    def setUp(self) -> None:
-        pass
 
-    def test_basic_search(self) -> None:
-        query = "good whales"
-
-        b1 = Block(body="whales whales whales whales"
-          + " good good"
-          + " bad"
-          + " the the the"
-          + " nice nice"
-          + " he"
-        )
-        b1.id = "1"
-        b1.created_at = datetime.strptime("2020-05-06T00:00:00Z", DATE_TIME_FMT) 
-        b1.freq_dict = make_freq_dict(b1.body)
-
-        b2 = Block(body="whales whales whales whales"
-          + " good good"
-          + " bad"
-          + " the the the"
-          + " nice nice"
-          + " he"
-        )
-        b2.id = "2"
-        b2.created_at = datetime.strptime("2020-05-01T00:00:00Z", DATE_TIME_FMT) 
-        b2.freq_dict = make_freq_dict(b2.body)
+class SearchTest(unittest.TestCase):
 
-        b3 = Block(body="whales whales whales whales"
+    def setUp(self) -> None:
+        body = ("whales whales whales whales"
           + " good good"
           + " bad"
           + " the the the"
           + " nice nice"
           + " he"
         )
-        b3.id = "3"
-        b3.created_at = datetime.strptime("2020-05-08T00:00:00Z", DATE_TIME_FMT) 
-        b3.freq_dict = make_freq_dict(b3.body)
-
-        b4 = Block(body="whales whales whales whales whales whales whales whales"
-          + " the the the"
-        )
-        b4.id = "4"
-        b4.created_at = datetime.strptime("2020-05-07T00:00:00Z", DATE_TIME_FMT) 
-        b4.freq_dict = make_freq_dict(b4.body)
+        self.units = [
+          make_unit("1", body, "2020-05-06T00:00:00.000Z"),
+          make_unit("2", body, "2020-05-01T00:00:00.000Z"),
+          make_unit("3", body, "2020-05-08T00:00:00.000Z"),
+          make_unit("4", "whales whales whales whales whales whales whales whales"
+            + " the the the", "2020-05-07T00:00:00.000Z"),
+          make_unit("5", "oranges oranges oranges"
+            + " friends friends", "2020-05-06T00:00:00.000Z"),
+          make_unit("6", "whale whale whale whale whale whale"
+            + " the the"
+            + " good good", "2020-05-06T00:00:00.000Z"),
+        ]
 
-        b5 = Block(body="oranges oranges oranges"
-          + " friends friends"
-        )
-        b5.id = "5"
-        b5.created_at = datetime.strptime("2020-05-06T00:00:00Z", DATE_TIME_FMT) 
-        b5.freq_dict = make_freq_dict(b5.body)
-
-        b6 = Block(body="whale whale whale whale whale whale"
-          + " the the"
-          + " good good"
-        )
-        b6.id = "6"
-        b6.created_at = datetime.strptime("2020-05-06T00:00:00Z", DATE_TIME_FMT) 
-        b6.freq_dict = make_freq_dict(b6.body)
-
-        results = basic_search(query, [b1, b2, b3, b4, b5, b6])
+    def test_basic_search(self) -> None:
+        results = basic_search("good whales", self.units)
         self.assertEqual(results, ["6", "3", "1", "2", "4"])
 
-    def test_tag_search(self) -> None:
-        tags = ["good", "whales"]
-
-        b1 = Block(body="")
-        b1.id = "1"
-        b1.created_at = datetime.strptime("2020-05-06T00:00:00Z", DATE_TIME_FMT)
-        b1.tags = [Tag(tag=t) for t in ["whales", "good", "bad", "nice"]] 
-
-        b2 = Block(body="")
-        b2.id = "2"
-        b2.created_at = datetime.strptime("2020-05-01T00:00:00Z", DATE_TIME_FMT)
-        b2.tags = [Tag(tag=t) for t in ["whales", "good", "bad", "nice"]]
+    def test_index_search(self) -> None:
+        index = DiscussionIndex()
+        for u in self.units:
+          index.add(u.id, u.pith, u.created_at)
 
-        b3 = Block(body="")
-        b3.id = "3"
-        b3.created_at = datetime.strptime("2020-05-08T00:00:00Z", DATE_TIME_FMT)
-        b3.tags = [Tag(tag=t) for t in ["whales", "good", "bad", "nice"]] 
-
-        b4 = Block(body="")
-        b4.id = "4"
-        b4.created_at = datetime.strptime("2020-05-07T00:00:00Z", DATE_TIME_FMT)
-        b4.tags = [Tag(tag=t) for t in ["whales", "lovely"]]
-
-        b5 = Block(body="")
-        b5.id = "5"
-        b5.created_at = datetime.strptime("2020-05-06T00:00:00Z", DATE_TIME_FMT)
-        b5.tags = [Tag(tag=t) for t in ["oranges", "friends"]] 
-
-        results = tag_search(tags, [b1, b2, b3, b4, b5])
-        self.assertEqual(results, ["3", "1", "2", "4"])
+        # shorter units with both terms first, newest first among equals
+        results = index.search("good whales")
+        self.assertEqual(results, ["6", "3", "1", "2", "4"])
+        self.assertEqual(index.search("good whales", limit=2), ["6", "3"])
+        # ties at the limit are still newest first
+        self.assertEqual(index.search("good whales", limit=3), ["6", "3", "1"])
+        self.assertEqual(index.search("orange"), ["5"])
+        self.assertEqual(index.search("dolphins"), [])
+
+    def test_index_update(self) -> None:
+        index = DiscussionIndex()
+        for u in self.units:
+          index.add(u.id, u.pith, u.created_at)
+        total_length = index.total_length
+
+        # replaced, not added to
+        index.add("5", "whales <cite>abc</cite>", self.units[4].created_at)
+        self.assertEqual(index.search("orange"), [])
+        self.assertEqual(index.search("abc"), [])
+        self.assertTrue("5" in index.search("whales"))
+
+        index.remove("5")
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.total_length, total_length - 5)
+        self.assertFalse("5" in index.search("whales"))
+        self.assertFalse("orang" in index.postings)
+
+        # the removed unit's row is reused
+        index.add("7", "whales", self.units[4].created_at)
+        self.assertEqual(len(index.ids), 6)
+        self.assertTrue("7" in index.search("whales"))
+
+    def test_typeahead(self) -> None:
+        index = DiscussionIndex()
+        for u in self.units:
+          index.add(u.id, u.pith, u.created_at)
+
+        self.assertEqual(index.prefix_terms("wh", 10), ["whale"])
+        self.assertEqual(index.typeahead("wha", 10), ["4", "6", "3", "1", "2"])
+        self.assertEqual(index.typeahead("good wha", 2), ["6", "3"])
+        self.assertEqual(index.typeahead("oranges fr", 10), ["5"])
+        self.assertEqual(index.typeahead("oranges whal", 10), [])
+        self.assertEqual(index.typeahead("good wha", 10, lambda u: u != "6"),
+          ["3", "1", "2"])
+
+        # removed words no longer complete
+        index.remove("5")
+        self.assertEqual(index.prefix_terms("orang", 10), [])
+        self.assertEqual(index.typeahead("fr", 10), [])
 
 
 if __name__ == "__main__":
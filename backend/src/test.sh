@@ -8,8 +8,11 @@ mypy .
 
 # functionality tests
 python3.8 utils/tests/test_utils.py
-#python3.8 search/tests/test_search.py
+python3.8 search/tests/test_search.py
+python3.8 worker/tests/test_export.py
 
 # manager tests
 python3.8 managers/tests/board_manager_test.py
 python3.8 managers/tests/discussion_manager_test.py
+python3.8 managers/tests/client_manager_test.py
+python3.8 managers/tests/admission_manager_test.py
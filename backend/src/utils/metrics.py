@@ -0,0 +1,68 @@
+"""
+Per-process counters, served in the Prometheus text format on /metrics.
+Each worker process reports its own, labelled with its index and pid, and
+they are not summed across workers. When workers share a port, a scrape is
+answered by one of them at random; without it, each is scraped on its own.
+"""
+
+from collections import defaultdict
+import os
+from typing import (
+  Any,
+  Callable,
+  Dict,
+  List,
+)
+
+from aiohttp import web
+
+
+labels = {"pid": str(os.getpid())}
+# event name -> [calls, errors, total seconds]
+events: Dict[str, List[Any]] = defaultdict(lambda: [0, 0, 0.0])
+# event name -> events turned away by rate limits
+limited: Dict[str, int] = defaultdict(int)
+# metric name -> function returning its current value
+gauges: Dict[str, Callable[[], float]] = {}
+
+
+def set_labels(**kwargs: Any) -> None:
+  labels.update({k: str(v) for k, v in kwargs.items()})
+
+
+def observe(name: str, seconds: float, error: bool = False) -> None:
+  entry = events[name]
+  entry[0] += 1
+  entry[1] += int(error)
+  entry[2] += seconds
+
+
+def limit(name: str) -> None:
+  limited[name] += 1
+
+
+def gauge(name: str, func: Callable[[], float]) -> None:
+  gauges[name] = func
+
+
+def _format(name: str, value: float, **extra: str) -> str:
+  all_labels = dict(labels, **extra)
+  label_str = ",".join('{}="{}"'.format(k, v) for k, v in sorted(all_labels.items()))
+  return "pith_{}{{{}}} {}".format(name, label_str, value)
+
+
+def render() -> str:
+  lines = []
+  for name, (calls, errors, seconds) in sorted(events.items()):
+    lines.append(_format("event_calls_total", calls, event=name))
+    lines.append(_format("event_errors_total", errors, event=name))
+    lines.append(_format("event_seconds_total", seconds, event=name))
+  for name, count in sorted(limited.items()):
+    lines.append(_format("event_rate_limited_total", count, event=name))
+  for name, func in sorted(gauges.items()):
+    lines.append(_format(name, func()))
+  return "\n".join(lines) + "\n"
+
+
+async def handle(request: web.Request) -> web.Response:
+  return web.Response(text=render(), content_type="text/plain")
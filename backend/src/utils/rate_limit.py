@@ -0,0 +1,54 @@
+"""
+Token buckets limiting how fast each connection may send each class of
+event, checked before an event does any work.
+"""
+
+import time
+from typing import (
+  Dict,
+  List,
+  Optional,
+  Tuple,
+)
+
+
+class RateLimiter:
+
+  def __init__(self, limits: Dict[str, Tuple[float, float]],
+      classes: Dict[str, str]) -> None:
+    # event class -> (tokens added per second, most tokens held)
+    self.limits = limits
+    # event -> event class; other events are not limited
+    self.classes = classes
+    # sid -> event class -> [tokens, last refill]
+    self.buckets: Dict[str, Dict[str, List[float]]] = {}
+
+  def allow(self, sid: str, event: str, cost: int = 1,
+      now: Optional[float] = None) -> bool:
+    """
+    Takes `cost` tokens if any are left. A cost above one may leave the
+    bucket in debt, so a large batch passes once and is then paid off.
+    """
+    event_class = self.classes.get(event)
+    if event_class is None:
+      return True
+    rate, burst = self.limits[event_class]
+    if now is None:
+      now = time.monotonic()
+
+    buckets = self.buckets.setdefault(sid, {})
+    bucket = buckets.get(event_class)
+    if bucket is None:
+      bucket = [burst, now]
+      buckets[event_class] = bucket
+    else:
+      bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+      bucket[1] = now
+
+    if bucket[0] < 1:
+      return False
+    bucket[0] -= cost
+    return True
+
+  def forget(self, sid: str) -> None:
+    self.buckets.pop(sid, None)
@@ -0,0 +1,82 @@
+"""
+Runs the app in several worker processes so one container uses every core.
+
+Workers are started with spawn, so a reload (SIGHUP) loads the current code.
+Workers that exit are restarted; SIGTERM and SIGINT stop them all.
+"""
+
+import multiprocessing
+import signal
+import time
+from typing import (
+  Callable,
+  Dict,
+)
+
+from utils.utils import logger
+
+
+def _stop(process: multiprocessing.Process, timeout: float) -> None:
+  # aiohttp shuts down gracefully on SIGTERM (on_shutdown hooks run)
+  process.terminate()
+  process.join(timeout)
+  if process.is_alive():
+    process.kill()
+    process.join()
+
+
+def supervise(target: Callable[[int], None], workers: int, 
+    overlap: bool = False, timeout: float = 30) -> None:
+  """
+  Run target(index) in `workers` processes until asked to stop.
+  On reload, workers are replaced one at a time. With `overlap` the new one
+  starts before the old one stops, which needs the port to be shared
+  (SO_REUSEPORT); otherwise the old one stops first.
+  """
+  ctx = multiprocessing.get_context("spawn")
+  processes: Dict[int, multiprocessing.Process] = {}
+  state = {"stop": False, "reload": False}
+
+  def start(index: int) -> multiprocessing.Process:
+    process = ctx.Process(target=target, args=(index,), daemon=False)
+    process.start()
+    logger.info("started worker {} (pid {})\n".format(index, process.pid))
+    return process
+
+  def on_stop(signum, frame):
+    state["stop"] = True
+
+  def on_reload(signum, frame):
+    state["reload"] = True
+
+  signal.signal(signal.SIGTERM, on_stop)
+  signal.signal(signal.SIGINT, on_stop)
+  signal.signal(signal.SIGHUP, on_reload)
+
+  for i in range(workers):
+    processes[i] = start(i)
+
+  while not state["stop"]:
+    if state["reload"]:
+      state["reload"] = False
+      for i in range(workers):
+        if overlap:
+          old, processes[i] = processes[i], start(i)
+          time.sleep(1) # let the new worker bind before the old one leaves
+          _stop(old, timeout)
+        else:
+          _stop(processes[i], timeout)
+          processes[i] = start(i)
+
+    for i, process in processes.items():
+      if not process.is_alive():
+        logger.info("worker {} exited with {}\n".format(i, process.exitcode))
+        processes[i] = start(i)
+    time.sleep(0.5)
+
+  for process in processes.values():
+    process.terminate()
+  for process in processes.values():
+    process.join(timeout)
+    if process.is_alive():
+      process.kill()
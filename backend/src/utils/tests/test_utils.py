@@ -2,6 +2,7 @@ import logging
 import unittest
 
 from utils import utils
+from utils.rate_limit import RateLimiter
 
 
 class TestUtils(unittest.TestCase):
@@ -29,6 +30,21 @@ class TestUtils(unittest.TestCase):
         freq_dict = utils.make_freq_dict(text)
         self.assertEqual(freq_dict["you"], 2)
 
+    def test_batch_text_tokens(self) -> None:
+        texts = ["Make believe and play hard!", "", "Playing makes believers."]
+        self.assertEqual(utils.batch_text_tokens(texts),
+            [utils.text_tokens(t) for t in texts])
+        self.assertEqual(utils.batch_freq_dicts(texts),
+            [utils.make_freq_dict(t) for t in texts])
+
+    def test_stem_cache(self) -> None:
+        utils.stem.cache_clear()
+        utils.text_tokens("whales and whales")
+        stats = utils.stem_cache_stats()
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["size"], 2)
+
     def test_sum_dicts(self) -> None:
         sum_dict = utils.sum_dicts([
             {"A": 1, "B": 2},
@@ -37,6 +53,49 @@ class TestUtils(unittest.TestCase):
         ])
         self.assertEqual(sum_dict, {"A": 4, "B": 7, "C": 4, "E": 8})
 
+    def test_list_delta(self) -> None:
+        def apply(old, ops):
+            res = list(old)
+            for o in ops:
+                if o["op"] == "remove":
+                    del res[o["position"]:o["position"] + o["count"]]
+                else:
+                    res[o["position"]:o["position"]] = o["units"]
+            return res
+
+        cases = [
+            ([], []),
+            ([], ["A", "B"]),
+            (["A", "B"], []),
+            (["A", "B", "C"], ["A", "X", "B", "C"]),
+            (["A", "B", "C", "D"], ["D", "A", "C"]),
+            (["A", "B", "C", "D", "E"], ["A", "X", "Y", "D", "Z"]),
+        ]
+        for old, new in cases:
+            self.assertEqual(apply(old, utils.list_delta(old, new)), new)
+
+        ops = utils.list_delta(["A", "B", "C"], ["A", "X", "B", "C"])
+        self.assertEqual(ops, [{"op": "insert", "position": 1, "units": ["X"]}])
+
+    def test_rate_limiter(self) -> None:
+        limiter = RateLimiter({"read": (2, 3)}, {"search": "read"})
+        # the burst, then nothing until tokens come back
+        self.assertEqual([limiter.allow("a", "search", now=0) for _ in range(4)],
+            [True, True, True, False])
+        self.assertTrue(limiter.allow("b", "search", now=0))
+        self.assertTrue(limiter.allow("a", "search", now=0.5))
+        self.assertFalse(limiter.allow("a", "search", now=0.5))
+        # unlimited events
+        self.assertTrue(all(limiter.allow("a", "leave", now=0.5) for _ in range(10)))
+
+        # a large batch passes once, then is paid off
+        self.assertTrue(limiter.allow("c", "search", cost=5, now=0))
+        self.assertFalse(limiter.allow("c", "search", now=1))
+        self.assertTrue(limiter.allow("c", "search", now=2))
+
+        limiter.forget("a")
+        self.assertTrue(limiter.allow("a", "search", now=0.5))
+
 
 if __name__ == "__main__":
     logging.info("Running util tests...")
@@ -1,13 +1,13 @@
 from collections import Counter, defaultdict
 import datetime
-from functools import reduce
+from difflib import SequenceMatcher
+from functools import lru_cache
 from json import JSONEncoder, dumps
 from mongoengine import (
   Document,
   EmbeddedDocument,
 )
 from nltk.stem import PorterStemmer
-from operator import or_
 import string
 from typing import (
   Any,
@@ -53,15 +53,26 @@ sys.excepthook = exception_handler
 def is_error(src):
   if src is None:
     return False
+  if isinstance(src, tuple) and len(src) == 2: # may be (error, details)
+    return isinstance(src[0], Errors)
   return isinstance(src, Errors) 
 
-def make_error(err, info={}):
+def split_error(src):
+  """
+  (error, details) of an error, with details None if it has none.
+  """
+  if isinstance(src, tuple):
+    return src
+  return src, None
+
+def make_error(err, info={}, log=True):
   exp = {
     "_id": uuid4().hex,
     "error": err,
     "info": info
   }
-  logger.exception(exp)
+  if log:
+    logger.exception(exp)
   return dumps(exp, cls=ErrorEncoder)
 
 
@@ -69,21 +80,76 @@ ps = PorterStemmer()
 table = str.maketrans(string.punctuation, ' '*len(string.punctuation))
 
 
-def text_tokens(text: str) -> List[str]:
+def text_words(text: str) -> List[str]:
   lower_case = text.lower()
   no_punc = lower_case.translate(table)
   word_list = no_punc.split(" ")
   word_list = [w.strip() for w in word_list]
   word_list = [w for w in word_list if w != ""]
-  stemmed = [ps.stem(w) for w in word_list]
+  return word_list
+
+
+@lru_cache(maxsize=constants.STEM_CACHE_SIZE)
+def stem(word: str) -> str:
+  return ps.stem(word)
+
+
+def stem_cache_stats() -> Dict[str, float]:
+  info = stem.cache_info()
+  calls = info.hits + info.misses
+  return {
+    "hits": info.hits,
+    "misses": info.misses,
+    "size": info.currsize,
+    "hit_rate": info.hits / calls if calls > 0 else 0.0
+  }
+
+
+def text_tokens(text: str) -> List[str]:
+  word_list = text_words(text)
+  stemmed = [stem(w) for w in word_list]
   return stemmed
 
 
+def batch_text_tokens(texts: List[str]) -> List[List[str]]:
+  """
+  Tokens of each text, stemming each distinct word once.
+  """
+  word_lists = [text_words(t) for t in texts]
+  stems = {w: stem(w) for w in set(w for words in word_lists for w in words)}
+  return [[stems[w] for w in words] for words in word_lists]
+
+
 def make_freq_dict(text: str) -> Dict[str, int]:
   tokens = text_tokens(text)
   return dict(Counter(tokens))
 
 
+def batch_freq_dicts(texts: List[str]) -> List[Dict[str, int]]:
+  return [dict(Counter(tokens)) for tokens in batch_text_tokens(texts)]
+
+
 def sum_dicts(dL: List[Dict[Any, Any]]) -> Dict[Any, Any]:
-  keys = reduce(or_, [set(d) for d in dL])
-  return defaultdict(lambda:0, {k:sum([d.get(k,0) for d in dL]) for k in keys})
+  total: Dict[Any, Any] = defaultdict(lambda:0)
+  for d in dL:
+    for k, v in d.items():
+      total[k] += v
+  return total
+
+
+def list_delta(old: List[Any], new: List[Any]) -> List[Dict[str, Any]]:
+  """
+  Operations that turn `old` into `new` when applied in order. Each is either
+  {"op": "remove", "position": i, "count": n} or 
+  {"op": "insert", "position": i, "units": [...]}.
+  """
+  ops = []
+  offset = 0 # shift of positions in old from applied operations
+  matcher = SequenceMatcher(None, old, new, autojunk=False)
+  for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+    if tag in ("replace", "delete"):
+      ops.append({"op": "remove", "position": i1 + offset, "count": i2 - i1})
+    if tag in ("replace", "insert"):
+      ops.append({"op": "insert", "position": i1 + offset, "units": new[j1:j2]})
+    offset += (j2 - j1) - (i2 - i1)
+  return ops
@@ -0,0 +1,174 @@
+"""
+Streaming export of a discussion's document.
+
+The shape of the document (unit ids and their children) is fetched in one
+query. The tree is then walked depth first, and piths are fetched in
+batches in document order and written out as they arrive, so no more than
+a batch of piths is held at once.
+"""
+
+import html
+from json import dumps
+import os
+
+import constants
+
+from models.discussion import (
+  Discussion,
+  Unit,
+)
+
+
+# format -> file extension
+FORMATS = {
+  "markdown": "md",
+  "html": "html",
+  "json": "json",
+}
+
+
+def export_path(discussion_id, export_id, format):
+    return os.path.join(constants.EXPORT_DIR, discussion_id,
+      "{}.{}".format(export_id, FORMATS[format]))
+
+
+def export_url(discussion_id, export_id, format):
+    return "{}/{}/{}.{}".format(constants.EXPORT_URL, discussion_id,
+      export_id, FORMATS[format])
+
+
+def fetch_tree(discussion_id):
+    """
+    Root unit id, children of each visible document unit, in one query.
+    """
+    root = Discussion.objects(id=discussion_id).only("document").get().document
+    children = {}
+    units = Unit.objects(discussion=discussion_id, in_chat=False) \
+      .only("id", "children", "hidden").as_pymongo()
+    for u in units:
+      if not u.get("hidden", False):
+        children[u["_id"]] = u.get("children", [])
+    return root, children
+
+
+def walk(root, children):
+    """
+    (unit id, parent id, depth) of the units under the root in document
+    order. Hidden units are left out along with everything under them.
+    """
+    stack = [(c, root, 0) for c in reversed(children.get(root, []))]
+    while len(stack) > 0:
+      unit_id, parent, depth = stack.pop()
+      if unit_id not in children:
+        continue
+      yield unit_id, parent, depth
+      stack.extend((c, unit_id, depth + 1) for c in reversed(children[unit_id]))
+
+
+def with_piths(walked, batch_size):
+    """
+    Adds the pith to each walked unit, fetching a batch at a time.
+    """
+    batch = []
+    for item in walked:
+      batch.append(item)
+      if len(batch) == batch_size:
+        yield from _fill(batch)
+        batch = []
+    yield from _fill(batch)
+
+
+def _fill(batch):
+    if len(batch) == 0:
+      return
+    units = Unit.objects(id__in=[u for u, _, _ in batch]).only("id", "pith") \
+      .as_pymongo()
+    piths = {u["_id"]: u["pith"] for u in units}
+    for unit_id, parent, depth in batch:
+      yield unit_id, parent, depth, piths.get(unit_id, "")
+
+
+def _render(pith, link, escape):
+    """
+    Pith with each citation replaced by `link` formatted with the cited id.
+    """
+    parts = []
+    last = 0
+    for match in constants.LINK_PATTERN.finditer(pith):
+      parts.append(escape(pith[last:match.start()]))
+      parts.append(link.format(escape(match.group(1))))
+      last = match.end()
+    parts.append(escape(pith[last:]))
+    return "".join(parts)
+
+
+"""
+Writers, each yielding the text of a document piece by piece.
+"""
+
+
+def to_markdown(units):
+    for unit_id, _, depth, pith in units:
+      text = _render(pith, "[↗](#{})", lambda s: " ".join(s.split("\n")))
+      yield '{}- <a id="{}"></a>{}\n'.format("  " * depth, unit_id, text)
+
+
+def to_html(units):
+    yield '<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"></head>\n<body>\n'
+    last = -1
+    for unit_id, _, depth, pith in units:
+      if depth > last:
+        yield "<ul>\n"
+      else:
+        yield "</li>\n" + "</ul></li>\n" * (last - depth)
+      text = _render(pith, '<a href="#{0}">[{0}]</a>', html.escape)
+      yield '<li id="{}">{}'.format(unit_id, text)
+      last = depth
+    if last >= 0:
+      yield "</li>\n" + "</ul></li>\n" * last + "</ul>\n"
+    yield "</body>\n</html>\n"
+
+
+def to_json(units):
+    yield "["
+    separator = "\n"
+    for unit_id, parent, depth, pith in units:
+      yield separator + dumps({
+        "unit_id": unit_id,
+        "parent": parent,
+        "depth": depth,
+        "pith": pith
+      })
+      separator = ",\n"
+    yield "\n]\n"
+
+
+WRITERS = {
+  "markdown": to_markdown,
+  "html": to_html,
+  "json": to_json,
+}
+
+
+def export_document(discussion_id, format, path):
+    """
+    Writes the document to `path`, which only appears once complete.
+    Returns the number of units written.
+    """
+    count = 0
+
+    def counted(units):
+      nonlocal count
+      for u in units:
+        count += 1
+        yield u
+
+    root, children = fetch_tree(discussion_id)
+    units = counted(with_piths(walk(root, children), constants.EXPORT_BATCH_SIZE))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + ".part"
+    with open(partial, "w", encoding="utf-8") as f:
+      for piece in WRITERS[format](units):
+        f.write(piece)
+    os.replace(partial, path)
+    return count
@@ -0,0 +1,55 @@
+from json import loads
+import logging
+import unittest
+
+from worker import export
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # hidden units are left out of the tree, so "h" is skipped
+        self.children = {
+          "root": ["a", "h", "b"],
+          "a": ["c", "d"],
+          "c": [],
+          "d": [],
+          "b": [],
+        }
+
+    def units(self):
+        return [(u, p, d, "{} <cite>b</cite> & more".format(u))
+          for u, p, d in export.walk("root", self.children)]
+
+    def test_walk(self) -> None:
+        self.assertEqual(list(export.walk("root", self.children)), [
+          ("a", "root", 0),
+          ("c", "a", 1),
+          ("d", "a", 1),
+          ("b", "root", 0),
+        ])
+        self.assertEqual(list(export.walk("b", self.children)), [])
+
+    def test_to_markdown(self) -> None:
+        text = "".join(export.to_markdown(self.units()))
+        lines = text.splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[1], '  - <a id="c"></a>c [↗](#b) & more')
+
+    def test_to_html(self) -> None:
+        text = "".join(export.to_html(self.units()))
+        self.assertEqual(text.count("<ul>"), text.count("</ul>"))
+        self.assertEqual(text.count("<li"), text.count("</li>"))
+        self.assertTrue('<li id="c">c <a href="#b">[b]</a> &amp; more</li>' in text)
+
+    def test_to_json(self) -> None:
+        units = loads("".join(export.to_json(self.units())))
+        self.assertEqual([u["unit_id"] for u in units], ["a", "c", "d", "b"])
+        self.assertEqual(units[1]["parent"], "a")
+        self.assertEqual(units[1]["depth"], 1)
+        self.assertEqual(loads("".join(export.to_json([]))), [])
+
+
+if __name__ == "__main__":
+    logging.info("Running export tests...")
+    unittest.main()
@@ -2,7 +2,13 @@ import arq
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
-from worker.worker_functions import test  
+from worker.worker_functions import (
+  archive_cold_discussions,
+  export_document,
+  rollup_stats,
+  run_operation,
+  test,
+)
 import constants
 
 
@@ -20,4 +26,9 @@ class WorkerSettings(arq.worker.Worker):
     max_tries = constants.MAX_QUEUED_JOB_RETRIES
     on_startup = startup
     on_shutdown = shutdown
-    functions = [test]
+    functions = [test, export_document, run_operation]
+    cron_jobs = [
+      arq.cron(archive_cold_discussions, hour=constants.ARCHIVE_HOUR, minute=0),
+      arq.cron(rollup_stats, 
+        minute=set(range(0, 60, constants.STATS_ROLLUP_MINUTES)))
+    ]
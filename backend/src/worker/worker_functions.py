@@ -1,11 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta
+from functools import partial
 from json import dumps
+from jsonschema import validate
+from jsonschema.exceptions import ValidationError
+from managers.client_manager import DiscussionClientManager
+from managers.discussion_manager import DiscussionManager
 from managers.global_manager import GlobalManager
 
+import constants
+from error import Errors
+import schema.discussion_responses as dres
+from utils.utils import (
+  logger,
+  is_error,
+  split_error,
+  DictEncoder,
+)
+from worker import export
+
 
 gm = GlobalManager()
 gm.start()
 sio = gm.sio
+# emits to clients connected to the app instances
+external = DiscussionClientManager(constants.SOCKET_REDIS, write_only=True)
 
 async def test(ctx, x):
   print("in test", x)
   return gm.discussion_manager.test(x)
+
+async def export_document(ctx, discussion_id, format, export_id, sid):
+  """
+  Writes the document to the export store and tells the client who asked.
+  """
+  path = export.export_path(discussion_id, export_id, format)
+  result = {"export_id": export_id, "format": format}
+  try:
+    loop = asyncio.get_event_loop()
+    # blocking database reads and file writes stay off the worker's loop
+    result["units"] = await loop.run_in_executor(None, 
+      export.export_document, discussion_id, format, path)
+    result["url"] = export.export_url(discussion_id, export_id, format)
+  except Exception as e:
+    logger.info("export exception: {}\n".format(e))
+    result["failed"] = True
+  await external.emit("exported", dumps(result), namespace="/discussion", room=sid)
+  return result
+
+async def archive_cold_discussions(ctx):
+  """
+  Moves discussions without recent activity out of mongo.
+  """
+  loop = asyncio.get_event_loop()
+  archived = await loop.run_in_executor(None, gm.archive_manager.archive_cold)
+  logger.info("archived {} bytes of discussions\n".format(archived))
+  return archived
+
+async def run_operation(ctx, event, operation, sid):
+  """
+  Runs an operation the app offloaded and pushes out its results.
+  """
+  ret, emits = DiscussionManager._offload_operations[event]
+  message = {"job_id": ctx["job_id"], "event": event}
+  try:
+    loop = asyncio.get_event_loop()
+    product = await loop.run_in_executor(None, 
+      partial(getattr(gm.discussion_manager, event), **operation))
+  except Exception as e:
+    logger.info("operation exception: {}\n".format(e))
+    product = Errors.BAD_RESPONSE
+
+  if is_error(product):
+    error, details = split_error(product)
+    message["error"] = error.value
+    if details is not None:
+      message["details"] = details
+  else:
+    ret_res, emits_res = product
+    shared = dict(zip(emits or [], emits_res or []))
+    try:
+      if ret is not None:
+        validate(instance=ret_res, schema=dres.schema[ret])
+      for e, r in shared.items():
+        validate(instance=r, schema=dres.schema[e])
+    except ValidationError:
+      message["error"] = Errors.BAD_RESPONSE.value
+    else:
+      result = dict(ret_res or {})
+      result["shared"] = shared
+      message["result"] = result
+      if len(shared) > 0:
+        # everyone else has a copy to apply the delta to
+        shared = {k: v for k, v in shared.items() \
+          if k != "doc_meta" or "doc_delta" not in shared}
+        # logged for clients that miss it, and numbered so they know
+        seq = gm.event_log_manager.append(operation["discussion_id"], event, shared)
+        if seq is not None:
+          shared["seq"] = seq
+          result["seq"] = seq
+        await external.emit(event, dumps(shared, cls=DictEncoder), 
+          namespace="/discussion", room=operation["discussion_id"], skip_sid=sid)
+
+  await external.emit("job_done", dumps(message, cls=DictEncoder), 
+    namespace="/discussion", room=sid)
+  return message
+
+async def rollup_stats(ctx):
+  """
+  Adds new timeline intervals into each discussion's stats.
+  """
+  # twice the interval, so a late or failed run loses nothing
+  since = datetime.utcnow() - timedelta(minutes=2 * constants.STATS_ROLLUP_MINUTES)
+  loop = asyncio.get_event_loop()
+  return await loop.run_in_executor(None, gm.stats_manager.rollup_pending, since)
@@ -1,6 +1,7 @@
-import { discussionSocket as socket } from "./socket";
+import { discussionSocket as socket, routeToDiscussion } from "./socket";
 import { getValue, setValue } from "../api/local";
 import { createRequestWrapper } from "./queue";
+import { receive, resetSeq, getSeq, setGapHandler } from "./sequence";
 
 import {
   getStatus,
@@ -51,6 +52,9 @@ import {
   handleRequestToEdit,
   handleDeeditUnit,
   handleEditUnit,
+  handleBatch,
+  handleSetCursor,
+  broadcastHandlers,
 } from "./handlers";
 
 import {
@@ -82,6 +86,27 @@ import {
   SEARCH_FULFILLED,
 } from "../reducers/types";
 
+const handleJoined = (discussionId, userId, response, shared, dispatch) => {
+  handleJoin(shared, dispatch);
+  handleDocMeta(response.doc_meta, dispatch);
+  handleChatMeta(response.chat_meta, dispatch);
+
+  const timeline = unpackTimeline(response.timeline);
+  const icons = unpackCursors(response.cursors);
+  dispatch({
+    type: JOIN_USER_FULFILLED,
+    payload: {
+      discussionId: discussionId,
+      userId: userId,
+      nickname: response.nickname,
+      icons: icons,
+      currentUnit: response.current_unit,
+      timeline: timeline,
+      chatHistory: response.chat_history || [],
+    },
+  });
+};
+
 const joinUser = (discussionId, requestId) => {
   return (dispatch) => {
     // we assume join user to be called only when the userId is populated
@@ -106,24 +131,8 @@ const joinUser = (discussionId, requestId) => {
 
         if (statusCode === null) {
           // success
-          handleJoin(response.shared, dispatch);
-          handleDocMeta(response.doc_meta, dispatch);
-          handleChatMeta(response.chat_meta, dispatch);
-
-          const timeline = unpackTimeline(response.timeline);
-          const icons = unpackCursors(response.cursors);
-          dispatch({
-            type: JOIN_USER_FULFILLED,
-            payload: {
-              discussionId: discussionId,
-              userId: userId,
-              nickname: response.nickname,
-              icons: icons,
-              currentUnit: response.current_unit,
-              timeline: timeline,
-              chatHistory: response.chat_history || [],
-            },
-          });
+          handleJoined(discussionId, userId, response, response.shared, dispatch);
+          resetSeq(response.seq);
         }
         endRequest(statusCode);
       });
@@ -131,6 +140,58 @@ const joinUser = (discussionId, requestId) => {
   };
 };
 
+// fetch the broadcasts missed since `seq`, or all of join if too many were
+const resync = (seq, reconnected) => {
+  return (dispatch, getState) => {
+    const discussionId = getState().discussion.discussionId;
+    if (discussionId === null) {
+      return; // not joined yet
+    }
+    const userId = getValue(discussionId);
+
+    const handleResynced = (res) => {
+      const response = JSON.parse(res);
+      if (Object.keys(response).includes("error")) {
+        return;
+      }
+      const joined = response.joined || (seq === null ? response : undefined);
+      if (joined !== undefined) {
+        handleJoined(discussionId, userId, joined, response.shared, dispatch);
+        resetSeq(response.seq);
+        return;
+      }
+      for (const e of response.events) {
+        const handler = broadcastHandlers[e.event];
+        receive(e.seq, handler ? () => handler(e.shared, dispatch) : null);
+      }
+      // cursor moves are not logged
+      for (const cursor of response.cursors || []) {
+        handleSetCursor(cursor, dispatch);
+      }
+    };
+
+    const send = () => {
+      const data = {
+        discussion_id: discussionId,
+        user_id: userId,
+      };
+      if (seq === null) {
+        // nothing is known to be applied, so join again
+        socket.emit("join", data, handleResynced);
+      } else {
+        socket.emit("resync", { ...data, seq: seq }, handleResynced);
+      }
+    };
+
+    if (reconnected) {
+      // a new connection has no session yet
+      socket.emit("test_connect", { discussion_id: discussionId }, send);
+    } else {
+      send();
+    }
+  };
+};
+
 const enterDiscussion = (discussionId, requestId) => {
   return (dispatch) => {
     const data = {
@@ -143,6 +204,8 @@ const enterDiscussion = (discussionId, requestId) => {
       requestId
     );
 
+    routeToDiscussion(discussionId);
+
     startRequest(() => {
       socket.emit("test_connect", data, (res) => {
         const response = JSON.parse(res);
@@ -649,89 +712,100 @@ const subscribeChat = () => {
     socket.on("post", (res) => {
       console.log("post");
       const response = JSON.parse(res);
-      handlePost(response, dispatch);
+      receive(response.seq, () => handlePost(response, dispatch));
     });
   };
 };
 
 const subscribeDocument = () => {
   return (dispatch) => {
+    setGapHandler((seq) => dispatch(resync(seq, false)));
+    socket.on("reconnect", () => {
+      dispatch(resync(getSeq(), true));
+    });
+
     socket.on("join", (res) => {
       console.log("join");
       const response = JSON.parse(res);
-      handleJoin(response, dispatch);
+      receive(response.seq, () => handleJoin(response, dispatch));
     });
 
     socket.on("leave", (res) => {
       console.log("leave");
       const response = JSON.parse(res);
-      handleLeave(response, dispatch);
+      receive(response.seq, () => handleLeave(response, dispatch));
     });
 
     socket.on("load_unit_page", (res) => {
       console.log("load_unit_page");
       const response = JSON.parse(res);
-      handleLoadUnitPage(response, dispatch);
+      receive(response.seq, () => handleLoadUnitPage(response, dispatch));
     });
 
     socket.on("send_to_doc", (res) => {
       console.log("send_to_doc");
       const response = JSON.parse(res);
-      handleSendToDoc(response, dispatch);
+      receive(response.seq, () => handleSendToDoc(response, dispatch));
     });
 
     socket.on("hide_unit", (res) => {
       console.log("hide_unit");
       const response = JSON.parse(res);
-      handleHideUnit(response, dispatch);
+      receive(response.seq, () => handleHideUnit(response, dispatch));
     });
 
     socket.on("unhide_unit", (res) => {
       console.log("unhide_unit");
       const response = JSON.parse(res);
-      handleUnhideUnit(response, dispatch);
+      receive(response.seq, () => handleUnhideUnit(response, dispatch));
     });
 
     socket.on("add_unit", (res) => {
       console.log("add_unit");
       const response = JSON.parse(res);
-      handleAddUnit(response, dispatch);
+      receive(response.seq, () => handleAddUnit(response, dispatch));
     });
 
     socket.on("select_unit", (res) => {
       console.log("select_unit");
       const response = JSON.parse(res);
-      handleSelectUnit(response, dispatch);
+      receive(response.seq, () => handleSelectUnit(response, dispatch));
     });
 
     socket.on("deselect_unit", (res) => {
       console.log("deselect_unit");
       const response = JSON.parse(res);
-      handleDeselectUnit(response, dispatch);
+      receive(response.seq, () => handleDeselectUnit(response, dispatch));
     });
 
     socket.on("move_units", (res) => {
       console.log("move_units");
       const response = JSON.parse(res);
-      handleMoveUnits(response, dispatch);
+      receive(response.seq, () => handleMoveUnits(response, dispatch));
     });
 
     socket.on("request_to_edit", (res) => {
       console.log("request_to_edit");
       const response = JSON.parse(res);
-      handleRequestToEdit(response, dispatch);
+      receive(response.seq, () => handleRequestToEdit(response, dispatch));
     });
 
     socket.on("deedit_unit", (res) => {
       console.log("deedit_unit");
       const response = JSON.parse(res);
-      handleDeeditUnit(response, dispatch);
+      receive(response.seq, () => handleDeeditUnit(response, dispatch));
     });
 
     socket.on("edit_unit", (res) => {
       console.log("edit_unit");
       const response = JSON.parse(res);
-      handleEditUnit(response, dispatch);
+      receive(response.seq, () => handleEditUnit(response, dispatch));
+    });
+
+    socket.on("batch", (res) => {
+      console.log("batch");
+      const response = JSON.parse(res);
+      receive(response.seq, () => handleBatch(response, dispatch));
     });
   };
 };
@@ -13,3 +13,7 @@ export const FAILED_POSITION_ACQUIRE = -12;
 export const NICKNAME_EXISTS = -13;
 export const USER_ID_EXISTS = -14;
 export const INVALID_REFERENCE = -15;
+export const OVERLOADED = -16;
+export const RATE_LIMITED = -17;
+export const EDIT_CONFLICT = -18;
+export const JOB_NOT_QUEUED = -19;
@@ -1,4 +1,5 @@
-import { unpackChatMeta, unpackDocMeta } from "./utils";
+import { discussionSocket as socket } from "./socket";
+import { unpackChatMeta, unpackDocMeta, unpackDocDelta } from "./utils";
 import {
   SET_CURSOR,
   LEFT_USER,
@@ -17,6 +18,39 @@ const handleDocMeta = (response, dispatch) => {
   });
 };
 
+// doc_delta only applies to the version it was made from, otherwise resync
+const handleDocDelta = (response, dispatch) => {
+  dispatch((dispatch, getState) => {
+    const [docMeta, stale] = unpackDocDelta(
+      response,
+      getState().discussion.docMap
+    );
+    dispatch({
+      type: DOC_MAP,
+      payload: {
+        docMapAdd: docMeta,
+      },
+    });
+    if (stale.length > 0) {
+      socket.emit("get_doc_meta", { units: stale }, (res) => {
+        const resync = JSON.parse(res);
+        if (!Object.keys(resync).includes("error")) {
+          handleDocMeta(resync.doc_meta, dispatch);
+        }
+      });
+    }
+  });
+};
+
+// the requester receives doc_meta, everyone else receives doc_delta
+const handleDocUpdate = (shared, dispatch) => {
+  if (shared.doc_meta !== undefined) {
+    handleDocMeta(shared.doc_meta, dispatch);
+  } else {
+    handleDocDelta(shared.doc_delta, dispatch);
+  }
+};
+
 const handleChatMeta = (response, dispatch) => {
   const chatMeta = unpackChatMeta(response);
   dispatch({
@@ -68,47 +102,76 @@ const handleLoadUnitPage = (shared, dispatch) => {
   handleSetCursor(shared.set_cursor, dispatch);
 };
 const handlePost = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
   handleChatMeta(shared.chat_meta, dispatch);
   handleCreatedPost(shared.created_post, dispatch);
 };
 const handleSendToDoc = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
   handleChatMeta(shared.chat_meta, dispatch);
 };
 const handleHideUnit = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
 };
 const handleUnhideUnit = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
 };
 const handleAddUnit = (shared, dispatch) => {
   // no need to address added_unit
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
   handleChatMeta(shared.chat_meta, dispatch);
 };
 const handleSelectUnit = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
 };
 const handleDeselectUnit = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
 };
 const handleMoveUnits = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
 };
 const handleRequestToEdit = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
 };
 const handleDeeditUnit = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
 };
 const handleEditUnit = (shared, dispatch) => {
-  handleDocMeta(shared.doc_meta, dispatch);
+  handleDocUpdate(shared, dispatch);
+  handleChatMeta(shared.chat_meta, dispatch);
+};
+const handleBatch = (shared, dispatch) => {
+  handleDocUpdate(shared, dispatch);
   handleChatMeta(shared.chat_meta, dispatch);
+  for (const e of shared.batched_events || []) {
+    if (e.event === "post") {
+      handleCreatedPost(e.shared.created_post, dispatch);
+    }
+  }
+};
+
+// by the name each event is broadcast and logged under, to replay a resync
+const broadcastHandlers = {
+  post: handlePost,
+  join: handleJoin,
+  leave: handleLeave,
+  load_unit_page: handleLoadUnitPage,
+  send_to_doc: handleSendToDoc,
+  hide_unit: handleHideUnit,
+  unhide_unit: handleUnhideUnit,
+  add_unit: handleAddUnit,
+  select_unit: handleSelectUnit,
+  deselect_unit: handleDeselectUnit,
+  move_units: handleMoveUnits,
+  request_to_edit: handleRequestToEdit,
+  deedit_unit: handleDeeditUnit,
+  edit_unit: handleEditUnit,
+  batch: handleBatch,
 };
 
 export {
   handleDocMeta,
+  handleDocDelta,
   handleChatMeta,
   handleJoin,
   handleLeave,
@@ -124,4 +187,7 @@ export {
   handleRequestToEdit,
   handleDeeditUnit,
   handleEditUnit,
+  handleBatch,
+  handleSetCursor,
+  broadcastHandlers,
 };
@@ -0,0 +1,68 @@
+import { handleHideUnit } from "./handlers";
+import { DOC_MAP } from "../reducers/types";
+
+jest.mock("./socket", () => ({
+  discussionSocket: { emit: jest.fn() },
+}));
+
+const docMeta = {
+  unit_id: "a",
+  pith: "Whales sing.",
+  hidden: false,
+  created_at: "now",
+  edit_privilege: null,
+  position_privilege: null,
+  children: [],
+  backlinks: [],
+  version: 2,
+};
+
+// runs thunks against the given state, collecting plain actions
+const makeDispatch = (state) => {
+  const actions = [];
+  const dispatch = (action) => {
+    if (typeof action === "function") {
+      return action(dispatch, () => state);
+    }
+    actions.push(action);
+    return action;
+  };
+  return [dispatch, actions];
+};
+
+test("the requester's doc_meta replaces the cached units", () => {
+  const [dispatch, actions] = makeDispatch({ discussion: { docMap: {} } });
+  handleHideUnit({ doc_meta: [docMeta], doc_delta: [] }, dispatch);
+  expect(actions).toHaveLength(1);
+  expect(actions[0].type).toBe(DOC_MAP);
+  expect(actions[0].payload.docMapAdd.a.pith).toBe("Whales sing.");
+  expect(actions[0].payload.docMapAdd.a.version).toBe(2);
+});
+
+test("a doc_delta is applied to the cached version", () => {
+  const cached = {
+    pith: "Whales sing.",
+    hidden: false,
+    children: [],
+    backlinks: [],
+    version: 2,
+  };
+  const [dispatch, actions] = makeDispatch({
+    discussion: { docMap: { a: cached } },
+  });
+  const delta = {
+    unit_id: "a",
+    from_version: 2,
+    version: 3,
+    fields: { hidden: true },
+    children: [{ op: "insert", position: 0, units: ["b"] }],
+    backlinks: [],
+  };
+  handleHideUnit({ doc_delta: [delta] }, dispatch);
+  expect(actions).toHaveLength(1);
+  const unit = actions[0].payload.docMapAdd.a;
+  expect(unit.hidden).toBe(true);
+  expect(unit.pith).toBe("Whales sing.");
+  expect(unit.children).toEqual(["b"]);
+  expect(unit.version).toBe(3);
+});
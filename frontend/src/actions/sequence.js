@@ -0,0 +1,77 @@
+// every broadcast to a discussion carries the seq of its event log, so those
+// missed are noticed and fetched with resync
+
+// how long a gap may stay open before it is resynced, as the reply to our own
+// request may still be on its way
+const GAP_WAIT = 1000;
+
+// seq up to which every event has been applied, or null if not known yet
+let seen = null;
+// seq -> function applying it, or null for the reply to our own request
+const pending = new Map();
+let gapTimer = null;
+// called with `seen` to fetch what is missing
+let onGap = null;
+
+const drain = () => {
+  while (pending.has(seen + 1)) {
+    const apply = pending.get(seen + 1);
+    pending.delete(seen + 1);
+    seen += 1;
+    if (apply) {
+      apply();
+    }
+  }
+  if (pending.size === 0) {
+    clearTimeout(gapTimer);
+    gapTimer = null;
+  } else if (gapTimer === null) {
+    gapTimer = setTimeout(() => {
+      gapTimer = null;
+      if (pending.size > 0 && onGap !== null) {
+        onGap(seen);
+      }
+    }, GAP_WAIT);
+  }
+};
+
+// apply events in seq order, once each; those not logged are applied now
+const receive = (seq, apply = null) => {
+  if (seq === undefined || seq === null) {
+    if (apply) {
+      apply();
+    }
+    return;
+  }
+  if (seen === null) {
+    seen = seq - 1;
+  }
+  if (seq <= seen || pending.has(seq)) {
+    return;
+  }
+  pending.set(seq, apply);
+  drain();
+};
+
+// start over from a full load, which covers every event up to `seq`
+const resetSeq = (seq) => {
+  clearTimeout(gapTimer);
+  gapTimer = null;
+  seen = seq === undefined ? null : seq;
+  for (const s of [...pending.keys()]) {
+    if (seen === null || s <= seen) {
+      pending.delete(s);
+    }
+  }
+  if (seen !== null) {
+    drain();
+  }
+};
+
+const getSeq = () => seen;
+
+const setGapHandler = (handler) => {
+  onGap = handler;
+};
+
+export { receive, resetSeq, getSeq, setGapHandler, GAP_WAIT };
@@ -0,0 +1,50 @@
+import { receive, resetSeq, getSeq, setGapHandler, GAP_WAIT } from "./sequence";
+
+beforeEach(() => {
+  jest.useFakeTimers();
+  resetSeq(null);
+});
+
+test("events are applied once each, in seq order", () => {
+  const applied = [];
+  resetSeq(4);
+  receive(6, () => applied.push(6));
+  expect(applied).toEqual([]);
+  receive(5, () => applied.push(5));
+  receive(5, () => applied.push(5));
+  receive(4, () => applied.push(4));
+  expect(applied).toEqual([5, 6]);
+  expect(getSeq()).toBe(6);
+});
+
+test("the reply to our own request fills its place", () => {
+  const applied = [];
+  resetSeq(1);
+  receive(3, () => applied.push(3));
+  receive(2);
+  expect(applied).toEqual([3]);
+});
+
+test("a gap left open is resynced from the last seq applied", () => {
+  const gaps = [];
+  setGapHandler((seq) => gaps.push(seq));
+  resetSeq(1);
+  receive(3, () => {});
+  jest.advanceTimersByTime(GAP_WAIT - 1);
+  expect(gaps).toEqual([]);
+  jest.advanceTimersByTime(1);
+  expect(gaps).toEqual([1]);
+
+  // a full load covers what was waiting
+  resetSeq(5);
+  jest.advanceTimersByTime(GAP_WAIT);
+  expect(gaps).toEqual([1]);
+});
+
+test("the first seq is adopted when none is known", () => {
+  const applied = [];
+  receive(9, () => applied.push(9));
+  receive(undefined, () => applied.push("unlogged"));
+  expect(applied).toEqual([9, "unlogged"]);
+  expect(getSeq()).toBe(9);
+});
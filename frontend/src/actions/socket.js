@@ -1,11 +1,26 @@
 import io from "socket.io-client";
 
+// connects once the discussion is known, so the balancer can route by it
 const discussionSocket = io(
-	`${process.env.REACT_APP_BACKEND_HOST}:${process.env.REACT_APP_BACKEND_PORT}/discussion`
+	`${process.env.REACT_APP_BACKEND_HOST}:${process.env.REACT_APP_BACKEND_PORT}/discussion`,
+	{ autoConnect: false, forceNew: true }
 );
 
 const boardSocket = io(
 	`${process.env.REACT_APP_BACKEND_HOST}:${process.env.REACT_APP_BACKEND_PORT}`
 );
 
-export { boardSocket, discussionSocket };
+// (re)connect with the discussion id in the url; emits are buffered meanwhile
+const routeToDiscussion = (discussionId) => {
+	const query = discussionSocket.io.opts.query || {};
+	if (query.discussion_id === discussionId && discussionSocket.connected) {
+		return;
+	}
+	discussionSocket.io.opts.query = { discussion_id: discussionId };
+	if (discussionSocket.connected) {
+		discussionSocket.disconnect();
+	}
+	discussionSocket.connect();
+};
+
+export { boardSocket, discussionSocket, routeToDiscussion };
@@ -1,7 +1,10 @@
 import { GENERIC_ERROR } from "../utils/errors";
 import { SYSTEM_ERROR } from "./types";
+import { receive } from "./sequence";
 
 const getStatus = (response, dispatch, errorMap) => {
+  // our own events are not broadcast back, so their seq is noted here
+  receive(response.seq);
   let statusCode = null;
   if (Object.keys(response).includes("error")) {
     const errorStamp = response.error;
@@ -104,11 +107,56 @@ const unpackDocMeta = (docMetaArr = []) => {
       positionLock: unit.position_privilege,
       children: unit.children,
       backlinks: unit.backlinks,
+      version: unit.version,
     };
   }
   return docMeta;
 };
 
+const applyListDelta = (list = [], ops = []) => {
+  const res = [...list];
+  for (const o of ops) {
+    if (o.op === "remove") {
+      res.splice(o.position, o.count);
+    } else {
+      res.splice(o.position, 0, ...o.units);
+    }
+  }
+  return res;
+};
+
+// returns the updated doc map entries and the IDs of units that need a resync
+const unpackDocDelta = (docDeltaArr = [], docMap = {}) => {
+  const docMeta = {};
+  const stale = [];
+  for (const delta of docDeltaArr) {
+    const cached = docMeta[delta.unit_id] || docMap[delta.unit_id];
+    if (delta.from_version !== null && cached === undefined) {
+      continue; // not cached, nothing to update
+    }
+    if (delta.from_version !== null && cached.version !== delta.from_version) {
+      stale.push(delta.unit_id);
+      continue;
+    }
+    const base = cached || {};
+    const fields = delta.fields;
+    docMeta[delta.unit_id] = {
+      pith: "pith" in fields ? fields.pith : base.pith,
+      hidden: "hidden" in fields ? fields.hidden : base.hidden,
+      createdAt: "created_at" in fields ? fields.created_at : base.createdAt,
+      editLock: "edit_privilege" in fields ? fields.edit_privilege : base.editLock,
+      positionLock:
+        "position_privilege" in fields
+          ? fields.position_privilege
+          : base.positionLock,
+      children: applyListDelta(base.children, delta.children),
+      backlinks: applyListDelta(base.backlinks, delta.backlinks),
+      version: delta.version,
+    };
+  }
+  return [docMeta, stale];
+};
+
 const unpackContext = (contextObj = {}) => {
   const children = [];
   for (const entry in contextObj.children) {
@@ -136,4 +184,5 @@ export {
   unpackContext,
   unpackChatMeta,
   unpackDocMeta,
+  unpackDocDelta,
 };